@@ -0,0 +1,192 @@
+import contextlib
+import os
+import random
+import time
+from functools import wraps
+
+import fire
+from jericho import FrotzEnv
+from termcolor import cprint
+
+from run_game import ZORK1_ROM, make_agent, run_with_agent
+from text_agent.agents import ClaudeAgent
+from text_agent.base import AgentWrapper
+from utils.console import console
+from utils.mock_llm import MockAnthropic
+from utils.speculation import Speculator
+from utils.valid_actions import ValidActionCache
+
+# raw-history goes through instructor, which needs a real anthropic client.
+BENCHMARK_AGENTS = [
+    "random",
+    "thinking",
+    "summary",
+    "mentalmap",
+    "agentb",
+    "structuredmap",
+    "memo-thinking",
+    "search",
+]
+CATEGORIES = ["emulator", "valid_actions", "history", "llm", "io", "other"]
+
+
+class SectionTimer:
+    def __init__(self):
+        """
+        Accumulates exclusive time per category: time spent in a nested timed section is only
+        counted towards the innermost one.
+        """
+        self.totals = dict.fromkeys(CATEGORIES, 0.0)
+        self.stack = []
+
+    def wrap(self, obj, name: str, category: str):
+        method = getattr(obj, name)
+
+        @wraps(method)
+        def timed(*args, **kwargs):
+            self.stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                child_time = self.stack.pop()
+                self.totals[category] += elapsed - child_time
+                if self.stack:
+                    self.stack[-1] += elapsed
+
+        setattr(obj, name, timed)
+
+
+class TimedSink:
+    def __init__(self, timer: SectionTimer, file):
+        """
+        Stands in for stdout so console output counts as I/O without flooding the terminal.
+        :param file: Where the output really goes, usually os.devnull.
+        """
+        self.file = file
+        self.timer = timer
+        timer.wrap(self, "write", "io")
+
+    def write(self, text: str) -> int:
+        return self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+
+
+def benchmark_agent(
+    agent_type: str,
+    moves: int,
+    seed: int,
+    rom_path: str,
+    latency: float,
+    use_valid_action_cache: bool,
+    speculate: int = 0,
+) -> dict:
+    random.seed(seed)
+    timer = SectionTimer()
+
+    env = FrotzEnv(rom_path, seed=seed)
+    for name in ("reset", "step"):
+        timer.wrap(env, name, "emulator")
+    valid_action_cache = ValidActionCache(max_entries=4096 if use_valid_action_cache else 0)
+    timer.wrap(valid_action_cache, "get_valid_actions", "valid_actions")
+
+    agent = make_agent(
+        agent_type,
+        history_path="/dev/null",
+        anthropic_client=MockAnthropic(seed=seed, latency=latency),
+    )
+    timer.wrap(agent, "show_state", "history")
+    timer.wrap(agent, "choose_next_action", "other")
+    # Memo and search agents wrap the agent that calls the model.
+    model_agent = agent.inner if isinstance(agent, AgentWrapper) else agent
+    if isinstance(model_agent, ClaudeAgent):
+        timer.wrap(model_agent, "build_request", "history")
+        timer.wrap(model_agent.anthropic_client.messages, "create", "llm")
+        timer.wrap(model_agent.anthropic_client.messages, "stream", "llm")
+        timer.wrap(model_agent.history.writer, "write_entry", "io")
+
+    speculator = None
+    if speculate:
+        speculator = Speculator(rom_path, width=speculate)
+        for name in ("start", "step"):
+            timer.wrap(speculator, name, "emulator")
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(TimedSink(timer, devnull)):
+        try:
+            result = run_with_agent(
+                agent, valid_action_cache, max_moves=moves, env=env, speculator=speculator
+            )
+        finally:
+            agent.close()
+            if speculator is not None:
+                speculator.close()
+    wall_time = time.perf_counter() - start
+    if speculator is not None:
+        cprint(f"{agent_type} speculation: {speculator.stats()}", "yellow")
+
+    timer.totals["other"] += wall_time - sum(timer.totals.values())
+    return {
+        "agent": agent_type,
+        "moves": result["moves"],
+        "moves_per_sec": result["moves"] / wall_time,
+        "wall": wall_time,
+        **timer.totals,
+    }
+
+
+def print_benchmark_table(results: list[dict]):
+    header = f"{'agent':<14} {'moves':>6} {'moves/s':>9} {'wall s':>8}" + "".join(
+        f" {category:>13}" for category in CATEGORIES
+    )
+    cprint(header, "magenta")
+    for result in results:
+        print(
+            f"{result['agent']:<14} {result['moves']:>6} {result['moves_per_sec']:>9.1f} "
+            f"{result['wall']:>8.3f}"
+            + "".join(f" {result[category]:>13.3f}" for category in CATEGORIES)
+        )
+
+
+def run(
+    agents: str | list[str] | None = None,
+    moves: int = 100,
+    seed: int = 0,
+    rom_path: str = ZORK1_ROM,
+    latency: float = 0.0,
+    use_valid_action_cache: bool = True,
+    verbosity: str = "full",
+    speculate: int = 0,
+) -> list[dict]:
+    """
+    Plays each agent against a local mock model for a fixed number of moves and reports where
+    the harness spends its time. Needs the ROM but no network or API key.
+    :param agents: Agent types to benchmark, comma separated. Defaults to every agent that can
+        run against the mock model.
+    :param latency: Simulated seconds per model call.
+    :param verbosity: Console verbosity for the benchmarked runs, see run_game.run.
+    :param speculate: Actions to prepare in background emulators while the mock model waits,
+        see run_game.run.
+    """
+    if agents is None:
+        agents = BENCHMARK_AGENTS
+    elif isinstance(agents, str):
+        agents = agents.split(",")
+
+    console.configure(verbosity)
+    results = [
+        benchmark_agent(
+            agent_type, moves, seed, rom_path, latency, use_valid_action_cache, speculate
+        )
+        for agent_type in agents
+    ]
+    console.configure("full")
+    print_benchmark_table(results)
+    return results
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
@@ -1,79 +1,1096 @@
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
 import fire
 from dotenv import load_dotenv
 from jericho import FrotzEnv
-from termcolor import cprint
-
-from text_agent.agents import (
-    AgentInterface,
-    HumanAgent,
-    RandomAgent,
-    RawHistoryAgent,
-    SummaryAgent,
-    ThinkingAgent,
-    MentalMapAgent,
-    MentalMapAgentB,
+
+from text_agent.base import AgentInterface, AsyncAgent, AsyncAgentInterface, MemoAgent
+from text_agent.registry import OFFLINE_AGENTS, load_agent_class
+from utils.checkpoint import load_checkpoint, save_checkpoint
+from utils.console import console
+from utils.env_pool import init_env_pool, process_env_pool
+from utils.games import clean_intro, find_roms, game_name
+from utils.tracing import tracer
+from utils.trajectory import TrajectoryWriter, merge
+from utils.valid_actions import ValidActionCache, cache_path_for_rom
+
+ZORK1_ROM = "z-machine-games-master/jericho-game-suite/zork1.z5"
+# Where each evaluation episode saves the valid actions it has seen, inside its directory.
+EPISODE_VALID_ACTIONS = "valid_actions.json"
+# Game loop variables saved in checkpoints, in the order the loop unpacks them on resume.
+GAME_STATE = (
+    "move_number",
+    "observation",
+    "reward",
+    "score",
+    "done",
+    "info",
+    "chosen_action",
+    "agent_shown",
 )
 
 
-def clean_initial_observation(observation: str) -> str:
-    strip = """Copyright (c) 1981, 1982, 1983 Infocom, Inc. All rights reserved.
-ZORK is a registered trademark of Infocom, Inc.
-Revision 88 / Serial number 840726"""
+def run_with_agent(
+    agent: AgentInterface,
+    valid_action_cache: ValidActionCache | None = None,
+    rom_path: str = ZORK1_ROM,
+    seed: int | None = None,
+    max_moves: int | None = None,
+    env: FrotzEnv | None = None,
+    checkpoint_path: str | None = None,
+    checkpoint_every: int = 5,
+    resume: bool = False,
+    speculator=None,
+    trajectory: TrajectoryWriter | None = None,
+) -> dict:
+    """
+    :param checkpoint_path: Save the emulator, the game loop and the agent's memory here every
+        checkpoint_every moves and whenever the loop stops.
+    :param resume: Carry on from checkpoint_path if it exists instead of starting over.
+    :param speculator: utils.speculation.Speculator that prepares likely next moves in the
+        background while the agent chooses.
+    :param trajectory: Store that gets a row per move, including the opening observation.
+    """
+    if env is None:
+        env = FrotzEnv(rom_path, seed=seed)
+    if valid_action_cache is None:
+        valid_action_cache = ValidActionCache()
+
+    done = False
+    observation, info = env.reset()
+    observation = clean_intro(env.story_file.decode(), observation)
+    agent.attach_env(env)
+    move_number = 0
+    reward = 0
+    score = 0
+    chosen_action = "start"
+    # Whether the agent has been shown the move after move_number, which a checkpoint written by
+    # an interrupt in the middle of that move records.
+    agent_shown = False
+    trajectory_episode = None
+    if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        game = load_checkpoint(checkpoint_path, env, agent)
+        move_number, observation, reward, score, done, info, chosen_action, agent_shown = (
+            game[name] for name in GAME_STATE
+        )
+        trajectory_episode = game["trajectory_episode"]
+        console.summary(f"Resumed from {checkpoint_path} after move {move_number}", "yellow")
+    if trajectory is not None:
+        name = game_name(env.story_file.decode())
+        if trajectory_episode is None:
+            trajectory_episode = trajectory.begin_episode(name)
+            if move_number == 0:
+                trajectory.add_move(
+                    trajectory_episode, 0, chosen_action, observation, reward, score
+                )
+        else:
+            # Moves recorded after the checkpoint are replayed, so drop their rows.
+            trajectory.resume_episode(trajectory_episode, move_number, name)
+
+    completed_moves = saved_moves = move_number
+
+    def save_game():
+        nonlocal saved_moves
+        with tracer.span("checkpoint"):
+            save_checkpoint(
+                checkpoint_path,
+                env,
+                agent,
+                move_number=completed_moves,
+                observation=observation,
+                reward=reward,
+                score=score,
+                done=done,
+                info=info,
+                chosen_action=chosen_action,
+                agent_shown=agent_shown,
+                trajectory_episode=trajectory_episode,
+            )
+        saved_moves = completed_moves
+
+    try:
+        while not done and (max_moves is None or move_number < max_moves):
+            move_number += 1
+            input_tokens, output_tokens = agent.input_tokens, agent.output_tokens
+            with tracer.span("move", move=move_number):
+                with tracer.span("valid_actions"):
+                    valid_actions = None
+                    if speculator is not None:
+                        valid_actions = speculator.prepared_valid_actions(env)
+                    if valid_actions is None:
+                        valid_actions = valid_action_cache.get_valid_actions(env)
+                    else:
+                        valid_action_cache.put(env.get_world_state_hash(), valid_actions)
+                console.move(f"Move {move_number}:", "yellow")
+                console.move(f"Reward and Score: {reward} {info['score']}", "yellow")
+                console.move(f"Observation: {observation}", "green")
+                console.move(f"Valid Actions: {valid_actions}", "blue")
+                if not agent_shown:
+                    with tracer.span("agent.show_state"):
+                        agent.show_state(chosen_action, observation, reward, score, valid_actions)
+                    agent_shown = True
+                if speculator is not None:
+                    with tracer.span("speculation.start"):
+                        speculator.start(env, valid_actions)
+                with tracer.span("agent.choose_next_action"):
+                    start = time.perf_counter()
+                    chosen_action = agent.choose_next_action()
+                    latency = time.perf_counter() - start
+                console.move(f"Agent chose: {chosen_action}", "cyan")
+                with tracer.span("env.step"):
+                    if speculator is not None:
+                        observation, reward, done, info = speculator.step(env, chosen_action)
+                    else:
+                        observation, reward, done, info = env.step(chosen_action)
+                score = info["score"]
+                agent_shown = False
+                completed_moves = move_number
+                if trajectory is not None:
+                    trajectory.add_move(
+                        trajectory_episode,
+                        move_number,
+                        chosen_action,
+                        observation,
+                        reward,
+                        score,
+                        agent.input_tokens - input_tokens,
+                        agent.output_tokens - output_tokens,
+                        latency,
+                    )
+                if checkpoint_path is not None and (done or move_number % checkpoint_every == 0):
+                    save_game()
+                console.event(
+                    "move",
+                    move=move_number,
+                    action=chosen_action,
+                    reward=reward,
+                    score=score,
+                    done=done,
+                    observation=observation,
+                )
+    finally:
+        # Stopping at max_moves or on an interrupt or error saves the moves since the last
+        # checkpoint. A move cut short hasn't reached the emulator, so it restarts from the choice.
+        if checkpoint_path is not None and (saved_moves != completed_moves or agent_shown):
+            save_game()
+
+    if trajectory is not None:
+        trajectory.flush()
+    console.summary(f"Final Observation: {observation}", "green")
+    console.summary(f"Final Reward and Score: {reward} {score}", "magenta")
+    console.summary(f"Game Over! Scored {score} out of {env.get_max_score()}")
+    console.summary(f"Valid action cache: {valid_action_cache.stats()}", "yellow")
+    if speculator is not None:
+        console.summary(f"Speculation: {speculator.stats()}", "yellow")
+    console.summary(f"Invalid actions: {agent.invalid_actions} in {move_number} moves", "yellow")
+    if agent.cascade is not None:
+        console.summary(agent.cascade.summary(), "yellow")
 
-    return observation.replace(strip, "").strip()
+    return {
+        "score": score,
+        "max_score": env.get_max_score(),
+        "moves": move_number,
+        "input_tokens": agent.input_tokens,
+        "output_tokens": agent.output_tokens,
+        "invalid_actions": agent.invalid_actions,
+    }
 
 
-def run_with_agent(agent: AgentInterface):
-    env = FrotzEnv("z-machine-games-master/jericho-game-suite/zork1.z5")
+async def run_with_agent_async(
+    agent: AsyncAgentInterface,
+    valid_action_cache: ValidActionCache | None = None,
+    rom_path: str = ZORK1_ROM,
+    seed: int | None = None,
+    max_moves: int | None = None,
+    checkpoint_path: str | None = None,
+    checkpoint_every: int = 5,
+    resume: bool = False,
+    trajectory: TrajectoryWriter | None = None,
+) -> dict:
+    """
+    Same game loop as run_with_agent, but awaits the agent and pushes emulator work onto worker
+    threads so that many games can share one event loop while they wait on the API.
+    """
+    env = await asyncio.to_thread(FrotzEnv, rom_path, seed)
+    if valid_action_cache is None:
+        valid_action_cache = ValidActionCache()
 
     done = False
-    observation, info = env.reset()
-    observation = clean_initial_observation(observation)
+    observation, info = await asyncio.to_thread(env.reset)
+    observation = clean_intro(env.story_file.decode(), observation)
+    agent.attach_env(env)
     move_number = 0
     reward = 0
     score = 0
     chosen_action = "start"
+    # Whether the agent has been shown the move after move_number, which a checkpoint written by
+    # an interrupt in the middle of that move records.
+    agent_shown = False
+    trajectory_episode = None
+    if resume and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        game = await asyncio.to_thread(load_checkpoint, checkpoint_path, env, agent)
+        move_number, observation, reward, score, done, info, chosen_action, agent_shown = (
+            game[name] for name in GAME_STATE
+        )
+        trajectory_episode = game["trajectory_episode"]
+        console.summary(f"Resumed from {checkpoint_path} after move {move_number}", "yellow")
+    if trajectory is not None:
+        name = game_name(env.story_file.decode())
+        if trajectory_episode is None:
+            trajectory_episode = trajectory.begin_episode(name)
+            if move_number == 0:
+                trajectory.add_move(
+                    trajectory_episode, 0, chosen_action, observation, reward, score
+                )
+        else:
+            # Moves recorded after the checkpoint are replayed, so drop their rows.
+            trajectory.resume_episode(trajectory_episode, move_number, name)
 
-    while not done:
-        move_number += 1
-        valid_actions = env.get_valid_actions(use_parallel=False)
-        cprint(f"Move {move_number}:", "yellow")
-        cprint(f"Reward and Score: {reward} {info['score']}", "yellow")
-        cprint(f"Observation: {observation}", "green")
-        cprint(f"Valid Actions: {valid_actions}", "blue")
-        agent.show_state(chosen_action, observation, reward, score, valid_actions)
-        chosen_action = agent.choose_next_action()
-        cprint(f"Agent chose: {chosen_action}", "cyan")
-        observation, reward, done, info = env.step(chosen_action)
-        score = info["score"]
-
-    cprint(f"Final Observation: {observation}", "green")
-    cprint(f"Final Reward and Score: {reward} {score}", "magenta")
-    print("Game Over! Scored", score, "out of", env.get_max_score())
-
-
-def run(agent_type: str):
-    load_dotenv()
+    completed_moves = saved_moves = move_number
+
+    async def save_game():
+        nonlocal saved_moves
+        with tracer.span("checkpoint"):
+            await asyncio.to_thread(
+                save_checkpoint,
+                checkpoint_path,
+                env,
+                agent,
+                move_number=completed_moves,
+                observation=observation,
+                reward=reward,
+                score=score,
+                done=done,
+                info=info,
+                chosen_action=chosen_action,
+                agent_shown=agent_shown,
+                trajectory_episode=trajectory_episode,
+            )
+        saved_moves = completed_moves
+
+    try:
+        while not done and (max_moves is None or move_number < max_moves):
+            move_number += 1
+            input_tokens, output_tokens = agent.input_tokens, agent.output_tokens
+            with tracer.span("move", move=move_number):
+                with tracer.span("valid_actions"):
+                    valid_actions = await asyncio.to_thread(
+                        valid_action_cache.get_valid_actions, env
+                    )
+                console.move(f"Move {move_number}:", "yellow")
+                console.move(f"Reward and Score: {reward} {info['score']}", "yellow")
+                console.move(f"Observation: {observation}", "green")
+                console.move(f"Valid Actions: {valid_actions}", "blue")
+                if not agent_shown:
+                    with tracer.span("agent.show_state"):
+                        agent.show_state(chosen_action, observation, reward, score, valid_actions)
+                    agent_shown = True
+                with tracer.span("agent.choose_next_action"):
+                    start = time.perf_counter()
+                    chosen_action = await agent.choose_next_action()
+                    latency = time.perf_counter() - start
+                console.move(f"Agent chose: {chosen_action}", "cyan")
+                with tracer.span("env.step"):
+                    observation, reward, done, info = await asyncio.to_thread(
+                        env.step, chosen_action
+                    )
+                score = info["score"]
+                agent_shown = False
+                completed_moves = move_number
+                if trajectory is not None:
+                    trajectory.add_move(
+                        trajectory_episode,
+                        move_number,
+                        chosen_action,
+                        observation,
+                        reward,
+                        score,
+                        agent.input_tokens - input_tokens,
+                        agent.output_tokens - output_tokens,
+                        latency,
+                    )
+                if checkpoint_path is not None and (done or move_number % checkpoint_every == 0):
+                    await save_game()
+                console.event(
+                    "move",
+                    move=move_number,
+                    action=chosen_action,
+                    reward=reward,
+                    score=score,
+                    done=done,
+                    observation=observation,
+                )
+    finally:
+        # Stopping at max_moves or on an interrupt or error saves the moves since the last
+        # checkpoint. A move cut short hasn't reached the emulator, so it restarts from the choice.
+        if checkpoint_path is not None and (saved_moves != completed_moves or agent_shown):
+            await save_game()
+
+    if trajectory is not None:
+        trajectory.flush()
+    console.summary(f"Final Observation: {observation}", "green")
+    console.summary(f"Final Reward and Score: {reward} {score}", "magenta")
+    console.summary(f"Game Over! Scored {score} out of {env.get_max_score()}")
+    console.summary(f"Invalid actions: {agent.invalid_actions} in {move_number} moves", "yellow")
+    if agent.cascade is not None:
+        console.summary(agent.cascade.summary(), "yellow")
+
+    return {
+        "score": score,
+        "max_score": env.get_max_score(),
+        "moves": move_number,
+        "input_tokens": agent.input_tokens,
+        "output_tokens": agent.output_tokens,
+        "invalid_actions": agent.invalid_actions,
+    }
+
+
+def make_agent(agent_type: str, cascade=None, **llm_agent_kwargs) -> AgentInterface:
+    """
+    :param cascade: Model tiers for agents that call a model, as accepted by
+        ModelCascade.from_spec. Each agent gets its own cascade.
+    :param llm_agent_kwargs: Passed to agents that call a model, e.g. history_path or shared
+        anthropic clients.
+    """
+    if agent_type.startswith("memo-"):
+        return MemoAgent(
+            make_agent(agent_type.removeprefix("memo-"), cascade=cascade, **llm_agent_kwargs)
+        )
+    agent_class = load_agent_class(agent_type)
+    if agent_type in OFFLINE_AGENTS:
+        return agent_class()
+
+    if cascade is not None:
+        from utils.gpt import ModelCascade
+
+        llm_agent_kwargs["cascade"] = ModelCascade.from_spec(cascade)
+    if agent_type == "search":
+        return agent_class(fallback=load_agent_class("thinking")(**llm_agent_kwargs))
+    return agent_class(**llm_agent_kwargs)
+
+
+def make_model_services(llm_cache_path: str | None, replay_only: bool, rate_limits: dict | None):
+    """
+    Builds the response cache and rate limiter if they are wanted. Their modules import the
+    anthropic SDK, so they are only imported here.
+    """
+    response_cache = None
+    if llm_cache_path is not None:
+        from utils.llm_cache import ResponseCache
+
+        response_cache = ResponseCache(llm_cache_path, replay_only=replay_only)
+    rate_limiter = None
+    if rate_limits is not None:
+        from utils.rate_limit import RateLimiter
+
+        rate_limiter = RateLimiter(**rate_limits)
+    return response_cache, rate_limiter
+
+
+def run_episode(
+    agent_type: str,
+    episode: int,
+    seed: int,
+    max_moves: int | None,
+    rom_path: str,
+    valid_action_cache_path: str | None,
+    log_dir: str,
+    llm_cache_path: str | None = None,
+    replay_only: bool = False,
+    trace: str | None = None,
+    verbosity: str = "full",
+    log_async: bool = False,
+    cascade=None,
+    rate_limits: dict | None = None,
+    checkpoint: str | None = None,
+    checkpoint_every: int = 5,
+    resume: bool = False,
+    compact_history: bool = False,
+    history_jsonl: bool = False,
+    trajectory: str | None = None,
+) -> dict:
+    """
+    Plays one episode in a pool worker, on an emulator recycled from the worker's earlier
+    episodes when there is one. Console output and the agent's history.txt go to a
+    per-episode directory under log_dir so concurrent episodes don't interleave.
+    :param rate_limits: RateLimiter arguments for this worker's share of the account limits.
+    :param checkpoint: File name for the episode's checkpoint, inside its episode directory.
+    :param trajectory: Name of the episode's trajectory store, inside its episode directory.
+    """
+    episode_dir = os.path.join(log_dir, f"episode_{episode:03d}")
+    os.makedirs(episode_dir, exist_ok=True)
+    os.chdir(episode_dir)
+    random.seed(seed)
+    # Workers may be reused across episodes, so every episode starts with a clean tracer.
+    tracer.enabled = trace is not None
+    tracer.reset()
+
+    result = {"game": game_name(rom_path), "episode": episode, "seed": seed}
+    # Workers only read the shared cache. Each episode saves its own copy, which evaluate merges
+    # back once the pool is done, so concurrent saves can't clobber each other.
+    valid_action_cache = ValidActionCache(
+        path=valid_action_cache_path, save_path=EPISODE_VALID_ACTIONS
+    )
+    response_cache, rate_limiter = make_model_services(llm_cache_path, replay_only, rate_limits)
+    if trajectory is not None and not resume:
+        # A rerun into the same log_dir replaces the episode, it doesn't add another one.
+        shutil.rmtree(trajectory, ignore_errors=True)
+    trajectory_writer = TrajectoryWriter(trajectory) if trajectory is not None else None
+    agent = None
+    with open("run.log", "w") as log, contextlib.redirect_stdout(log):
+        console.configure(verbosity, log_async=log_async)
+        try:
+            agent = make_agent(
+                agent_type,
+                cascade=cascade,
+                response_cache=response_cache,
+                rate_limiter=rate_limiter,
+                priority=episode,
+                compact_history=compact_history,
+                history_jsonl=history_jsonl,
+            )
+            with process_env_pool().lease(rom_path, seed) as env:
+                result.update(
+                    run_with_agent(
+                        agent,
+                        valid_action_cache,
+                        rom_path,
+                        seed=seed,
+                        max_moves=max_moves,
+                        env=env,
+                        checkpoint_path=checkpoint,
+                        checkpoint_every=checkpoint_every,
+                        resume=resume,
+                        trajectory=trajectory_writer,
+                    )
+                )
+        # Any failure is reported in the episode's result so the rest of the evaluation goes on.
+        except Exception as e:  # noqa: BLE001
+            traceback.print_exc(file=log)
+            result["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            valid_action_cache.save()
+            if agent is not None:
+                agent.close()
+            if trajectory_writer is not None:
+                trajectory_writer.close()
+            console.summary(f"Env pool: {process_env_pool().stats()}", "yellow")
+            if rate_limiter is not None:
+                console.summary(f"Rate limiter: {rate_limiter.stats()}", "yellow")
+            if trace is not None:
+                tracer.export(trace)
+                console.summary(tracer.summary())
+            console.close()
+
+    return result
+
+
+def invalid_rate(results: list[dict]) -> float:
+    """
+    Share of moves where the model's answer wasn't a valid action as written.
+    """
+    moves = sum(r["moves"] for r in results)
+    return sum(r["invalid_actions"] for r in results) / moves if moves else 0.0
+
+
+def share_rate_limits(rate_limits: dict, processes: int) -> dict:
+    """
+    Splits account-wide limits evenly between processes that each run their own limiter.
+    """
+    share = dict(rate_limits)
+    for key in ("requests_per_minute", "tokens_per_minute"):
+        if share.get(key) is not None:
+            share[key] /= processes
+    share["max_in_flight"] = max(1, share["max_in_flight"] // processes)
+    return share
+
+
+def print_results_table(results: list[dict]):
+    header = (
+        f"{'episode':>7} {'seed':>6} {'score':>5} {'moves':>6} {'in tok':>9} {'out tok':>8} "
+        f"{'invalid':>8}  status"
+    )
+    console.summary(header, "magenta")
+    for result in sorted(results, key=lambda r: r["episode"]):
+        status = result.get("error", "ok")
+        if "score" in result:
+            console.summary(
+                f"{result['episode']:>7} {result['seed']:>6} {result['score']:>5} "
+                f"{result['moves']:>6} {result['input_tokens']:>9} {result['output_tokens']:>8} "
+                f"{invalid_rate([result]):>8.1%}  {status}",
+                "red" if "error" in result else None,
+            )
+        else:
+            console.summary(
+                f"{result['episode']:>7} {result['seed']:>6} {'-':>5} {'-':>6} {'-':>9} "
+                f"{'-':>8} {'-':>8}  {status}",
+                "red",
+            )
 
+    finished = [r for r in results if "score" in r]
+    if finished:
+        n = len(finished)
+        console.summary(
+            f"{'mean':>7} {'':>6} {sum(r['score'] for r in finished) / n:>5.1f} "
+            f"{sum(r['moves'] for r in finished) / n:>6.1f} "
+            f"{sum(r['input_tokens'] for r in finished) / n:>9.0f} "
+            f"{sum(r['output_tokens'] for r in finished) / n:>8.0f} "
+            f"{invalid_rate(finished):>8.1%}  {n}/{len(results)} episodes finished",
+            "magenta",
+        )
+
+
+def merge_valid_action_caches(cache_path: str, log_dir: str, episodes: int):
+    """
+    Folds the caches saved by a game's episodes into its shared cache file.
+    """
+    valid_action_cache = ValidActionCache(path=cache_path)
+    for episode in range(episodes):
+        valid_action_cache.load(
+            os.path.join(log_dir, f"episode_{episode:03d}", EPISODE_VALID_ACTIONS)
+        )
+    valid_action_cache.save()
+
+
+def print_suite_table(results: list[dict]):
+    """
+    One line per game: how many episodes finished, and their mean and best scores.
+    """
+    console.summary(
+        f"{'game':<16} {'done':>7} {'mean':>6} {'best':>5} {'max':>5} {'moves':>6} {'invalid':>8}",
+        "magenta",
+    )
+    for game in sorted({r["game"] for r in results}):
+        episodes = [r for r in results if r["game"] == game]
+        finished = [r for r in episodes if "score" in r]
+        if not finished:
+            console.summary(f"{game:<16} {0:>3}/{len(episodes):<3}", "red")
+            continue
+        n = len(finished)
+        console.summary(
+            f"{game:<16} {n:>3}/{len(episodes):<3} "
+            f"{sum(r['score'] for r in finished) / n:>6.1f} "
+            f"{max(r['score'] for r in finished):>5} {finished[0]['max_score']:>5} "
+            f"{sum(r['moves'] for r in finished) / n:>6.1f} {invalid_rate(finished):>8.1%}",
+            None if n == len(episodes) else "red",
+        )
+
+
+# Jobs this pool worker has started, shared with the parent to pin a crash on the jobs in flight.
+_started_jobs = None
+
+
+def init_pool_worker(rom_paths: list[str], started):
+    global _started_jobs
+    _started_jobs = started
+    init_env_pool(rom_paths)
+
+
+def run_pool_job(job, run, args):
+    _started_jobs.put(job)
+    return run(*args)
+
+
+def run_in_pools(run, jobs: dict, workers: int | None, rom_paths: list[str], max_crashes: int = 2):
+    """
+    Calls run(*args) for every job's args in worker processes, yielding (job, result) as each
+    finishes. A worker that dies (a segfault in the emulator, the OOM killer) breaks its pool
+    and fails every job still in it. Jobs that hadn't started go to a fresh pool, and the ones
+    that had are retried in a pool of their own each, so a further crash is known to be theirs.
+    A job yields its exception instead of a result if it raises, or once it has crashed its own
+    pool max_crashes times.
+    """
+    shared = list(jobs)
+    isolated = []
+    crashes = dict.fromkeys(jobs, 0)
+    while shared or isolated:
+        started = multiprocessing.SimpleQueue()
+        groups = [(shared, workers)] if shared else []
+        groups += [([job], 1) for job in isolated]
+        pools = []
+        futures = {}
+        for group, max_workers in groups:
+            pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=init_pool_worker,
+                initargs=(rom_paths, started),
+            )
+            pools.append(pool)
+            for job in group:
+                futures[pool.submit(run_pool_job, job, run, jobs[job])] = job
+
+        broken = {}
+        try:
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    broken[job] = e
+                    continue
+                # Results travel back pickled, so anything else failing here is one job's problem.
+                except Exception as e:  # noqa: BLE001
+                    result = e
+                yield job, result
+        finally:
+            for pool in pools:
+                pool.shutdown()
+
+        started_jobs = set()
+        while not started.empty():
+            started_jobs.add(started.get())
+        started.close()
+        # A crash in a job's own pool is that job's. One in the shared pool is only known to be
+        # among the jobs that had started, so those move to pools of their own and the rest go
+        # back to a shared one. If none had started, the pool died starting up and all are blamed.
+        from_shared = [job for job in broken if job not in isolated]
+        unstarted = [job for job in from_shared if job not in started_jobs]
+        blamed = [job for job in broken if job in isolated]
+        if unstarted and len(unstarted) == len(from_shared):
+            blamed += unstarted
+        for job in blamed:
+            crashes[job] += 1
+            if crashes[job] >= max_crashes:
+                yield job, broken[job]
+        retry = [job for job in broken if crashes[job] < max_crashes]
+        shared = [job for job in retry if job in unstarted]
+        isolated = [job for job in retry if job not in unstarted]
+
+
+def evaluate(
+    agent_type: str,
+    episodes: int,
+    workers: int | None = None,
+    seed: int = 0,
+    max_moves: int | None = None,
+    valid_action_cache_dir: str | None = None,
+    log_dir: str = "eval_logs",
+    llm_cache: str | None = None,
+    replay_only: bool = False,
+    trace: str | None = None,
+    verbosity: str = "full",
+    log_async: bool = False,
+    cascade=None,
+    rate_limits: dict | None = None,
+    checkpoint: str | None = None,
+    checkpoint_every: int = 5,
+    resume: bool = False,
+    compact_history: bool = False,
+    history_jsonl: bool = False,
+    trajectory: str | None = None,
+    roms: list[str] | None = None,
+) -> list[dict]:
+    """
+    :param roms: Games to play, `episodes` times each. Defaults to Zork I. With several games,
+        each gets its own directory under log_dir. Jobs are queued game by game, and every
+        worker preloads all the ROMs and recycles its emulator between episodes.
+    :param rate_limits: RateLimiter arguments for the account as a whole. Each worker process
+        gets an equal share.
+    :param trace: File name for each episode's trace, written inside its episode directory.
+    :param checkpoint: File name for each episode's checkpoint, written inside its episode
+        directory. With resume, episodes pick up from theirs and finished ones are replayed
+        from the final checkpoint without further moves.
+    :param trajectory: Each episode writes a trajectory store of this path's name inside its
+        episode directory. Once all have finished they are merged, in game and episode order,
+        into this path. Every row records its game. With resume the merged store is rebuilt
+        rather than appended to.
+    :param verbosity: Console verbosity inside each episode's run.log. Log mode writes its
+        events there too.
+    """
     if agent_type == "human":
-        agent = HumanAgent()
-    elif agent_type == "random":
-        agent = RandomAgent()
-    elif agent_type == "raw-history":
-        agent = RawHistoryAgent()
-    elif agent_type == "thinking":
-        agent = ThinkingAgent()
-    elif agent_type == "mentalmap":
-        agent = MentalMapAgent()
-    elif agent_type == "agentb":
-        agent = MentalMapAgentB()
+        raise ValueError("The human agent can't be evaluated in worker processes")
+
+    # Workers chdir into their episode directory, so every path they get must be absolute.
+    rom_paths = [os.path.abspath(rom_path) for rom_path in roms or [ZORK1_ROM]]
+    log_dir = os.path.abspath(log_dir)
+    game_log_dirs = {
+        rom_path: os.path.join(log_dir, game_name(rom_path)) if len(rom_paths) > 1 else log_dir
+        for rom_path in rom_paths
+    }
+    cache_paths = dict.fromkeys(rom_paths)
+    if valid_action_cache_dir is not None:
+        cache_paths = {
+            rom_path: os.path.abspath(cache_path_for_rom(valid_action_cache_dir, rom_path))
+            for rom_path in rom_paths
+        }
+    llm_cache_path = os.path.abspath(llm_cache) if llm_cache is not None else None
+    jobs = [(rom_path, episode) for rom_path in rom_paths for episode in range(episodes)]
+    if rate_limits is not None:
+        rate_limits = share_rate_limits(rate_limits, min(len(jobs), workers or os.cpu_count()))
+
+    # Episodes write their own stores, since writers can't share one across processes.
+    episode_trajectory = None
+    if trajectory is not None:
+        episode_trajectory = os.path.basename(os.path.normpath(trajectory))
+
+    episode_args = {
+        (rom_path, episode): (
+            agent_type,
+            episode,
+            seed + episode,
+            max_moves,
+            rom_path,
+            cache_paths[rom_path],
+            game_log_dirs[rom_path],
+            llm_cache_path,
+            replay_only,
+            trace,
+            verbosity,
+            log_async,
+            cascade,
+            rate_limits,
+            checkpoint,
+            checkpoint_every,
+            resume,
+            compact_history,
+            history_jsonl,
+            episode_trajectory,
+        )
+        for rom_path, episode in jobs
+    }
+    results = []
+    for (rom_path, episode), result in run_in_pools(run_episode, episode_args, workers, rom_paths):
+        if isinstance(result, BaseException):
+            error = (
+                "worker crashed"
+                if isinstance(result, BrokenProcessPool)
+                else f"{type(result).__name__}: {result}"
+            )
+            result = {
+                "game": game_name(rom_path),
+                "episode": episode,
+                "seed": seed + episode,
+                "error": error,
+            }
+        results.append(result)
+        console.summary(
+            f"{result['game']} episode {episode} finished: {result.get('error', 'ok')}",
+            "yellow",
+        )
+
+    results.sort(key=lambda r: (r["game"], r["episode"]))
+    for rom_path, cache_path in cache_paths.items():
+        if cache_path is not None:
+            merge_valid_action_caches(cache_path, game_log_dirs[rom_path], episodes)
+    if trajectory is not None:
+        if resume:
+            # The merged store already holds the episodes of the run being resumed.
+            shutil.rmtree(trajectory, ignore_errors=True)
+        game_log_dirs = {game_name(rom_path): path for rom_path, path in game_log_dirs.items()}
+        merge(
+            trajectory,
+            *(
+                os.path.join(
+                    game_log_dirs[r["game"]], f"episode_{r['episode']:03d}", episode_trajectory
+                )
+                for r in results
+                if "score" in r
+            ),
+        )
+    if len(rom_paths) > 1:
+        print_suite_table(results)
     else:
-        raise ValueError("Invalid agent type")
+        print_results_table(results)
+    return results
+
+
+async def evaluate_async(
+    agent_type: str,
+    episodes: int,
+    seed: int = 0,
+    max_moves: int | None = None,
+    valid_action_cache_dir: str | None = None,
+    log_dir: str = "eval_logs",
+    llm_cache: str | None = None,
+    replay_only: bool = False,
+    trace: str | None = None,
+    cascade=None,
+    rate_limits: dict | None = None,
+    checkpoint: str | None = None,
+    checkpoint_every: int = 5,
+    resume: bool = False,
+    compact_history: bool = False,
+    history_jsonl: bool = False,
+    trajectory: str | None = None,
+) -> list[dict]:
+    """
+    Plays all episodes concurrently on one event loop. Every agent shares the same pooled
+    anthropic clients, so a single process can keep dozens of requests in flight.
+    :param rate_limits: RateLimiter arguments. One limiter schedules every game's calls, and
+        lower-numbered episodes go first.
+    :param trajectory: Trajectory store shared by every game.
+    """
+    if agent_type == "human":
+        raise ValueError("The human agent can't be evaluated concurrently")
+
+    cache_path = None
+    if valid_action_cache_dir is not None:
+        cache_path = cache_path_for_rom(valid_action_cache_dir, ZORK1_ROM)
+    # Games run on different threads but share the event loop, so one cache serves them all.
+    valid_action_cache = ValidActionCache(path=cache_path)
+    import anthropic
+
+    anthropic_client = anthropic.Anthropic()
+    async_anthropic_client = anthropic.AsyncAnthropic()
+    response_cache, rate_limiter = make_model_services(llm_cache, replay_only, rate_limits)
+    trajectory_writer = TrajectoryWriter(trajectory) if trajectory is not None else None
+
+    async def play(episode: int) -> dict:
+        episode_dir = os.path.join(log_dir, f"episode_{episode:03d}")
+        os.makedirs(episode_dir, exist_ok=True)
+        result = {"episode": episode, "seed": seed + episode}
+        agent = None
+        try:
+            agent = make_agent(
+                agent_type,
+                cascade=cascade,
+                history_path=os.path.join(episode_dir, "history.txt"),
+                anthropic_client=anthropic_client,
+                async_anthropic_client=async_anthropic_client,
+                response_cache=response_cache,
+                rate_limiter=rate_limiter,
+                priority=episode,
+                compact_history=compact_history,
+                history_jsonl=history_jsonl,
+            )
+            result.update(
+                await run_with_agent_async(
+                    AsyncAgent(agent),
+                    valid_action_cache,
+                    seed=seed + episode,
+                    max_moves=max_moves,
+                    checkpoint_path=(
+                        os.path.join(episode_dir, checkpoint) if checkpoint is not None else None
+                    ),
+                    checkpoint_every=checkpoint_every,
+                    resume=resume,
+                    trajectory=trajectory_writer,
+                )
+            )
+        # As in run_episode, one failed game mustn't cancel the others in the gather.
+        except Exception as e:  # noqa: BLE001
+            result["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            if agent is not None:
+                agent.close()
+        console.summary(f"Episode {episode} finished: {result.get('error', 'ok')}", "yellow")
+        return result
+
+    try:
+        results = await asyncio.gather(*(play(episode) for episode in range(episodes)))
+    finally:
+        valid_action_cache.save()
+        if trajectory_writer is not None:
+            trajectory_writer.close()
+        await async_anthropic_client.close()
+        if rate_limiter is not None:
+            console.summary(f"Rate limiter: {rate_limiter.stats()}", "yellow")
+        if trace is not None:
+            export_trace(trace)
+
+    print_results_table(results)
+    return results
+
+
+def export_trace(path: str):
+    tracer.export(path)
+    console.summary(tracer.summary(), "yellow")
+    console.summary(f"Trace written to {path}", "yellow")
+
+
+def run(
+    agent_type: str,
+    valid_action_cache_dir: str | None = None,
+    episodes: int = 1,
+    workers: int | None = None,
+    seed: int | None = None,
+    max_moves: int | None = None,
+    use_async: bool = False,
+    llm_cache: str | None = None,
+    replay_only: bool = False,
+    trace: str | None = None,
+    verbosity: str = "full",
+    log_path: str | None = None,
+    log_async: bool = False,
+    cascade=None,
+    requests_per_minute: float | None = None,
+    tokens_per_minute: float | None = None,
+    max_in_flight: int = 8,
+    checkpoint: str | None = None,
+    checkpoint_every: int = 5,
+    resume: bool = False,
+    compact_history: bool = False,
+    history_jsonl: bool = False,
+    speculate: int = 0,
+    trajectory: str | None = None,
+    roms: str | list[str] | None = None,
+):
+    """
+    :param llm_cache: SQLite file used to record model responses and replay them on reruns.
+    :param replay_only: Fail on any request that isn't already in llm_cache.
+    :param trace: Record per-move spans and counters and write them to this file, as a Chrome
+        trace or as JSONL if it ends in .jsonl. A latency summary is printed at the end.
+    :param verbosity: "full" prints every move, "summary" only end-of-run results, "log" writes
+        structured JSONL events (to log_path, or stdout) instead of per-move text, and "silent"
+        prints nothing.
+    :param log_async: Write log events from a background thread.
+    :param cascade: Ask a fast model first and escalate to a stronger one on an invalid action,
+        a loop, a long run without reward or low confidence. Pass alone for haiku then sonnet,
+        or as a comma-separated list of models from fastest to strongest.
+    :param requests_per_minute: Account request limit. Setting this or tokens_per_minute puts
+        every model call behind a shared scheduler that queues, retries and backs off on 429
+        and overloaded errors.
+    :param tokens_per_minute: Account token limit, input and output combined.
+    :param max_in_flight: Most model calls the scheduler lets run at once.
+    :param checkpoint: Save the game, the agent's memory and its token counts to this file every
+        checkpoint_every moves, so a long run can be stopped and picked up again. With several
+        episodes, a file of this name is written inside each episode's directory.
+    :param resume: Carry on from the checkpoint instead of starting over, if it exists.
+    :param compact_history: Shorten prompts by writing "(same as before)" for an observation or
+        list of valid actions that repeats the previous move's. history.txt stays in full.
+    :param history_jsonl: Write history.txt as one JSON record per entry instead of the
+        plain-text transcript.
+    :param speculate: While the model is thinking, step this many of the likeliest actions in
+        background emulators, so the chosen one is usually ready without waiting on the
+        emulator. Single synchronous games only.
+    :param trajectory: Append a row per move (action, observation, reward, score, tokens and
+        latency) to this columnar store, for analysis with utils.trajectory.TrajectoryStore.
+    :param roms: Sweep the agent over these games instead of Zork I, `episodes` times each, in
+        worker processes. ROM paths, comma separated, or a directory to play every ROM in it.
+    """
+    if resume and checkpoint is None:
+        raise ValueError("--resume needs --checkpoint")
+    if speculate and (episodes > 1 or use_async or roms is not None):
+        raise ValueError("--speculate only applies to a single synchronous game")
+    if roms is not None and use_async:
+        raise ValueError("--roms runs games in worker processes, not with --use_async")
+    load_dotenv()
+    rate_limits = None
+    if requests_per_minute is not None or tokens_per_minute is not None:
+        rate_limits = {
+            "requests_per_minute": requests_per_minute,
+            "tokens_per_minute": tokens_per_minute,
+            "max_in_flight": max_in_flight,
+        }
+    if trace is not None:
+        tracer.enabled = True
+        tracer.reset()
+
+    if (episodes > 1 or roms is not None) and not use_async:
+        # Workers configure their own console. The parent only prints the results table, and
+        # must not hold a log file or writer thread when the pool forks.
+        console.configure("silent" if verbosity == "silent" else "summary")
+        evaluate(
+            agent_type,
+            episodes,
+            workers=workers,
+            seed=seed or 0,
+            max_moves=max_moves,
+            valid_action_cache_dir=valid_action_cache_dir,
+            llm_cache=llm_cache,
+            replay_only=replay_only,
+            trace=trace,
+            verbosity=verbosity,
+            log_async=log_async,
+            cascade=cascade,
+            rate_limits=rate_limits,
+            checkpoint=checkpoint,
+            checkpoint_every=checkpoint_every,
+            resume=resume,
+            compact_history=compact_history,
+            history_jsonl=history_jsonl,
+            trajectory=trajectory,
+            roms=find_roms(roms) if roms is not None else None,
+        )
+        return
+
+    console.configure(verbosity, log_path=log_path, log_async=log_async)
+    if use_async:
+        asyncio.run(
+            evaluate_async(
+                agent_type,
+                episodes,
+                seed=seed or 0,
+                max_moves=max_moves,
+                valid_action_cache_dir=valid_action_cache_dir,
+                llm_cache=llm_cache,
+                replay_only=replay_only,
+                trace=trace,
+                cascade=cascade,
+                rate_limits=rate_limits,
+                checkpoint=checkpoint,
+                checkpoint_every=checkpoint_every,
+                resume=resume,
+                compact_history=compact_history,
+                history_jsonl=history_jsonl,
+                trajectory=trajectory,
+            )
+        )
+        console.close()
+        return
+
+    response_cache, rate_limiter = make_model_services(llm_cache, replay_only, rate_limits)
+    agent = make_agent(
+        agent_type,
+        cascade=cascade,
+        response_cache=response_cache,
+        rate_limiter=rate_limiter,
+        compact_history=compact_history,
+        history_jsonl=history_jsonl,
+    )
+
+    cache_path = None
+    if valid_action_cache_dir is not None:
+        cache_path = cache_path_for_rom(valid_action_cache_dir, ZORK1_ROM)
+    valid_action_cache = ValidActionCache(path=cache_path)
+    speculator = None
+    if speculate:
+        from utils.speculation import Speculator
+
+        speculator = Speculator(ZORK1_ROM, width=speculate)
+    trajectory_writer = TrajectoryWriter(trajectory) if trajectory is not None else None
 
     try:
-        run_with_agent(agent)
+        run_with_agent(
+            agent,
+            valid_action_cache,
+            seed=seed,
+            max_moves=max_moves,
+            checkpoint_path=checkpoint,
+            checkpoint_every=checkpoint_every,
+            resume=resume,
+            speculator=speculator,
+            trajectory=trajectory_writer,
+        )
     except KeyboardInterrupt:
-        print("\n\nGame interrupted. Exiting...")
+        # stderr, so an interrupted log mode run still leaves only JSONL on stdout.
+        print("\n\nGame interrupted. Exiting...", file=sys.stderr)
+        if checkpoint is not None:
+            print(f"Rerun with --resume to carry on from {checkpoint}", file=sys.stderr)
+    finally:
+        valid_action_cache.save()
+        agent.close()
+        if speculator is not None:
+            speculator.close()
+        if trajectory_writer is not None:
+            trajectory_writer.close()
+        if response_cache is not None:
+            console.summary(f"LLM response cache: {response_cache.stats()}", "yellow")
+        if rate_limiter is not None:
+            console.summary(f"Rate limiter: {rate_limiter.stats()}", "yellow")
+        if trace is not None:
+            export_trace(trace)
+        console.close()
 
 
 if __name__ == "__main__":
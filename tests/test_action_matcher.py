@@ -0,0 +1,46 @@
+import pytest
+
+from utils.action_matcher import ActionMatcher, normalize
+
+VALID_ACTIONS = ["open mailbox", "north", "take leaflet", "take lamp", "put lamp in case"]
+
+
+@pytest.mark.parametrize(
+    ("answer", "expected"),
+    [
+        ("open mailbox", "open mailbox"),
+        ("  north\n", "north"),
+        ("Open Mailbox.", "open mailbox"),
+        ("**Action:** `open mailbox`", "open mailbox"),
+        ("> north", "north"),
+        ("1. take lamp", "take lamp"),
+        ("NEXT BEST ACTION: take leaflet", "take leaflet"),
+        ("put the lamp in case", "put lamp in case"),
+    ],
+)
+def test_match(answer, expected):
+    assert ActionMatcher(VALID_ACTIONS).match(answer) == expected
+
+
+@pytest.mark.parametrize("answer", ["", "dance", "take", "xyzzy north south east west up"])
+def test_no_match(answer):
+    # "take" overlaps "take leaflet" and "take lamp" equally, so it is ambiguous.
+    assert ActionMatcher(VALID_ACTIONS).match(answer) is None
+
+
+def test_min_overlap():
+    answer = "please open the old mailbox now"
+    assert ActionMatcher(VALID_ACTIONS).match(answer) is None
+    assert ActionMatcher(VALID_ACTIONS, min_overlap=0.3).match(answer) == "open mailbox"
+
+
+def test_match_completion_prefers_the_last_line():
+    matcher = ActionMatcher(VALID_ACTIONS)
+    assert matcher.match_completion("I think north is risky.\ntake lamp") == "take lamp"
+    assert matcher.match_completion("take lamp\nThat should help in the dark.") == "take lamp"
+    assert matcher.match_completion("\n\n") is None
+
+
+def test_normalize():
+    assert normalize("  Action: `Open  Mailbox`! ") == "open mailbox"
+    assert normalize("2) take (the) lamp") == "take the lamp"
@@ -0,0 +1,50 @@
+import asyncio
+
+from utils.gpt import ModelCascade, strip_confidence
+
+MODELS = ["fast", "strong"]
+
+
+def judge(answer: str) -> tuple[bool, int | None]:
+    return answer != "invalid", None
+
+
+def test_run_escalates_invalid_answers():
+    cascade = ModelCascade(MODELS)
+    answers = {"fast": "invalid", "strong": "north"}
+    discarded = []
+    answer = cascade.run(answers.get, judge, lambda *args: discarded.append(args))
+    assert answer == "north"
+    assert discarded == [("invalid", "strong")]
+    assert cascade.calls == [1, 1]
+    assert cascade.escalations == {"invalid_action": 1}
+
+
+def test_run_async_escalates_low_confidence():
+    cascade = ModelCascade(MODELS, min_confidence=5)
+
+    async def call(model: str) -> str:
+        return f"{model}\nCONFIDENCE: {2 if model == 'fast' else 9}"
+
+    answer = asyncio.run(cascade.run_async(call, lambda a: (True, int(a[-1]))))
+    assert answer.startswith("strong")
+    assert cascade.escalations == {"low_confidence": 1}
+
+
+def test_state_survives_a_restore():
+    cascade = ModelCascade(MODELS, stall_moves=2, loop_window=4)
+    for _ in range(3):
+        cascade.observe("West of House", 0, ["north"])
+    cascade.run(lambda model: "invalid", judge)
+
+    restored = ModelCascade(MODELS, stall_moves=2, loop_window=4)
+    restored.restore_state(cascade.get_state())
+    assert restored.stats() == cascade.stats()
+    assert restored.first_tier() == 1
+    restored.observe("West of House", 0, ["north"])
+    assert restored.visits == 4
+
+
+def test_strip_confidence():
+    assert strip_confidence("CONFIDENCE: 7\nopen mailbox") == "open mailbox"
+    assert strip_confidence("open mailbox") == "open mailbox"
@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+from run_game import run_with_agent
+from text_agent.base import RandomAgent
+from utils.checkpoint import load_checkpoint
+
+ACTIONS = ["east", "west", "wait"]
+
+
+class CorridorEnv:
+    story_file = b"corridor.z5"
+
+    def __init__(self):
+        self.position = 0
+        self.moves = 0
+
+    def reset(self):
+        self.position = self.moves = 0
+        return "Corridor 0", {"score": 0, "moves": 0}
+
+    def step(self, action: str):
+        self.moves += 1
+        self.position += {"east": 1, "west": -1}.get(action, 0)
+        return f"Corridor {self.position}", 0, False, {"score": 0, "moves": self.moves}
+
+    def get_world_state_hash(self) -> str:
+        return str(self.position)
+
+    def get_valid_actions(self, use_parallel: bool = False) -> list[str]:
+        return list(ACTIONS)
+
+    def get_max_score(self) -> int:
+        return 0
+
+    def get_state(self):
+        return self.position, self.moves
+
+    def set_state(self, state):
+        self.position, self.moves = state
+
+
+class RecordingAgent(RandomAgent):
+    def __init__(self, interrupt_at: int | None = None):
+        super().__init__()
+        self.interrupt_at = interrupt_at
+        self.chosen = []
+
+    def choose_next_action(self) -> str:
+        if len(self.chosen) + 1 == self.interrupt_at:
+            raise KeyboardInterrupt
+        self.chosen.append(super().choose_next_action())
+        return self.chosen[-1]
+
+
+def play(agent, checkpoint_path: str, max_moves: int, resume: bool = False) -> CorridorEnv:
+    env = CorridorEnv()
+    run_with_agent(
+        agent,
+        max_moves=max_moves,
+        env=env,
+        checkpoint_path=checkpoint_path,
+        checkpoint_every=5,
+        resume=resume,
+    )
+    return env
+
+
+def test_stopping_at_max_moves_saves_the_last_move(tmp_path):
+    checkpoint_path = str(tmp_path / "game.ckpt")
+    play(RecordingAgent(), checkpoint_path, max_moves=7)
+    game = load_checkpoint(checkpoint_path, CorridorEnv(), RecordingAgent())
+    assert game["move_number"] == 7
+
+
+def test_interrupted_move_resumes_where_it_stopped(tmp_path):
+    random.seed(1)
+    uninterrupted = play(RecordingAgent(), str(tmp_path / "a.ckpt"), max_moves=12)
+
+    checkpoint_path = str(tmp_path / "b.ckpt")
+    random.seed(1)
+    with pytest.raises(KeyboardInterrupt):
+        play(RecordingAgent(interrupt_at=8), checkpoint_path, max_moves=12)
+    game = load_checkpoint(checkpoint_path, CorridorEnv(), RecordingAgent())
+    assert (game["move_number"], game["agent_shown"]) == (7, True)
+
+    resumed = play(RecordingAgent(), checkpoint_path, max_moves=12, resume=True)
+    assert resumed.get_state() == uninterrupted.get_state()
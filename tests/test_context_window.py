@@ -0,0 +1,77 @@
+from utils.history import ContextWindow, History, estimate_tokens
+
+
+def make_window(turns: int, observation_size: int = 40, **kwargs) -> ContextWindow:
+    history = History("SYSTEM MESSAGE")
+    for turn in range(turns):
+        history.update_history(
+            f"action {turn}", f"room {turn} " + "x" * observation_size, 0, turn, ["north", "south"]
+        )
+    calls = []
+
+    def summarize(summary: str, new_turns: str) -> str:
+        calls.append(new_turns)
+        return f"{summary}|{len(calls)}"
+
+    window = ContextWindow(history, summarize, **kwargs)
+    window.calls = calls
+    return window
+
+
+def test_short_history_is_sent_verbatim():
+    window = make_window(5, keep_last_turns=8, refresh_every=10)
+    prompt = window.get_prompt()
+    assert window.calls == []
+    assert prompt == window.history.get_formatted_history_for_next_action()
+
+
+def test_older_turns_are_folded_into_the_summary():
+    window = make_window(20, keep_last_turns=4, refresh_every=10)
+    prompt = window.get_prompt()
+    assert len(window.calls) == 1
+    assert "action 15" in window.calls[0]
+    assert "action 16" not in window.calls[0]
+    assert window.summarized_turns == 16
+    assert prompt.startswith("SYSTEM MESSAGE\nSUMMARY OF EARLIER MOVES:\n|1")
+    assert "action 15" not in prompt
+    assert all(f"action {turn}" in prompt for turn in range(16, 20))
+
+    # Nothing new to fold until another refresh_every turns have piled up.
+    window.get_prompt()
+    assert len(window.calls) == 1
+
+
+def test_over_budget_drops_the_oldest_verbatim_turns():
+    window = make_window(10, observation_size=400, keep_last_turns=8, max_input_tokens=400)
+    prompt = window.get_prompt()
+    assert estimate_tokens(prompt) <= 400
+    assert prompt.startswith("SYSTEM MESSAGE\nSUMMARY OF EARLIER MOVES:")
+    assert "action 9" in prompt
+    assert "action 7" not in prompt
+
+
+def test_reserved_tokens_come_out_of_the_budget():
+    window = make_window(
+        10, observation_size=400, keep_last_turns=8, max_input_tokens=600, reserved_tokens=200
+    )
+    prompt = window.get_prompt()
+    assert estimate_tokens(prompt) <= 400
+    assert "action 9" in prompt
+    assert "action 7" not in prompt
+
+
+def test_overlong_turn_keeps_the_system_message_and_valid_actions():
+    window = make_window(3, observation_size=5000, keep_last_turns=1, max_input_tokens=300)
+    prompt = window.get_prompt()
+    assert estimate_tokens(prompt) <= 300
+    assert prompt.startswith("SYSTEM MESSAGE\nSUMMARY OF EARLIER MOVES:\n|1\n\nRECENT MOVES:\n")
+    assert "VALID NEXT ACTIONS: ['north', 'south']" in prompt
+
+
+def test_state_round_trip():
+    window = make_window(20, keep_last_turns=4, refresh_every=10)
+    window.get_prompt()
+    restored = make_window(20, keep_last_turns=4, refresh_every=10)
+    restored.restore_state(window.get_state())
+    assert restored.get_prompt() == window.get_prompt()
+    assert restored.calls == []
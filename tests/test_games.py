@@ -0,0 +1,45 @@
+from utils.games import ZORK1_INTRO, clean_intro, find_roms, game_name, strip_banner
+
+ZORK1_OPENING = f"""{ZORK1_INTRO}
+
+West of House
+You are standing in an open field west of a white house, with a boarded front door.
+There is a small mailbox here."""
+
+DETECTIVE_OPENING = """DETECTIVE
+An Interactive Mystery
+Copyright (c) 1993 by Matt Barringer.
+Release 1 / Serial number 000715 / Inform v6.21 Library 6/10
+
+Chief's office
+You are standing in the Chief's office."""
+
+
+def test_game_name():
+    assert game_name("z-machine-games-master/jericho-game-suite/zork1.z5") == "zork1"
+
+
+def test_clean_intro_zork1():
+    assert clean_intro("roms/zork1.z5", ZORK1_OPENING) == (
+        "West of House\nYou are standing in an open field west of a white house, with a "
+        "boarded front door.\nThere is a small mailbox here."
+    )
+
+
+def test_clean_intro_strips_other_banners():
+    assert clean_intro("roms/detective.z5", DETECTIVE_OPENING) == (
+        "DETECTIVE\nAn Interactive Mystery\n\n"
+        "Chief's office\nYou are standing in the Chief's office."
+    )
+
+
+def test_strip_banner_leaves_plain_observations_alone():
+    assert strip_banner("  Forest\nThis is a forest.\n") == "Forest\nThis is a forest."
+
+
+def test_find_roms(tmp_path):
+    for name in ("zork1.z5", "enchanter.z3", "notes.txt"):
+        (tmp_path / name).touch()
+    assert find_roms(str(tmp_path)) == [str(tmp_path / "enchanter.z3"), str(tmp_path / "zork1.z5")]
+    assert find_roms("a.z5,b.z8") == ["a.z5", "b.z8"]
+    assert find_roms([str(tmp_path), "extra.z5"])[-1] == "extra.z5"
@@ -0,0 +1,97 @@
+import json
+import pickle
+
+from utils.history import SAME_AS_BEFORE, History, HistoryWriter
+
+
+def play(history: History):
+    history.update_history("start", "West of House\nA mailbox.", 0, 0, ["north", "open mailbox"])
+    history.update_history_with_string("I should open the mailbox.")
+    history.update_history(
+        "open mailbox", "West of House\nA mailbox.", 0, 0, ["north", "open mailbox"]
+    )
+    history.update_history("north", "North of House", 0, 0, ["south", "west"])
+
+
+def test_compact_refers_back_to_the_previous_turn():
+    history = History("SYSTEM", compact=True)
+    play(history)
+
+    repeated = history.format_entry(2)
+    assert f"Led to this Observation: {SAME_AS_BEFORE}" in repeated
+    assert f"VALID NEXT ACTIONS: {SAME_AS_BEFORE}" in repeated
+    assert "North of House" in history.format_entry(3)
+    assert "['south', 'west']" in history.format_entry(3)
+    assert SAME_AS_BEFORE not in history.format_entry(0)
+
+
+def test_compact_turn_can_be_formatted_standalone():
+    history = History("SYSTEM", compact=True)
+    play(history)
+    # The turn starting at the repeated entry also holds nothing else.
+    assert SAME_AS_BEFORE in history.get_turn(1)
+    assert SAME_AS_BEFORE not in history.get_turn(1, standalone=True)
+    assert history.get_turn(1, standalone=True) == History.format_entry(history, 2, compact=False)
+
+
+def test_full_format_is_unaffected_by_interning():
+    compact, full = History("SYSTEM", compact=True), History("SYSTEM")
+    play(compact)
+    play(full)
+    prompt = full.get_formatted_history_for_next_action()
+    assert prompt.count("West of House\nA mailbox.") == 2
+    assert SAME_AS_BEFORE not in prompt
+    assert len(compact.get_formatted_history_for_next_action()) < len(prompt)
+    assert compact.format_entry(2, compact=False) == full.format_entry(2)
+    # Repeats share one interned observation and action list.
+    assert len(full.observations) == 2
+    assert len(full.action_lists) == 2
+
+
+def test_writer_gets_the_full_transcript(tmp_path):
+    path = tmp_path / "history.txt"
+    history = History("SYSTEM", writer=HistoryWriter(str(path)), compact=True)
+    assert not path.exists()
+    play(history)
+    history.close()
+
+    full = History("SYSTEM")
+    play(full)
+    assert path.read_text() == full.get_formatted_history_for_next_action()
+
+
+def test_jsonl_writer(tmp_path):
+    path = tmp_path / "history.jsonl"
+    history = History("SYSTEM", writer=HistoryWriter(str(path), jsonl=True))
+    play(history)
+    history.close()
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert records[0] == {"system_message": "SYSTEM"}
+    assert records[2] == {"text": "I should open the mailbox."}
+    assert records[4] == {
+        "chosen_action": "north",
+        "observation": "North of House",
+        "reward": 0,
+        "score": 0,
+        "valid_actions": ["south", "west"],
+    }
+
+
+def test_state_round_trip(tmp_path):
+    history = History("SYSTEM", writer=HistoryWriter(str(tmp_path / "before.txt")), compact=True)
+    play(history)
+    history.close()
+    state = pickle.loads(pickle.dumps(history.get_state()))
+
+    restored = History("SYSTEM", writer=HistoryWriter(str(tmp_path / "after.txt")), compact=True)
+    restored.restore_state(state)
+
+    assert restored.get_formatted_history_for_next_action() == (
+        history.get_formatted_history_for_next_action()
+    )
+    assert restored.get_turn(2) == history.get_turn(2)
+    restored.update_history("west", "Forest", 0, 0, ["east"])
+    restored.close()
+    assert restored.previous_turn(len(restored.history) - 1) is restored.history[3]
+    assert (tmp_path / "after.txt").read_text().startswith((tmp_path / "before.txt").read_text())
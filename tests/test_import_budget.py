@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Starting the harness for an agent that doesn't call a model must fit in this many ms of imports.
+BUDGET_MS = 400
+# Modules that only agents calling a model may import.
+MODEL_MODULES = ("anthropic", "instructor", "pydantic")
+
+
+def import_times(agent_type: str) -> dict[str, int]:
+    """
+    Imports run_game and makes an agent in a fresh interpreter under -X importtime. Returns the
+    microseconds spent importing each module itself.
+    """
+    code = f"import run_game; run_game.make_agent({agent_type!r})"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, _, module = line.removeprefix("import time:").split("|")
+        times[module.strip()] = int(own)
+    return times
+
+
+@pytest.mark.parametrize("agent_type", ["human", "random"])
+def test_model_free_agents_start_fast(agent_type):
+    times = import_times(agent_type)
+    assert "run_game" in times
+    assert [name for name in MODEL_MODULES if name in times] == []
+    assert sum(times.values()) / 1000 <= BUDGET_MS
@@ -0,0 +1,187 @@
+import asyncio
+import threading
+import time
+
+import anthropic
+import pytest
+from instructor.core import InstructorRetryException
+
+from utils.fake_server import FakeAnthropicServer
+from utils.gpt import GPTModelManager
+from utils.rate_limit import (
+    AsyncRateLimitedAnthropic,
+    RateLimitedAnthropic,
+    RateLimiter,
+    TokenBucket,
+)
+
+REQUEST = {
+    "model": "claude-3-haiku-20240307",
+    "max_tokens": 20,
+    "messages": [{"role": "user", "content": "VALID NEXT ACTIONS: ['north', 'south']"}],
+}
+
+
+@pytest.fixture
+def start_server():
+    servers = []
+
+    def start(requests_per_minute: float = 6000, overloaded_rate: float = 0.0):
+        server = FakeAnthropicServer(0, requests_per_minute, overloaded_rate, latency=0, seed=1)
+        threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def base_url(server: FakeAnthropicServer) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def client_for(server: FakeAnthropicServer, limiter: RateLimiter) -> RateLimitedAnthropic:
+    client = anthropic.Anthropic(base_url=base_url(server), api_key="test")
+    return RateLimitedAnthropic(client, limiter)
+
+
+def test_token_bucket_refills_continuously():
+    bucket = TokenBucket(60)
+    bucket.take(60)
+    assert bucket.wait_time(1, bucket.updated) == pytest.approx(1.0)
+    assert bucket.wait_time(1, bucket.updated + 0.5) == pytest.approx(0.5)
+    # Requests larger than the bucket only wait for a full bucket.
+    assert bucket.wait_time(600, bucket.updated + 60) == 0
+
+
+def test_retries_overloaded_errors(start_server):
+    server = start_server(overloaded_rate=0.5)
+    limiter = RateLimiter(base_delay=0.001, max_delay=0.01, max_retries=20)
+    client = client_for(server, limiter)
+    for _ in range(10):
+        response = client.messages.create(**REQUEST)
+        assert response.content[0].text.splitlines()[-1] in ("north", "south")
+    assert server.accepted == 10
+    assert server.rejected > 0
+    assert limiter.retries == server.rejected
+
+
+def test_rate_limit_error_waits_for_retry_after(start_server):
+    server = start_server(requests_per_minute=120)
+    limiter = RateLimiter(base_delay=0.001, max_delay=0.01)
+    client = client_for(server, limiter)
+    with server.lock:
+        server.bucket.level = 0
+
+    delays = []
+    retry_delay = limiter.retry_delay
+
+    def record_delay(error, attempt):
+        delays.append(retry_delay(error, attempt))
+        return delays[-1]
+
+    limiter.retry_delay = record_delay
+    start = time.monotonic()
+    client.messages.create(**REQUEST)
+    assert (server.accepted, server.rejected, limiter.retries) == (1, 1, 1)
+    # Backoff alone would be at most max_delay. The server asked for up to 0.5s.
+    assert 0.01 < delays[0] <= 0.5
+    assert limiter.paused_until > start
+
+
+def test_gives_up_after_max_retries(start_server):
+    server = start_server(overloaded_rate=1.0)
+    limiter = RateLimiter(base_delay=0.001, max_delay=0.001, max_retries=2)
+    with pytest.raises(anthropic.APIStatusError):
+        client_for(server, limiter).messages.create(**REQUEST)
+    assert server.rejected == 3
+    assert limiter.in_flight == 0
+
+
+def manager_for(server: FakeAnthropicServer, limiter: RateLimiter) -> GPTModelManager:
+    client = anthropic.Anthropic(base_url=base_url(server), api_key="test")
+    return GPTModelManager(anthropic_client=client, rate_limiter=limiter)
+
+
+def test_retries_errors_wrapped_by_instructor(start_server):
+    # instructor raises its own exception with the 529 as the cause. The fake server's plain text
+    # answers don't parse as instructor output, so only the failure path is checked end to end.
+    server = start_server(overloaded_rate=1.0)
+    limiter = RateLimiter(base_delay=0.001, max_delay=0.001, max_retries=2)
+    with pytest.raises(InstructorRetryException):
+        manager_for(server, limiter).get_response(REQUEST["messages"][0]["content"], str)
+    assert server.rejected == 3
+    assert limiter.retries == 2
+    assert limiter.in_flight == 0
+
+
+def test_async_retries_errors_wrapped_by_instructor(start_server):
+    server = start_server(overloaded_rate=1.0)
+    limiter = RateLimiter(base_delay=0.001, max_delay=0.001, max_retries=2)
+
+    async def play():
+        client = anthropic.AsyncAnthropic(base_url=base_url(server), api_key="test")
+        manager = GPTModelManager(async_anthropic_client=client, rate_limiter=limiter)
+        with pytest.raises(InstructorRetryException):
+            await manager.get_response_async(REQUEST["messages"][0]["content"], str)
+        await client.close()
+
+    asyncio.run(play())
+    assert server.rejected == 3
+    assert limiter.retries == 2
+    assert limiter.in_flight == 0
+
+
+def test_client_side_limit_keeps_under_the_server_limit(start_server):
+    server = start_server(requests_per_minute=600)
+    limiter = RateLimiter(requests_per_minute=600)
+    client = client_for(server, limiter)
+    # Drain the server first, so it has refilled at least as far as the client thinks.
+    with server.lock:
+        server.bucket.level = 0
+    limiter.requests.level = 0
+
+    start = time.monotonic()
+    for _ in range(3):
+        client.messages.create(**REQUEST)
+    assert time.monotonic() - start >= 0.2
+    assert (server.accepted, server.rejected) == (3, 0)
+
+
+def test_async_calls_share_the_limiter(start_server):
+    server = start_server(overloaded_rate=0.3)
+    limiter = RateLimiter(max_in_flight=2, base_delay=0.001, max_delay=0.01, max_retries=20)
+
+    async def play():
+        client = anthropic.AsyncAnthropic(base_url=base_url(server), api_key="test")
+        limited = AsyncRateLimitedAnthropic(client, limiter)
+        await asyncio.gather(*(limited.messages.create(**REQUEST) for _ in range(6)))
+        await client.close()
+
+    asyncio.run(play())
+    assert server.accepted == 6
+    assert limiter.calls == 6 + limiter.retries
+    assert limiter.in_flight == 0
+
+
+def test_lower_priority_numbers_go_first():
+    limiter = RateLimiter(max_in_flight=1)
+    limiter.acquire(0)
+    order = []
+
+    def call(priority: int):
+        limiter.acquire(0, priority)
+        order.append(priority)
+        limiter.release()
+
+    threads = [threading.Thread(target=call, args=(priority,)) for priority in (2, 0, 1)]
+    for thread in threads:
+        thread.start()
+    while len(limiter.waiting) < 3:
+        time.sleep(0.001)
+    limiter.release()
+    for thread in threads:
+        thread.join()
+    assert order == [0, 1, 2]
@@ -0,0 +1,28 @@
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+from run_game import run_in_pools
+
+
+def play(episode: int, log_path: str) -> int:
+    with open(log_path, "a") as log:
+        log.write(f"{episode}\n")
+    if episode == 2:
+        os._exit(1)
+    if episode == 3:
+        raise ValueError("bad episode")
+    return episode * 10
+
+
+def test_only_the_crashing_job_fails(tmp_path):
+    log_path = str(tmp_path / "started.txt")
+    jobs = {episode: (episode, log_path) for episode in range(6)}
+    results = dict(run_in_pools(play, jobs, workers=2, rom_paths=[], max_crashes=2))
+
+    assert sorted(results) == list(range(6))
+    assert isinstance(results[2], BrokenProcessPool)
+    assert isinstance(results[3], ValueError)
+    assert {episode: results[episode] for episode in (0, 1, 4, 5)} == {0: 0, 1: 10, 4: 40, 5: 50}
+    # Once in the shared pool, then twice in a pool of its own.
+    with open(log_path) as log:
+        assert log.read().split().count("2") == 3
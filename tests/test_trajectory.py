@@ -0,0 +1,159 @@
+import math
+
+import pytest
+
+from utils.history import History, HistoryWriter
+from utils.trajectory import (
+    TrajectoryStore,
+    TrajectoryWriter,
+    column_path,
+    convert_transcript,
+    merge,
+)
+
+
+def write_episode(writer: TrajectoryWriter, game: str, moves: int, score_step: int = 1) -> int:
+    episode = writer.begin_episode(game)
+    for move in range(moves):
+        writer.add_move(
+            episode, move, f"action {move}", f"{game} room {move}", 1, move * score_step, 10, 2, 0.5
+        )
+    return episode
+
+
+def rows(store: TrajectoryStore) -> list[tuple]:
+    return [
+        (store.text("game", row), store.column("episode")[row], store.column("move")[row])
+        for row in range(len(store))
+    ]
+
+
+def test_round_trip(tmp_path):
+    writer = TrajectoryWriter(str(tmp_path), flush_every=3)
+    write_episode(writer, "zork1", 5)
+    writer.close()
+
+    store = TrajectoryStore(str(tmp_path))
+    assert len(store) == 5
+    assert list(store.column("score")) == [0, 1, 2, 3, 4]
+    assert store.text("action", 4) == "action 4"
+    assert store.text("observation", 2) == "zork1 room 2"
+    assert store.array("latency").tolist() == [0.5] * 5
+    summary = store.episode_summary()
+    assert summary["game"] == ["zork1"]
+    assert summary["moves"].tolist() == [5]
+    assert summary["score"].tolist() == [4]
+    assert summary["input_tokens"].tolist() == [50]
+
+
+def test_strings_are_stored_once(tmp_path):
+    writer = TrajectoryWriter(str(tmp_path))
+    episode = writer.begin_episode("zork1")
+    for move in range(4):
+        writer.add_move(episode, move, "north", "Forest", 0, 0)
+    writer.close()
+    store = TrajectoryStore(str(tmp_path))
+    assert len(store.strings["action"]) == 1
+    assert len(store.strings["observation"]) == 1
+    assert math.isnan(store.column("latency")[0])
+
+
+def test_reopening_drops_what_a_crash_left_behind(tmp_path):
+    writer = TrajectoryWriter(str(tmp_path))
+    write_episode(writer, "zork1", 4)
+    writer.close()
+    # A crash mid-flush: one column got an extra row, and a string was half written.
+    with open(column_path(str(tmp_path), "move"), "ab") as f:
+        f.write(b"\x07\x00\x00\x00\x08\x00")
+    with open(tmp_path / "action.strings", "ab") as f:
+        f.write(b"half an act")
+
+    assert len(TrajectoryStore(str(tmp_path))) == 4
+    writer = TrajectoryWriter(str(tmp_path))
+    assert writer.rows == 4
+    episode = writer.begin_episode("zork1")
+    writer.add_move(episode, 0, "new action", "new room", 0, 0)
+    writer.close()
+
+    store = TrajectoryStore(str(tmp_path))
+    assert len(store) == 5
+    assert store.text("action", 4) == "new action"
+    assert store.text("action", 3) == "action 3"
+    assert store.meta["episodes"] == 2
+
+
+def test_resume_episode_drops_rows_after_the_checkpoint(tmp_path):
+    writer = TrajectoryWriter(str(tmp_path))
+    first = write_episode(writer, "zork1", 4)
+    write_episode(writer, "detective", 2)
+    writer.close()
+
+    writer = TrajectoryWriter(str(tmp_path))
+    assert writer.resume_episode(first, 1, "zork1") == first
+    writer.add_move(first, 2, "again", "zork1 room 2", 0, 0)
+    writer.close()
+
+    store = TrajectoryStore(str(tmp_path))
+    assert rows(store) == [
+        ("zork1", 0, 0),
+        ("zork1", 0, 1),
+        ("detective", 1, 0),
+        ("detective", 1, 1),
+        ("zork1", 0, 2),
+    ]
+    assert store.text("action", 4) == "again"
+    assert store.meta["episodes"] == 2
+
+
+def test_merge_keeps_games_apart(tmp_path):
+    for game, moves in (("zork1", 3), ("detective", 2)):
+        writer = TrajectoryWriter(str(tmp_path / game))
+        write_episode(writer, game, moves, score_step=10 if game == "detective" else 1)
+        writer.close()
+
+    merged = str(tmp_path / "merged")
+    merge(merged, str(tmp_path / "zork1"), str(tmp_path / "detective"))
+    store = TrajectoryStore(merged)
+    assert rows(store) == [
+        ("zork1", 0, 0),
+        ("zork1", 0, 1),
+        ("zork1", 0, 2),
+        ("detective", 1, 0),
+        ("detective", 1, 1),
+    ]
+    summary = store.episode_summary()
+    assert summary["game"] == ["zork1", "detective"]
+    assert summary["score"].tolist() == [2, 10]
+
+    # Merging again appends the episodes anew.
+    merge(merged, str(tmp_path / "zork1"))
+    assert TrajectoryStore(merged).episode_summary()["episode"].tolist() == [0, 1, 2]
+
+
+def test_rejects_stores_with_other_columns(tmp_path):
+    writer = TrajectoryWriter(str(tmp_path))
+    write_episode(writer, "zork1", 1)
+    writer.close()
+    meta_path = tmp_path / "meta.json"
+    meta_path.write_text(meta_path.read_text().replace('"game": "i", ', ""))
+    with pytest.raises(ValueError, match="has columns"):
+        TrajectoryStore(str(tmp_path))
+
+
+def test_convert_transcript(tmp_path):
+    transcript = tmp_path / "history.txt"
+    history = History("SYSTEM", writer=HistoryWriter(str(transcript)))
+    history.update_history("start", "West of House\n", 0, 0, ["north"])
+    history.update_history_with_string("Thinking: go north.\n\nnorth")
+    history.update_history("north", "North of House", 5, 5, ["south", "west"])
+    history.close()
+
+    writer = TrajectoryWriter(str(tmp_path / "store"))
+    assert convert_transcript(str(transcript), writer, "zork1") == 2
+    writer.close()
+    store = TrajectoryStore(str(tmp_path / "store"))
+    assert [store.text("action", row) for row in range(2)] == ["start", "north"]
+    assert store.text("observation", 0) == "West of House\n"
+    assert store.text("observation", 1) == "North of House"
+    assert list(store.column("reward")) == [0, 5]
+    assert store.episode_summary()["game"] == ["zork1"]
@@ -0,0 +1,100 @@
+import json
+
+from utils.valid_actions import ValidActionCache, cache_path_for_rom
+
+
+class StubEnv:
+    def __init__(self, state_hash: str = "a", valid_actions=("north", "south")):
+        self.state_hash = state_hash
+        self.valid_actions = list(valid_actions)
+        self.calls = 0
+
+    def get_world_state_hash(self) -> str:
+        return self.state_hash
+
+    def get_valid_actions(self, use_parallel=False) -> list[str]:
+        self.calls += 1
+        return list(self.valid_actions)
+
+
+def test_hits_skip_the_emulator():
+    cache = ValidActionCache()
+    env = StubEnv()
+    assert cache.get_valid_actions(env) == ["north", "south"]
+    assert cache.get_valid_actions(env) == ["north", "south"]
+    assert env.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_returned_lists_are_copies():
+    cache = ValidActionCache()
+    env = StubEnv()
+    cache.get_valid_actions(env).append("xyzzy")
+    assert cache.get_valid_actions(env) == ["north", "south"]
+
+
+def test_evicts_least_recently_used():
+    cache = ValidActionCache(max_entries=2)
+    cache.put("a", ["north"])
+    cache.put("b", ["south"])
+    cache.get_valid_actions(StubEnv("a"))
+    cache.put("c", ["east"])
+    assert list(cache.entries) == ["a", "c"]
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = ValidActionCache(path=path)
+    cache.put("a", ["north"])
+    cache.put("b", ["south", "take lamp"])
+    cache.save()
+
+    reloaded = ValidActionCache(path=path)
+    assert reloaded.entries == cache.entries
+    assert reloaded.get_valid_actions(StubEnv("b")) == ["south", "take lamp"]
+    assert reloaded.hits == 1
+    assert [p.name for p in tmp_path.iterdir()] == ["cache.json"]
+
+
+def test_missing_or_corrupt_file_counts_as_empty(tmp_path):
+    assert len(ValidActionCache(path=str(tmp_path / "missing.json")).entries) == 0
+
+    path = tmp_path / "cache.json"
+    path.write_text('{"a": ["north"], "b": [')
+    cache = ValidActionCache(path=str(path))
+    assert len(cache.entries) == 0
+    cache.put("c", ["east"])
+    cache.save()
+    assert json.loads(path.read_text()) == {"c": ["east"]}
+
+
+def test_save_path_leaves_the_shared_file_alone(tmp_path):
+    shared = tmp_path / "shared.json"
+    shared.write_text(json.dumps({"a": ["north"]}))
+    own = tmp_path / "episode" / "own.json"
+    cache = ValidActionCache(path=str(shared), save_path=str(own))
+    cache.put("b", ["south"])
+    cache.save()
+
+    assert json.loads(shared.read_text()) == {"a": ["north"]}
+    assert json.loads(own.read_text()) == {"a": ["north"], "b": ["south"]}
+
+
+def test_cache_path_for_rom():
+    assert cache_path_for_rom("caches", "games/zork1.z5") == "caches/zork1.valid_actions.json"
+
+
+def test_merge_episode_caches(tmp_path):
+    from run_game import EPISODE_VALID_ACTIONS, merge_valid_action_caches
+
+    shared = tmp_path / "zork1.valid_actions.json"
+    shared.write_text(json.dumps({"a": ["north"]}))
+    for episode, entries in enumerate([{"a": ["north"], "b": ["south"]}, {"c": ["east"]}]):
+        episode_dir = tmp_path / "logs" / f"episode_{episode:03d}"
+        episode_dir.mkdir(parents=True)
+        (episode_dir / EPISODE_VALID_ACTIONS).write_text(json.dumps(entries))
+    # An episode that crashed before saving its cache.
+    (tmp_path / "logs" / "episode_002").mkdir()
+
+    merge_valid_action_caches(str(shared), str(tmp_path / "logs"), episodes=3)
+    assert json.loads(shared.read_text()) == {"a": ["north"], "b": ["south"], "c": ["east"]}
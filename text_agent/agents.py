@@ -1,61 +1,62 @@
+import asyncio
 import random
 import textwrap
-from abc import ABC, abstractmethod
+import time
+from abc import abstractmethod
 
 import anthropic
-from termcolor import cprint
 
-from utils.gpt import GPTModelManager
-from utils.history import History
-
-
-class AgentInterface(ABC):
-    @abstractmethod
-    def show_state(
-        chosen_action: str, observation: str, reward: int, score: int, valid_actions: list[str]
-    ) -> None: ...
-
-    @abstractmethod
-    def choose_next_action(self) -> str: ...
-
-
-class RandomAgent(AgentInterface):
-    def __init__(self):
-        self.valid_actions = []
-
-    def show_state(
-        self,
-        chosen_action: str,
-        observation: str,
-        reward: int,
-        score: int,
-        valid_actions: list[str],
-    ) -> None:
-        self.valid_actions = valid_actions
-
-    def choose_next_action(self) -> str:
-        return random.choice(self.valid_actions)
-
-
-class HumanAgent(AgentInterface):
-    def show_state(
-        self,
-        chosen_action: str,
-        observation: str,
-        reward: int,
-        score: int,
-        valid_actions: list[str],
-    ) -> None:
-        pass
-
-    def choose_next_action(
-        self,
-    ) -> str:
-        return input("Enter your action: ")
+from text_agent.base import AgentInterface, AgentWrapper
+from utils.action_matcher import ActionMatcher
+from utils.console import console
+from utils.gpt import (
+    CONFIDENCE_PATTERN,
+    GPTModelManager,
+    ModelCascade,
+    confidence_instruction,
+    parse_confidence,
+    strip_confidence,
+)
+from utils.history import ContextWindow, History, HistoryWriter, estimate_tokens
+from utils.llm_cache import AsyncCachedAnthropic, CachedAnthropic, ResponseCache
+from utils.mental_map import MentalMap, room_objects
+from utils.rate_limit import AsyncRateLimitedAnthropic, RateLimitedAnthropic, RateLimiter
+from utils.rollouts import RolloutPool, step_value
+from utils.tracing import tracer
+
+# Asks a cheap model to pick from the valid actions when an answer can't be matched to one.
+RETRY_SYSTEM_MESSAGE = (
+    "Reply with exactly one action from the list, written as it appears in the list, and "
+    "nothing else."
+)
+
+
+def retry_prompt(answer: str, valid_actions: list[str]) -> str:
+    return f"A player wanted to do: {answer}\n\nVALID ACTIONS: {valid_actions}"
 
 
 class RawHistoryAgent(AgentInterface):
-    def __init__(self):
+    retry_model = "claude-3-haiku-20240307"
+    checkpoint_attributes = (
+        *AgentInterface.checkpoint_attributes,
+        "history",
+        "last_valid_actions",
+        "action_matcher",
+        "cascade",
+    )
+
+    def __init__(
+        self,
+        history_path: str = "history.txt",
+        anthropic_client: anthropic.Anthropic | None = None,
+        async_anthropic_client: anthropic.AsyncAnthropic | None = None,
+        response_cache: ResponseCache | None = None,
+        cascade: ModelCascade | None = None,
+        rate_limiter: RateLimiter | None = None,
+        priority: int = 0,
+        compact_history: bool = False,
+        history_jsonl: bool = False,
+    ):
         system_message = textwrap.dedent("""\
             You are an expert at text-based games. You are trying to play a game, and
             you are trying to figure out what the next best action should be based on
@@ -64,17 +65,129 @@ class RawHistoryAgent(AgentInterface):
             written exactly as it appears in the list. Do not guess at actions that
             you think should be possible. Only choose an action on the latest list.""")
 
-        self.history = History(system_message=system_message)
-        self.agent = GPTModelManager(system_message=system_message)
+        self.history = History(
+            system_message=system_message,
+            writer=HistoryWriter(history_path, jsonl=history_jsonl),
+            compact=compact_history,
+        )
+        # Only the model sees the confidence instruction, not history.txt.
+        self.agent = GPTModelManager(
+            system_message=(
+                system_message
+                if cascade is None
+                else f"{system_message}\n{confidence_instruction()}"
+            ),
+            anthropic_client=anthropic_client,
+            async_anthropic_client=async_anthropic_client,
+            response_cache=response_cache,
+            cascade=cascade,
+            rate_limiter=rate_limiter,
+            priority=priority,
+        )
+        self.retry_agent = GPTModelManager(
+            system_message=RETRY_SYSTEM_MESSAGE,
+            anthropic_client=anthropic_client,
+            async_anthropic_client=async_anthropic_client,
+            response_cache=response_cache,
+            rate_limiter=rate_limiter,
+            priority=priority,
+        )
+        self.cascade = cascade
+        self.last_valid_actions = []
+        self.action_matcher = ActionMatcher([])
 
     def choose_next_action(self) -> str:
         model = "claude-3-haiku-20240307"
-        next_action = self.agent.get_response(
-            model=model,
-            prompt=self.history.get_formatted_history_for_next_action(),
-            response_model=str,
-        )
-        return next_action
+        with tracer.span("history.format"):
+            prompt = self.history.get_cacheable_history_blocks()
+        if self.cascade is not None:
+            with tracer.span("llm.request", cascade=True):
+                next_action = self.agent.get_cascaded_response(
+                    prompt,
+                    response_model=str,
+                    is_valid=lambda answer: (
+                        self.action_matcher.match(strip_confidence(answer)) is not None
+                    ),
+                    on_usage=self.record_usage,
+                )
+            next_action = strip_confidence(next_action)
+        else:
+            with tracer.span("llm.request", model=model):
+                next_action = self.agent.get_response(
+                    model=model, prompt=prompt, response_model=str
+                )
+            if self.agent.last_usage is not None:
+                self.record_usage(self.agent.last_usage)
+        return self.match_action(next_action) or self.retry_invalid(next_action)
+
+    async def choose_next_action_async(self) -> str:
+        model = "claude-3-haiku-20240307"
+        with tracer.span("history.format"):
+            prompt = self.history.get_cacheable_history_blocks()
+        if self.cascade is not None:
+            with tracer.span("llm.request", cascade=True):
+                next_action = await self.agent.get_cascaded_response_async(
+                    prompt,
+                    response_model=str,
+                    is_valid=lambda answer: (
+                        self.action_matcher.match(strip_confidence(answer)) is not None
+                    ),
+                    on_usage=self.record_usage,
+                )
+            next_action = strip_confidence(next_action)
+        else:
+            with tracer.span("llm.request", model=model):
+                next_action = await self.agent.get_response_async(
+                    model=model, prompt=prompt, response_model=str
+                )
+            if self.agent.last_usage is not None:
+                self.record_usage(self.agent.last_usage)
+        return self.match_action(next_action) or await self.retry_invalid_async(next_action)
+
+    def match_action(self, answer: str) -> str | None:
+        """
+        Returns the answer matched onto the valid actions, or None if it can't be matched, so
+        the caller retries.
+        """
+        if answer in self.last_valid_actions:
+            return answer
+        self.invalid_actions += 1
+        tracer.count("actions.invalid")
+        action = self.action_matcher.match(answer)
+        if action is None:
+            console.move(f"Invalid action: {answer}, retrying", "red")
+            return None
+        tracer.count("actions.matched")
+        return action
+
+    def retry_invalid(self, answer: str) -> str:
+        with tracer.span("llm.retry_request"):
+            response = self.retry_agent.get_response(
+                retry_prompt(answer, self.last_valid_actions),
+                response_model=str,
+                model=self.retry_model,
+            )
+        return self.handle_retry(response)
+
+    async def retry_invalid_async(self, answer: str) -> str:
+        with tracer.span("llm.retry_request"):
+            response = await self.retry_agent.get_response_async(
+                retry_prompt(answer, self.last_valid_actions),
+                response_model=str,
+                model=self.retry_model,
+            )
+        return self.handle_retry(response)
+
+    def handle_retry(self, response: str) -> str:
+        if self.retry_agent.last_usage is not None:
+            self.record_usage(self.retry_agent.last_usage, label="Retry Input and Output tokens")
+        action = self.action_matcher.match_completion(response)
+        if action is None:
+            console.move(f"Retry failed: {response}", "red")
+            tracer.count("actions.invalid_fallback")
+            return random.choice(self.last_valid_actions)
+        tracer.count("actions.retried")
+        return action
 
     def show_state(
         self,
@@ -91,67 +204,335 @@ class RawHistoryAgent(AgentInterface):
             score=score,
             next_valid_actions=valid_actions,
         )
-        self.history.export_history_to_file("history.txt")
-
-
-class ThinkingAgent(AgentInterface):
-    def __init__(self):
-        self.history = History(system_message="")
-        self.anthropic_client = anthropic.Anthropic()
-        self.last_valid_actions = []
-
-    def choose_next_action(self) -> str:
-        system = textwrap.dedent("""\
-            You are an expert at text-based games. You are trying to play a game, and
-            you are trying to figure out what the next best action should be based on
-            context you are given. You will always be given a list of valid actions.
-
-            Begin your response with a few sentences of thinking through your choices.
-            Then output two
-            newlines and then the exact text of your chosen action. Write nothing
-            after outputing your chosen action. It should be the
-            only text on the final line. Do not guess at actions you think should be
-            possible. Only choose an action on the latest list.
+        self.last_valid_actions = valid_actions
+        self.action_matcher = ActionMatcher(valid_actions)
+        if self.cascade is not None:
+            self.cascade.observe(observation, reward, valid_actions)
 
-            Example response:
+    def close(self) -> None:
+        self.history.close()
 
-            ```Thinking: As I've explored east already, I will go west now.
 
-            west```
+class ActionStream:
+    def __init__(self, action_marker: str, valid_actions: list[str]):
+        """
+        Accumulates a streamed completion and spots the chosen action as soon as the line after
+        action_marker is complete and is one of valid_actions.
+        """
+        self.action_marker = action_marker
+        self.valid_actions = valid_actions
+        self.text = ""
+        self.start_time = time.perf_counter()
+        self.first_token_time = None
+        self.action_time = None
+        self.stopped_early = False
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Adds a chunk of streamed text. Returns True once the action has been read, at which
+        point the caller should close the stream.
+        """
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter() - self.start_time
+        self.text += chunk
+
+        marker_index = self.text.rfind(self.action_marker)
+        if marker_index == -1:
+            return False
+        action_start = marker_index + len(self.action_marker)
+        while True:
+            while action_start < len(self.text) and self.text[action_start] in " \n":
+                action_start += 1
+            action_end = self.text.find("\n", action_start)
+            if action_end == -1:
+                return False
+            line = self.text[action_start:action_end].strip()
+            # A confidence line asked for by a cascade may still land between marker and action.
+            if not CONFIDENCE_PATTERN.match(line):
+                break
+            action_start = action_end
+        if line not in self.valid_actions:
+            return False
+
+        self.action_time = time.perf_counter() - self.start_time
+        self.text = self.text[:action_end]
+        self.stopped_early = True
+        return True
+
+    def finish(self, usage):
+        total_time = time.perf_counter() - self.start_time
+        if self.action_time is None:
+            self.action_time = total_time
+        console.move(
+            f"Time to first token, action and completion: {self.first_token_time or 0:.2f}s "
+            f"{self.action_time:.2f}s {total_time:.2f}s",
+            "yellow",
+        )
+        console.event(
+            "stream_timing",
+            first_token=self.first_token_time,
+            action=self.action_time,
+            total=total_time,
+            stopped_early=self.stopped_early,
+        )
+        if self.stopped_early:
+            # The final usage delta never arrives when the stream is closed early.
+            usage = usage.model_copy(update={"output_tokens": estimate_tokens(self.text)})
+        return self.text, usage
+
+
+class ClaudeAgent(AgentInterface):
+    """
+    Base class for agents that send a system prompt plus a view of their history to Claude and
+    read the chosen action off the last line of the completion.
+    """
+
+    system_prompt = ""
+    model = "claude-3-sonnet-20240229"
+    max_tokens = 1000
+    # Mark the system prompt as a prompt-cache breakpoint. get_prompt can add its own breakpoints
+    # by returning content blocks.
+    cache_system_prompt = True
+    # Stream completions and close the stream as soon as the line after action_marker is a
+    # valid action, instead of waiting for the whole completion.
+    stream_response = False
+    action_marker = ""
+    retry_model = "claude-3-haiku-20240307"
+    checkpoint_attributes = (
+        *AgentInterface.checkpoint_attributes,
+        "history",
+        "last_valid_actions",
+        "action_matcher",
+        "cascade",
+    )
+
+    def __init__(
+        self,
+        history_path: str = "history.txt",
+        anthropic_client: anthropic.Anthropic | None = None,
+        async_anthropic_client: anthropic.AsyncAnthropic | None = None,
+        response_cache: ResponseCache | None = None,
+        cascade: ModelCascade | None = None,
+        rate_limiter: RateLimiter | None = None,
+        priority: int = 0,
+        compact_history: bool = False,
+        history_jsonl: bool = False,
+    ):
+        """
+        :param cascade: Pick the model per call from these tiers instead of using self.model.
+            The agent is then also asked for a confidence line before its action.
+        :param rate_limiter: Scheduler shared by every agent in the process, which queues calls
+            by priority (lower first) and retries rate-limit errors.
+        :param compact_history: Write "(same as before)" in prompts for an observation or list of
+            valid actions that repeats the previous move's.
+        :param history_jsonl: Write history_path as one JSON record per entry instead of the
+            plain-text transcript.
+        """
+        self.history = History(
+            system_message="",
+            writer=HistoryWriter(history_path, jsonl=history_jsonl),
+            compact=compact_history,
+        )
+        self.cascade = cascade
+        self.response_cache = response_cache
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+        self.anthropic_client = self.wrap_client(anthropic_client or anthropic.Anthropic())
+        self.async_anthropic_client = None
+        if async_anthropic_client is not None:
+            self.async_anthropic_client = self.wrap_async_client(async_anthropic_client)
+        self.last_valid_actions = []
+        self.action_matcher = ActionMatcher([])
 
-            Another example response:
+    @abstractmethod
+    def get_prompt(self) -> str | list[dict]: ...
+
+    def system_text(self) -> str:
+        if self.cascade is None:
+            return self.system_prompt
+        return f"{self.system_prompt}\n{confidence_instruction(self.action_marker)}"
+
+    def build_request(self) -> dict:
+        system = self.system_text()
+        if self.cache_system_prompt:
+            system = [
+                {"type": "text", "text": system, "cache_control": {"type": "ephemeral"}},
+            ]
+        with tracer.span("history.format"):
+            prompt = self.get_prompt()
+        return {
+            "system": system,
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": self.max_tokens,
+        }
 
-            ```Thinking: I will try to find a key to open the door.
+    def choose_next_action(self) -> str:
+        request = self.build_request()
+        if self.cascade is None:
+            text, usage = self.complete(request)
+        else:
+            text, usage = self.complete_with_cascade(request)
+        return self.handle_response(text, usage) or self.retry_invalid(text)
+
+    def complete_with_cascade(self, request: dict):
+        return self.cascade.run(
+            lambda model: self.complete({**request, "model": model}),
+            self.judge,
+            self.discard,
+        )
 
-            open box```
-            """)
+    def complete(self, request: dict):
+        if self.stream_response:
+            return self.stream_completion(request)
+
+        with tracer.span("llm.request", model=request["model"]):
+            response = self.anthropic_client.messages.create(**request)
+        return response.content[0].text, response.usage
+
+    def judge(self, completion) -> tuple[bool, int | None]:
+        """
+        Whether a (text, usage) completion names a valid action, and its reported confidence.
+        """
+        text, _ = completion
+        return self.action_matcher.match_completion(text) is not None, parse_confidence(text)
+
+    def discard(self, completion, model: str):
+        """
+        A completion the cascade retries on `model` still costs its tokens but stays out of the
+        history.
+        """
+        self.record_usage(completion[1], label="Escalated Input and Output tokens")
+        console.move(f"Escalating to {model}", "yellow")
+
+    @staticmethod
+    def parse_action(text: str) -> str:
+        return text.splitlines()[-1].strip() if text else ""
+
+    def stream_completion(self, request: dict):
+        action_stream = ActionStream(self.action_marker, self.last_valid_actions)
+        with (
+            tracer.span("llm.request", model=request["model"], stream=True),
+            self.anthropic_client.messages.stream(**request) as stream,
+        ):
+            for chunk in stream.text_stream:
+                if action_stream.feed(chunk):
+                    break
+            usage = stream.current_message_snapshot.usage
+        return action_stream.finish(usage)
+
+    async def stream_completion_async(self, request: dict):
+        action_stream = ActionStream(self.action_marker, self.last_valid_actions)
+        with tracer.span("llm.request", model=request["model"], stream=True):
+            async with self.get_async_anthropic_client().messages.stream(**request) as stream:
+                async for chunk in stream.text_stream:
+                    if action_stream.feed(chunk):
+                        break
+                usage = stream.current_message_snapshot.usage
+        return action_stream.finish(usage)
+
+    def get_async_anthropic_client(self):
+        if self.async_anthropic_client is None:
+            self.async_anthropic_client = self.wrap_async_client(anthropic.AsyncAnthropic())
+        return self.async_anthropic_client
+
+    def wrap_client(self, client):
+        # The cache goes outside the limiter so cache hits don't count against the limits.
+        if self.rate_limiter is not None:
+            client = RateLimitedAnthropic(client, self.rate_limiter, self.priority)
+        if self.response_cache is not None:
+            client = CachedAnthropic(client, self.response_cache)
+        return client
+
+    def wrap_async_client(self, client):
+        if self.rate_limiter is not None:
+            client = AsyncRateLimitedAnthropic(client, self.rate_limiter, self.priority)
+        if self.response_cache is not None:
+            client = AsyncCachedAnthropic(client, self.response_cache)
+        return client
+
+    async def choose_next_action_async(self) -> str:
+        return await self.complete_async(self.build_request())
+
+    async def complete_async(self, request: dict) -> str:
+        if self.cascade is None:
+            text, usage = await self.fetch_async(request)
+        else:
+            text, usage = await self.fetch_with_cascade_async(request)
+        return self.handle_response(text, usage) or await self.retry_invalid_async(text)
+
+    async def fetch_with_cascade_async(self, request: dict):
+        return await self.cascade.run_async(
+            lambda model: self.fetch_async({**request, "model": model}),
+            self.judge,
+            self.discard,
+        )
 
-        # model = "claude-3-haiku-20240307"
-        model = "claude-3-sonnet-20240229"
-        # model = "claude-3-opus-20240229"
+    async def fetch_async(self, request: dict):
+        if self.stream_response:
+            return await self.stream_completion_async(request)
 
-        response = self.anthropic_client.messages.create(
-            system=system,
-            model=model,
-            messages=[
-                {"role": "user", "content": self.history.get_formatted_history_for_next_action()}
-            ],
-            max_tokens=1000,
-        )
+        with tracer.span("llm.request", model=request["model"]):
+            response = await self.get_async_anthropic_client().messages.create(**request)
+        return response.content[0].text, response.usage
 
-        text = response.content[0].text
-        input_tokens = response.usage.input_tokens
-        output_tokens = response.usage.output_tokens
-        cprint(f"Input and Output tokens: {input_tokens} {output_tokens}", "yellow")
+    def handle_response(self, text: str, usage) -> str | None:
+        """
+        Records the completion and returns its action, matched onto the valid actions if it
+        isn't one as written. Returns None if it can't be matched, so the caller retries.
+        """
+        self.record_usage(usage)
 
         self.history.update_history_with_string(text)
-        cprint(text, "light_blue")
-        action = text.splitlines()[-1].strip()
+        console.move(text, "light_blue")
+        answer = self.parse_action(text)
+        if answer in self.last_valid_actions:
+            return answer
+
+        self.invalid_actions += 1
+        tracer.count("actions.invalid")
+        action = self.action_matcher.match_completion(text)
+        console.event("invalid_action", action=answer, matched=action)
+        if action is not None:
+            console.move(f"Invalid action: {answer}, matched to {action}", "red")
+            tracer.count("actions.matched")
+        else:
+            console.move(f"Invalid action: {answer}, retrying", "red")
+        return action
 
-        if action not in self.last_valid_actions:
-            cprint(f"Invalid action: {action}", "red")
+    def build_retry_request(self, text: str) -> dict:
+        return {
+            "system": RETRY_SYSTEM_MESSAGE,
+            "model": self.retry_model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": retry_prompt(self.parse_action(text), self.last_valid_actions),
+                }
+            ],
+            "max_tokens": 20,
+        }
+
+    def retry_invalid(self, text: str) -> str:
+        with tracer.span("llm.retry_request"):
+            response = self.anthropic_client.messages.create(**self.build_retry_request(text))
+        return self.handle_retry(response)
+
+    async def retry_invalid_async(self, text: str) -> str:
+        with tracer.span("llm.retry_request"):
+            response = await self.get_async_anthropic_client().messages.create(
+                **self.build_retry_request(text)
+            )
+        return self.handle_retry(response)
+
+    def handle_retry(self, response) -> str:
+        self.record_usage(response.usage, label="Retry Input and Output tokens")
+        action = self.action_matcher.match_completion(response.content[0].text)
+        if action is None:
+            console.move(f"Retry failed: {response.content[0].text}", "red")
+            tracer.count("actions.invalid_fallback")
             return random.choice(self.last_valid_actions)
-
+        tracer.count("actions.retried")
         return action
 
     def show_state(
@@ -169,158 +550,284 @@ class ThinkingAgent(AgentInterface):
             score=score,
             next_valid_actions=valid_actions,
         )
-        self.history.export_history_to_file("history.txt")
         self.last_valid_actions = valid_actions
+        self.action_matcher = ActionMatcher(valid_actions)
+        if self.cascade is not None:
+            self.cascade.observe(observation, reward, valid_actions)
 
+    def close(self) -> None:
+        self.history.close()
 
-class SummaryAgent(AgentInterface):
-    def __init__(self):
-        self.history = History(system_message="")
-        self.anthropic_client = anthropic.Anthropic()
-        self.last_valid_actions = []
 
-    def choose_next_action(self) -> str:
-        system = textwrap.dedent("""\
-            You are an expert at text-based games. You are trying to play a game, and
-            you are trying to figure out what the next best action should be based on
-            context you are given. You will always be given a list of valid actions.
+class ThinkingAgent(ClaudeAgent):
+    system_prompt = textwrap.dedent("""\
+        You are an expert at text-based games. You are trying to play a game, and
+        you are trying to figure out what the next best action should be based on
+        context you are given. You will always be given a list of valid actions.
 
-            Begin your response with a few sentences of thinking through your choices.
-            Then output two
-            newlines and then the exact text of your chosen action. Write nothing
-            after outputing your chosen action. It should be the
-            only text on the final line. Do not guess at actions you think should be
-            possible. Only choose an action on the latest list.
+        Begin your response with a few sentences of thinking through your choices.
+        Then output two
+        newlines and then the exact text of your chosen action. Write nothing
+        after outputing your chosen action. It should be the
+        only text on the final line. Do not guess at actions you think should be
+        possible. Only choose an action on the latest list.
 
-            Example response:
+        Example response:
 
-            ```Thinking: As I've explored east already, I will go west now.
+        ```Thinking: As I've explored east already, I will go west now.
 
-            west```
+        west```
 
-            Another example response:
+        Another example response:
 
-            ```Thinking: I will try to find a key to open the door.
+        ```Thinking: I will try to find a key to open the door.
 
-            open box```
-            """)
+        open box```
+        """)
 
-        # model = "claude-3-haiku-20240307"
-        model = "claude-3-sonnet-20240229"
-        # model = "claude-3-opus-20240229"
+    # model = "claude-3-haiku-20240307"
+    model = "claude-3-sonnet-20240229"
+    # model = "claude-3-opus-20240229"
 
-        response = self.anthropic_client.messages.create(
-            system=system,
-            model=model,
-            messages=[
-                {"role": "user", "content": self.history.get_formatted_history_for_next_action()}
-            ],
-            max_tokens=1000,
-        )
+    def get_prompt(self) -> list[dict]:
+        return self.history.get_cacheable_history_blocks()
 
-        text = response.content[0].text
-        input_tokens = response.usage.input_tokens
-        output_tokens = response.usage.output_tokens
-        cprint(f"Input and Output tokens: {input_tokens} {output_tokens}", "yellow")
 
-        self.history.update_history_with_string(text)
-        cprint(text, "light_blue")
-        action = text.splitlines()[-1].strip()
+class SummaryAgent(ClaudeAgent):
+    system_prompt = textwrap.dedent("""\
+        You are an expert at text-based games. You are trying to play a game, and
+        you are trying to figure out what the next best action should be based on
+        context you are given. You will always be given a list of valid actions.
+        Older moves may be given to you as a summary, followed by the most recent moves.
 
-        if action not in self.last_valid_actions:
-            cprint(f"Invalid action: {action}", "red")
-            return random.choice(self.last_valid_actions)
+        Begin your response with a few sentences of thinking through your choices.
+        Then output two
+        newlines and then the exact text of your chosen action. Write nothing
+        after outputing your chosen action. It should be the
+        only text on the final line. Do not guess at actions you think should be
+        possible. Only choose an action on the latest list.
 
-        return action
+        Example response:
 
-    def show_state(
-        self,
-        chosen_action: str,
-        observation: str,
-        reward: int,
-        score: int,
-        valid_actions: list[str],
-    ) -> None:
-        self.history.update_history(
-            chosen_action=chosen_action,
-            observation=observation,
-            reward=reward,
-            score=score,
-            next_valid_actions=valid_actions,
-        )
-        self.history.export_history_to_file("history.txt")
-        self.last_valid_actions = valid_actions
+        ```Thinking: As I've explored east already, I will go west now.
 
+        west```
 
-class MentalMapAgent(AgentInterface):
-    def __init__(self):
-        self.history = History(system_message="")
-        self.anthropic_client = anthropic.Anthropic()
-        self.last_valid_actions = []
+        Another example response:
 
-    def choose_next_action(self) -> str:
-        system = textwrap.dedent("""\
-            You are an expert at text-based games. You are trying to play a game, and
-            you are trying to figure out what the next best action should be based on
-            context you are given. You will always be given a list of valid actions.
-            YOUR GOAL IS TO MAXIMIZE YOUR SCORE.
-            EXPLORING MORE REWARDING AREAS MIGHT HELP THAN LOOPING AROUND UNREWARDING AREAS.
-
-            Begin your response re-iterate mental map and update last mental map if needed.
-            then, output a few sentences of thinking through your choices.
-            Then output two
-            newlines and then the exact text of your chosen action. Write nothing
-            after outputing your chosen action. It should be the
-            only text on the final line. Do not guess at actions you think should be
-            possible. Only choose an action on the latest list.
-
-            FOLLOW THIS FORMAT STRICTLY:
-            ---------
-            Mental Map:
-                - Nodes:
-                - Current Location: Room A
-                - Interactions:
-                    - Explored east (Room B)
-                    - Found a locked door in Room B
-                - Objects:
-                    - Box in Room A
-                - Edges:
-                - (Current Location: Room A) -- (Explored east) --> (Room B)
-                - (Room B) -- (Found) --> (Locked Door)
-                - (Current Location: Room A) -- (Contains) --> (Box)
-            -------
-            Thinking: Based on the mental map, I have explored Room B to the east and found a locked door. Since I'm back in Room A and there is a box here, I will search the box for a potential key to unlock the door in Room B.
-            
-            NEXT BEST ACTION FROM VALID NEXT ACTIONS:
-            open box""")
+        ```Thinking: I will try to find a key to open the door.
 
-        model = "claude-3-haiku-20240307"
-        # model = "claude-3-sonnet-20240229"
-        # model = "claude-3-opus-20240229"
-
-        response = self.anthropic_client.messages.create(
-            system=system,
-            model=model,
-            messages=[
-                {"role": "user", "content": self.history.get_latest_history_entry()}
-            ],
-            max_tokens=1000,
-        )
+        open box```
+        """)
 
-        text = response.content[0].text
-        input_tokens = response.usage.input_tokens
-        output_tokens = response.usage.output_tokens
-        cprint(f"Input and Output tokens: {input_tokens} {output_tokens}", "yellow")
+    # model = "claude-3-haiku-20240307"
+    model = "claude-3-sonnet-20240229"
+    # model = "claude-3-opus-20240229"
 
-        self.history.update_history_with_string(text)
-        cprint(text, "light_blue")
-        action = text.splitlines()[-1].strip()
+    checkpoint_attributes = (*ClaudeAgent.checkpoint_attributes, "context")
 
-        if action not in self.last_valid_actions:
-            cprint(f"Invalid action: {action}", "red")
-            return random.choice(self.last_valid_actions)
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.context = ContextWindow(
+            history=self.history,
+            summarize=self.summarize,
+            keep_last_turns=8,
+            refresh_every=10,
+            max_input_tokens=6000,
+            reserved_tokens=estimate_tokens(self.system_text()),
+        )
 
-        return action
+    def summarize(self, previous_summary: str, new_turns: str) -> str:
+        system = textwrap.dedent("""\
+            You are keeping notes for an agent playing a text-based game. You will be given
+            the agent's previous notes and the moves that happened since. Rewrite the notes
+            so they cover everything that matters for playing on: locations visited and how
+            they connect, items found and where, puzzles solved or still open, and the score.
+            Be terse. Output only the updated notes.""")
+
+        with tracer.span("llm.summary_request"):
+            response = self.anthropic_client.messages.create(
+                system=system,
+                model="claude-3-haiku-20240307",
+                messages=[
+                    {
+                        "role": "user",
+                        "content": f"PREVIOUS NOTES:\n{previous_summary or '(none)'}\n\n"
+                        f"NEW MOVES:\n{new_turns}",
+                    }
+                ],
+                max_tokens=500,
+            )
+
+        self.record_usage(response.usage, label="Summary Input and Output tokens")
+        return response.content[0].text
+
+    def get_prompt(self) -> str:
+        return self.context.get_prompt()
+
+    async def choose_next_action_async(self) -> str:
+        # Building the prompt may block on a summary refresh, so keep it off the event loop.
+        request = await asyncio.to_thread(self.build_request)
+        return await self.complete_async(request)
+
+
+class MentalMapAgent(ClaudeAgent):
+    system_prompt = textwrap.dedent("""\
+        You are an expert at text-based games. You are trying to play a game, and
+        you are trying to figure out what the next best action should be based on
+        context you are given. You will always be given a list of valid actions.
+        YOUR GOAL IS TO MAXIMIZE YOUR SCORE.
+        EXPLORING MORE REWARDING AREAS MIGHT HELP THAN LOOPING AROUND UNREWARDING AREAS.
+
+        Begin your response re-iterate mental map and update last mental map if needed.
+        then, output a few sentences of thinking through your choices.
+        Then output two
+        newlines and then the exact text of your chosen action. Write nothing
+        after outputing your chosen action. It should be the
+        only text on the final line. Do not guess at actions you think should be
+        possible. Only choose an action on the latest list.
+
+        FOLLOW THIS FORMAT STRICTLY:
+        ---------
+        Mental Map:
+            - Nodes:
+            - Current Location: Room A
+            - Interactions:
+                - Explored east (Room B)
+                - Found a locked door in Room B
+            - Objects:
+                - Box in Room A
+            - Edges:
+            - (Current Location: Room A) -- (Explored east) --> (Room B)
+            - (Room B) -- (Found) --> (Locked Door)
+            - (Current Location: Room A) -- (Contains) --> (Box)
+        -------
+        Thinking: Based on the mental map, I have explored Room B to the east and found a locked door. Since I'm back in Room A and there is a box here, I will search the box for a potential key to unlock the door in Room B.
+        
+        NEXT BEST ACTION FROM VALID NEXT ACTIONS:
+        open box""")
+
+    model = "claude-3-haiku-20240307"
+    # model = "claude-3-sonnet-20240229"
+    # model = "claude-3-opus-20240229"
+
+    def get_prompt(self) -> str:
+        return self.history.get_latest_history_entry()
+
+
+class MentalMapAgentB(ClaudeAgent):
+    system_prompt = textwrap.dedent("""\
+        You are an expert AI agent navigating a text-based game environment. Your goal is to maximize your
+        score by making strategic decisions based on the information provided to you.
+
+        You are given the current observation of the game state and the list of valid actions you can take.
+        You also have access to your mental map and your reasoning process from last action.
+        
+        Begin by analyzing the current game state and updating your mental map of the environment in the
+        following format:
+
+        <mental_map>
+        Mental Map:
+        - Nodes:
+        - Current Location: [Room/Area]
+        - [Other Rooms/Areas]
+        - Interactions:
+        - [Interaction 1]
+        - [Interaction 2]
+        - ...
+        - Objects:
+        - [Object 1]
+        - [Object 2]
+        - ...
+        - Edges:
+        - (Current Location) -- [Interaction/Connection] --> [Connected Room/Area]
+        - [Room/Area 1] -- [Interaction/Connection] --> [Room/Area 2]
+        - ...
+        </mental_map>
+
+        Next, think through potential strategies and evaluate the best next action. Consider factors such
+        as:
+        - Exploring new areas that may lead to higher rewards
+        - Investigating objects or interactions that could provide useful items or information
+        - Avoiding actions that may lead to negative consequences or looping behavior
+
+        Write your thought process inside <strategy_thinking> tags.
+
+        Do not guess at actions you think should be possible. Only choose an action from the latest list of
+        valid actions.
+
+        Remember, your ultimate goal is to MAXIMIZE YOUR SCORE by making strategic decisions and exploring
+        rewarding areas of the game environment.
+        Finally, choose the next best action from the list of valid actions. Output your chosen action in
+        the following strict format:
+                             
+        NEXT BEST ACTION FROM VALID NEXT ACTIONS:
+        open box""")
+
+    model = "claude-3-haiku-20240307"
+    # model = "claude-3-sonnet-20240229"
+    # model = "claude-3-opus-20240229"
+
+    stream_response = True
+    action_marker = "NEXT BEST ACTION FROM VALID NEXT ACTIONS:"
+
+    def get_prompt(self) -> str:
+        return self.history.get_latest_history_entry()
+
+
+class StructuredMapAgent(ClaudeAgent):
+    """
+    Like MentalMapAgentB, but the mental map is kept as a graph in code and sent to the model in
+    compact form, so the model only writes a short note and the action instead of the whole map.
+    """
+
+    system_prompt = textwrap.dedent("""\
+        You are an expert AI agent navigating a text-based game environment. Your goal is to maximize your
+        score by making strategic decisions based on the information provided to you.
+
+        You are given your mental map of the places you have been, which is kept up to date for you,
+        followed by the latest observation and the list of valid actions. Each room in the map lists
+        its known exits, exits you haven't tried yet, the objects in it, what you have already done
+        there and any notes you left.
+
+        Do not rewrite the mental map. If you learned something it can't capture, such as a locked
+        door or a clue, add at most one line starting with NOTE:. Then think through your options in
+        at most two sentences, preferring unexplored exits and untried interactions over looping
+        around areas you have already covered.
+
+        Do not guess at actions you think should be possible. Only choose an action from the latest list of
+        valid actions. Output your chosen action in the following strict format:
+
+        NEXT BEST ACTION FROM VALID NEXT ACTIONS:
+        open box""")
+
+    model = "claude-3-haiku-20240307"
+    # model = "claude-3-sonnet-20240229"
+    # model = "claude-3-opus-20240229"
+
+    max_tokens = 300
+    stream_response = True
+    action_marker = "NEXT BEST ACTION FROM VALID NEXT ACTIONS:"
+    checkpoint_attributes = (*ClaudeAgent.checkpoint_attributes, "mental_map")
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.mental_map = MentalMap()
+        self.env = None
+
+    def attach_env(self, env) -> None:
+        self.env = env
+
+    def get_prompt(self) -> str:
+        return (
+            f"MENTAL MAP:\n{self.mental_map.serialize()}\n{self.history.get_latest_history_entry()}"
+        )
+
+    def handle_response(self, text: str, usage) -> str | None:
+        for line in text.splitlines():
+            if line.strip().startswith("NOTE:"):
+                self.mental_map.add_note(line.strip().removeprefix("NOTE:").strip())
+        return super().handle_response(text, usage)
 
     def show_state(
         self,
@@ -330,99 +837,77 @@ class MentalMapAgent(AgentInterface):
         score: int,
         valid_actions: list[str],
     ) -> None:
-        self.history.update_history(
+        super().show_state(chosen_action, observation, reward, score, valid_actions)
+        if self.env is None:
+            raise RuntimeError("StructuredMapAgent needs attach_env(env) before the first move")
+
+        location = self.env.get_player_location()
+        self.mental_map.update(
+            location=location.num,
+            location_name=location.name,
+            objects=room_objects(self.env, location),
             chosen_action=chosen_action,
             observation=observation,
             reward=reward,
-            score=score,
-            next_valid_actions=valid_actions,
-        )
-        self.history.export_history_to_file("history.txt")
-        self.last_valid_actions = valid_actions
-
-
-class MentalMapAgentB(AgentInterface):
-    def __init__(self):
-        self.history = History(system_message="")
-        self.anthropic_client = anthropic.Anthropic()
-        self.last_valid_actions = []
-
-    def choose_next_action(self) -> str:
-        system = textwrap.dedent("""\
-            You are an expert AI agent navigating a text-based game environment. Your goal is to maximize your
-            score by making strategic decisions based on the information provided to you.
-
-            You are given the current observation of the game state and the list of valid actions you can take.
-            You also have access to your mental map and your reasoning process from last action.
-            
-            Begin by analyzing the current game state and updating your mental map of the environment in the
-            following format:
-
-            <mental_map>
-            Mental Map:
-            - Nodes:
-            - Current Location: [Room/Area]
-            - [Other Rooms/Areas]
-            - Interactions:
-            - [Interaction 1]
-            - [Interaction 2]
-            - ...
-            - Objects:
-            - [Object 1]
-            - [Object 2]
-            - ...
-            - Edges:
-            - (Current Location) -- [Interaction/Connection] --> [Connected Room/Area]
-            - [Room/Area 1] -- [Interaction/Connection] --> [Room/Area 2]
-            - ...
-            </mental_map>
-
-            Next, think through potential strategies and evaluate the best next action. Consider factors such
-            as:
-            - Exploring new areas that may lead to higher rewards
-            - Investigating objects or interactions that could provide useful items or information
-            - Avoiding actions that may lead to negative consequences or looping behavior
-
-            Write your thought process inside <strategy_thinking> tags.
-
-            Do not guess at actions you think should be possible. Only choose an action from the latest list of
-            valid actions.
-
-            Remember, your ultimate goal is to MAXIMIZE YOUR SCORE by making strategic decisions and exploring
-            rewarding areas of the game environment.
-            Finally, choose the next best action from the list of valid actions. Output your chosen action in
-            the following strict format:
-                                 
-            NEXT BEST ACTION FROM VALID NEXT ACTIONS:
-            open box""")
-
-        model = "claude-3-haiku-20240307"
-        # model = "claude-3-sonnet-20240229"
-        # model = "claude-3-opus-20240229"
-
-        response = self.anthropic_client.messages.create(
-            system=system,
-            model=model,
-            messages=[
-                {"role": "user", "content": self.history.get_latest_history_entry()}
-            ],
-            max_tokens=1000,
+            valid_actions=valid_actions,
         )
 
-        text = response.content[0].text
-        input_tokens = response.usage.input_tokens
-        output_tokens = response.usage.output_tokens
-        cprint(f"Input and Output tokens: {input_tokens} {output_tokens}", "yellow")
 
-        self.history.update_history_with_string(text)
-        cprint(text, "light_blue")
-        action = text.splitlines()[-1].strip()
+class SearchAgent(AgentWrapper):
+    """
+    Looks a few plies ahead from emulator snapshots and takes the move itself when one action is
+    clearly best, handing the decision to a fallback (usually LLM) agent otherwise.
+    """
 
-        if action not in self.last_valid_actions:
-            cprint(f"Invalid action: {action}", "red")
-            return random.choice(self.last_valid_actions)
+    # The fallback is the wrapped agent, whose state AgentWrapper saves alongside these.
+    checkpoint_attributes = (
+        *AgentWrapper.checkpoint_attributes,
+        "valid_actions",
+        "visited_hashes",
+        "transposition_table",
+        "search_moves",
+        "fallback_moves",
+    )
 
-        return action
+    def __init__(
+        self,
+        fallback: AgentInterface,
+        plies: int = 2,
+        node_budget: int = 200,
+        workers: int | None = None,
+        novelty_weight: float = 0.5,
+        obvious_margin: float = 1.0,
+    ):
+        """
+        :param fallback: Agent consulted when no action is clearly best.
+        :param plies: Search depth in moves, including the move being chosen.
+        :param node_budget: Nodes the workers may expand per move, shared among the root actions.
+        :param workers: Size of the rollout process pool.
+        :param novelty_weight: Bonus for actions leading to world states not yet seen this game.
+        :param obvious_margin: How far the best action must score above the runner-up to be
+            taken without asking the fallback.
+        """
+        super().__init__(fallback)
+        self.fallback = fallback
+        self.plies = plies
+        self.node_budget = node_budget
+        self.workers = workers
+        self.novelty_weight = novelty_weight
+        self.obvious_margin = obvious_margin
+        self.env = None
+        self.pool = None
+        self.valid_actions = []
+        self.visited_hashes = set()
+        # World-state hash -> (best future reward, depth searched), shared across moves.
+        self.transposition_table: dict[str, tuple[float, int]] = {}
+        self.search_moves = 0
+        self.fallback_moves = 0
+
+    def attach_env(self, env) -> None:
+        super().attach_env(env)
+        self.env = env
+        if self.pool is None and self.plies > 1:
+            self.pool = RolloutPool(env.story_file.decode(), workers=self.workers)
 
     def show_state(
         self,
@@ -432,13 +917,91 @@ class MentalMapAgentB(AgentInterface):
         score: int,
         valid_actions: list[str],
     ) -> None:
-        self.history.update_history(
-            chosen_action=chosen_action,
-            observation=observation,
-            reward=reward,
-            score=score,
-            next_valid_actions=valid_actions,
-        )
-        self.history.export_history_to_file("history.txt")
-        self.last_valid_actions = valid_actions
+        self.valid_actions = valid_actions
+        self.visited_hashes.add(self.env.get_world_state_hash())
+        self.fallback.show_state(chosen_action, observation, reward, score, valid_actions)
+
+    def expand_root(self) -> list[dict]:
+        """
+        Steps every valid action once from the current state, which is cheap compared to
+        generating valid actions, and restores the state afterwards.
+        """
+        root_state = self.env.get_state()
+        root_hash = self.env.get_world_state_hash()
+        branches = []
+        for action in self.valid_actions:
+            self.env.set_state(root_state)
+            _, reward, done, _ = self.env.step(action)
+            state_hash = self.env.get_world_state_hash()
+            branches.append(
+                {
+                    "action": action,
+                    "value": step_value(self.env, reward, done),
+                    "dead": done and not self.env.victory(),
+                    "done": done,
+                    "hash": state_hash,
+                    "state": self.env.get_state(),
+                    "novel": state_hash not in self.visited_hashes and state_hash != root_hash,
+                }
+            )
+        self.env.set_state(root_state)
+        return branches
+
+    def search(self) -> list[dict]:
+        branches = self.expand_root()
+        depth = self.plies - 1
+
+        to_search = {}
+        if depth > 0:
+            for branch in branches:
+                cached = self.transposition_table.get(branch["hash"])
+                if not branch["done"] and (cached is None or cached[1] < depth):
+                    to_search.setdefault(branch["hash"], branch["state"])
+
+        future_values = {}
+        if to_search:
+            budget = max(1, self.node_budget // len(to_search))
+            futures = {
+                state_hash: self.pool.submit(state, depth, budget)
+                for state_hash, state in to_search.items()
+            }
+            for state_hash, future in futures.items():
+                value, _, complete = future.result()
+                future_values[state_hash] = value
+                # Partial results are the best estimate for this move but aren't reused.
+                if complete:
+                    self.transposition_table[state_hash] = (value, depth)
+
+        for branch in branches:
+            if not branch["done"] and depth > 0:
+                if branch["hash"] in future_values:
+                    branch["value"] += future_values[branch["hash"]]
+                else:
+                    branch["value"] += self.transposition_table[branch["hash"]][0]
+            if branch["novel"]:
+                branch["value"] += self.novelty_weight
+        return branches
+
+    def choose_next_action(self) -> str:
+        branches = sorted(self.search(), key=lambda branch: -branch["value"])
+        safe = [branch for branch in branches if not branch["dead"]]
+
+        if len(safe) == 1 or (
+            len(safe) > 1 and safe[0]["value"] - safe[1]["value"] >= self.obvious_margin
+        ):
+            self.search_moves += 1
+            console.move(f"Search chose: {safe[0]['action']} ({safe[0]['value']:.1f})", "yellow")
+            return safe[0]["action"]
+
+        self.fallback_moves += 1
+        action = self.fallback.choose_next_action()
+        if safe and action in {branch["action"] for branch in branches if branch["dead"]}:
+            console.move(f"Search vetoed deadly action: {action}", "red")
+            return safe[0]["action"]
+        return action
 
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        super().close()
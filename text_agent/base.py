@@ -0,0 +1,317 @@
+import asyncio
+import random
+from abc import ABC, abstractmethod
+
+from utils.console import console
+from utils.tracing import tracer
+from utils.transitions import TransitionTable
+
+
+class AgentInterface(ABC):
+    # Running token totals, updated by agents that call a model.
+    input_tokens = 0
+    output_tokens = 0
+    cache_write_tokens = 0
+    cache_read_tokens = 0
+    # Model answers that weren't a valid action as written, whether or not they were recovered.
+    invalid_actions = 0
+    # Model cascade of agents that pick a model per call, for reporting.
+    cascade = None
+    # Attributes saved in checkpoints. Values with get_state and restore_state methods are saved
+    # through those, everything else is pickled as is.
+    checkpoint_attributes = (
+        "input_tokens",
+        "output_tokens",
+        "cache_write_tokens",
+        "cache_read_tokens",
+        "invalid_actions",
+    )
+
+    @abstractmethod
+    def show_state(
+        chosen_action: str, observation: str, reward: int, score: int, valid_actions: list[str]
+    ) -> None: ...
+
+    @abstractmethod
+    def choose_next_action(self) -> str: ...
+
+    def attach_env(self, env) -> None:
+        """
+        Called with the game's FrotzEnv before the first move, for agents that read the emulator
+        directly rather than only the observation text.
+        """
+
+    async def choose_next_action_async(self) -> str:
+        """
+        Agents that call a model override this to await an async client. Everything else runs
+        its synchronous choose_next_action in a thread so it doesn't block the event loop.
+        """
+        return await asyncio.to_thread(self.choose_next_action)
+
+    def close(self) -> None:
+        """
+        Called once the game is over, for agents holding resources such as worker processes.
+        """
+
+    def checkpoint_name(self) -> str:
+        """
+        Identifies the kind of agent a checkpoint belongs to.
+        """
+        return type(self).__name__
+
+    def get_checkpoint_state(self) -> dict:
+        """
+        The agent's memory, so that a restarted game can carry on where it was checkpointed.
+        """
+        state = {}
+        for name in self.checkpoint_attributes:
+            value = getattr(self, name)
+            state[name] = value.get_state() if hasattr(value, "restore_state") else value
+        return state
+
+    def restore_checkpoint_state(self, state: dict) -> None:
+        for name, value in state.items():
+            current = getattr(self, name, None)
+            if hasattr(current, "restore_state"):
+                # None is what a run without the attribute (e.g. no model cascade) saved.
+                if value is not None:
+                    current.restore_state(value)
+            else:
+                setattr(self, name, value)
+
+    def record_usage(self, usage, label: str = "Input and Output tokens"):
+        cache_write_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+        cache_read_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+        self.input_tokens += usage.input_tokens
+        self.output_tokens += usage.output_tokens
+        self.cache_write_tokens += cache_write_tokens
+        self.cache_read_tokens += cache_read_tokens
+        tracer.count("tokens.input", usage.input_tokens)
+        tracer.count("tokens.output", usage.output_tokens)
+        tracer.count("tokens.cache_write", cache_write_tokens)
+        tracer.count("tokens.cache_read", cache_read_tokens)
+        console.event(
+            "usage",
+            label=label,
+            input_tokens=usage.input_tokens,
+            output_tokens=usage.output_tokens,
+            cache_write_tokens=cache_write_tokens,
+            cache_read_tokens=cache_read_tokens,
+        )
+        console.move(
+            f"{label}: {usage.input_tokens} {usage.output_tokens} "
+            f"(Cache write and read tokens: {cache_write_tokens} {cache_read_tokens})",
+            "yellow",
+        )
+
+
+class AsyncAgentInterface(ABC):
+    @abstractmethod
+    def show_state(
+        chosen_action: str, observation: str, reward: int, score: int, valid_actions: list[str]
+    ) -> None: ...
+
+    @abstractmethod
+    async def choose_next_action(self) -> str: ...
+
+    def attach_env(self, env) -> None:
+        """
+        See AgentInterface.attach_env.
+        """
+
+    def close(self) -> None:
+        """
+        See AgentInterface.close.
+        """
+
+
+class AsyncAgent(AsyncAgentInterface):
+    def __init__(self, agent: AgentInterface):
+        """
+        Exposes any agent through the async interface so many games can share one event loop.
+        """
+        self.agent = agent
+
+    @property
+    def input_tokens(self) -> int:
+        return self.agent.input_tokens
+
+    @property
+    def output_tokens(self) -> int:
+        return self.agent.output_tokens
+
+    @property
+    def invalid_actions(self) -> int:
+        return self.agent.invalid_actions
+
+    @property
+    def cascade(self):
+        return self.agent.cascade
+
+    def show_state(
+        self,
+        chosen_action: str,
+        observation: str,
+        reward: int,
+        score: int,
+        valid_actions: list[str],
+    ) -> None:
+        self.agent.show_state(chosen_action, observation, reward, score, valid_actions)
+
+    def attach_env(self, env) -> None:
+        self.agent.attach_env(env)
+
+    def close(self) -> None:
+        self.agent.close()
+
+    def checkpoint_name(self) -> str:
+        return self.agent.checkpoint_name()
+
+    def get_checkpoint_state(self) -> dict:
+        return self.agent.get_checkpoint_state()
+
+    def restore_checkpoint_state(self, state: dict) -> None:
+        self.agent.restore_checkpoint_state(state)
+
+    async def choose_next_action(self) -> str:
+        return await self.agent.choose_next_action_async()
+
+
+class RandomAgent(AgentInterface):
+    checkpoint_attributes = (*AgentInterface.checkpoint_attributes, "valid_actions")
+
+    def __init__(self):
+        self.valid_actions = []
+
+    def show_state(
+        self,
+        chosen_action: str,
+        observation: str,
+        reward: int,
+        score: int,
+        valid_actions: list[str],
+    ) -> None:
+        self.valid_actions = valid_actions
+
+    def choose_next_action(self) -> str:
+        return random.choice(self.valid_actions)
+
+
+class HumanAgent(AgentInterface):
+    def show_state(
+        self,
+        chosen_action: str,
+        observation: str,
+        reward: int,
+        score: int,
+        valid_actions: list[str],
+    ) -> None:
+        pass
+
+    def choose_next_action(
+        self,
+    ) -> str:
+        return input("Enter your action: ")
+
+
+class AgentWrapper(AgentInterface):
+    """
+    Base class for agents that decide some moves themselves and delegate the rest to another
+    agent, which is still shown every state so its history stays complete.
+    """
+
+    def __init__(self, inner: AgentInterface):
+        self.inner = inner
+
+    @property
+    def input_tokens(self) -> int:
+        return self.inner.input_tokens
+
+    @property
+    def output_tokens(self) -> int:
+        return self.inner.output_tokens
+
+    @property
+    def invalid_actions(self) -> int:
+        return self.inner.invalid_actions
+
+    @property
+    def cascade(self):
+        return self.inner.cascade
+
+    # The token counters live on the inner agent, which checkpoints them itself.
+    checkpoint_attributes = ()
+
+    def attach_env(self, env) -> None:
+        self.inner.attach_env(env)
+
+    def close(self) -> None:
+        self.inner.close()
+
+    def get_checkpoint_state(self) -> dict:
+        return {**super().get_checkpoint_state(), "inner": self.inner.get_checkpoint_state()}
+
+    def restore_checkpoint_state(self, state: dict) -> None:
+        state = dict(state)
+        self.inner.restore_checkpoint_state(state.pop("inner"))
+        super().restore_checkpoint_state(state)
+
+
+class MemoAgent(AgentWrapper):
+    """
+    Remembers the outcome of every (world state, action) pair. When the agent is in a state it
+    has fully explored, or keeps coming back to, it walks the shortest known route to a state with
+    untried actions instead of calling the wrapped agent.
+    """
+
+    checkpoint_attributes = ("table", "state_hash", "route", "skipped_calls")
+
+    def __init__(self, inner: AgentInterface, loop_threshold: int = 3):
+        """
+        :param loop_threshold: Visits to the same world state after which it counts as a loop.
+        """
+        super().__init__(inner)
+        self.loop_threshold = loop_threshold
+        self.table = TransitionTable()
+        self.env = None
+        self.state_hash = None
+        self.route: list[str] = []
+        self.skipped_calls = 0
+
+    def attach_env(self, env) -> None:
+        super().attach_env(env)
+        self.env = env
+
+    def show_state(
+        self,
+        chosen_action: str,
+        observation: str,
+        reward: int,
+        score: int,
+        valid_actions: list[str],
+    ) -> None:
+        state_hash = self.env.get_world_state_hash()
+        if self.state_hash is not None:
+            expected = self.table.lookup(self.state_hash, chosen_action)
+            if expected is not None and expected.next_hash != state_hash:
+                # The game didn't behave as it did last time (randomness), so replan.
+                self.route = []
+            self.table.record(self.state_hash, chosen_action, state_hash, reward, observation)
+        self.table.visit(state_hash, valid_actions)
+        self.state_hash = state_hash
+        self.inner.show_state(chosen_action, observation, reward, score, valid_actions)
+
+    def choose_next_action(self) -> str:
+        explored = not self.table.untried_actions(self.state_hash)
+        looping = self.table.visits[self.state_hash] >= self.loop_threshold
+        if not self.route and (explored or looping):
+            self.route = self.table.route_to_frontier(self.state_hash) or []
+
+        if self.route:
+            self.skipped_calls += 1
+            tracer.count("memo.skipped_calls")
+            action = self.route.pop(0)
+            console.move(f"Memo route: {action} ({len(self.route)} more)", "yellow")
+            return action
+
+        return self.inner.choose_next_action()
@@ -0,0 +1,24 @@
+import importlib
+
+# Agent type -> "module:class". Modules are imported the first time an agent of that type is
+# made, so agents that never call a model don't pay for importing the anthropic SDK.
+AGENT_CLASSES = {
+    "human": "text_agent.base:HumanAgent",
+    "random": "text_agent.base:RandomAgent",
+    "raw-history": "text_agent.agents:RawHistoryAgent",
+    "summary": "text_agent.agents:SummaryAgent",
+    "thinking": "text_agent.agents:ThinkingAgent",
+    "mentalmap": "text_agent.agents:MentalMapAgent",
+    "agentb": "text_agent.agents:MentalMapAgentB",
+    "structuredmap": "text_agent.agents:StructuredMapAgent",
+    "search": "text_agent.agents:SearchAgent",
+}
+# Agents that take no model arguments.
+OFFLINE_AGENTS = ("human", "random")
+
+
+def load_agent_class(agent_type: str) -> type:
+    if agent_type not in AGENT_CLASSES:
+        raise ValueError("Invalid agent type")
+    module_name, class_name = AGENT_CLASSES[agent_type].split(":")
+    return getattr(importlib.import_module(module_name), class_name)
@@ -0,0 +1,77 @@
+import re
+from collections import defaultdict
+
+# Markdown, quotes and trailing punctuation models wrap actions in, and prefixes they put before
+# them, e.g. "**Action:** `open mailbox`."
+STRIP_PATTERN = re.compile(r"[`*_\"'.!?,;:()\[\]<>]")
+PREFIX_PATTERN = re.compile(
+    r"^(?:>\s*|(?:next\s+)?(?:best\s+)?action\s*[:\-]\s*|\d+[.)]\s+)", re.IGNORECASE
+)
+
+
+def normalize(text: str) -> str:
+    text = PREFIX_PATTERN.sub("", text.strip())
+    return " ".join(STRIP_PATTERN.sub(" ", text.lower()).split())
+
+
+class ActionMatcher:
+    def __init__(self, valid_actions: list[str], min_overlap: float = 0.5):
+        """
+        Maps a model's free-form answer onto the valid action it most likely meant, using an index
+        built once per game state.
+        :param min_overlap: Lowest token overlap (intersection over union) a fuzzy match needs.
+        """
+        self.valid_actions = valid_actions
+        self.min_overlap = min_overlap
+        self.exact = {action: action for action in valid_actions}
+        self.normalized = {normalize(action): action for action in valid_actions}
+        self.tokens = [set(normalize(action).split()) for action in valid_actions]
+        self.by_token: dict[str, list[int]] = defaultdict(list)
+        for index, tokens in enumerate(self.tokens):
+            for token in tokens:
+                self.by_token[token].append(index)
+
+    def match(self, answer: str) -> str | None:
+        """
+        The valid action the answer names, or None if no single action is a close enough match.
+        """
+        answer = answer.strip()
+        if answer in self.exact:
+            return self.exact[answer]
+        normalized = normalize(answer)
+        if normalized in self.normalized:
+            return self.normalized[normalized]
+
+        tokens = set(normalized.split())
+        shared = defaultdict(int)
+        for token in tokens:
+            for index in self.by_token.get(token, ()):
+                shared[index] += 1
+
+        best, best_score, tied = None, 0.0, False
+        for index, overlap in shared.items():
+            score = overlap / len(tokens | self.tokens[index])
+            if score > best_score:
+                best, best_score, tied = index, score, False
+            elif score == best_score:
+                tied = True
+        if best is None or tied or best_score < self.min_overlap:
+            return None
+        return self.valid_actions[best]
+
+    def match_completion(self, text: str) -> str | None:
+        """
+        Matches the last line of a completion, then falls back to any earlier line that is
+        exactly an action, for models that add a remark after their answer.
+        """
+        lines = [line for line in text.splitlines() if line.strip()]
+        if not lines:
+            return None
+        action = self.match(lines[-1])
+        if action is not None:
+            return action
+        for line in reversed(lines[:-1]):
+            action = self.normalized.get(normalize(line))
+            if action is not None:
+                return action
+        return None
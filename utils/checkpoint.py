@@ -0,0 +1,54 @@
+import os
+import pickle
+import random
+import zlib
+
+CHECKPOINT_VERSION = 4
+
+
+def save_checkpoint(path: str, env, agent, **game_state):
+    """
+    Writes everything needed to carry on a game from the end of the current move: the emulator
+    state, the game loop's variables and the agent's memory, pickled and zlib-compressed.
+    :param game_state: The game loop's variables, returned again by load_checkpoint.
+    """
+    checkpoint = {
+        "version": CHECKPOINT_VERSION,
+        "agent_class": agent.checkpoint_name(),
+        "env_state": env.get_state(),
+        "random_state": random.getstate(),
+        "game": game_state,
+        "agent": agent.get_checkpoint_state(),
+    }
+    data = zlib.compress(pickle.dumps(checkpoint, protocol=pickle.HIGHEST_PROTOCOL))
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file first so a crash while saving leaves the previous checkpoint.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: str, env, agent) -> dict:
+    """
+    Restores the emulator and the agent from a checkpoint. The env must already be loaded with
+    the same game, and the agent must be of the same type as the one that was saved.
+    :return: The game loop's variables as passed to save_checkpoint.
+    """
+    with open(path, "rb") as f:
+        checkpoint = pickle.loads(zlib.decompress(f.read()))
+    if checkpoint["version"] != CHECKPOINT_VERSION:
+        raise ValueError(f"Checkpoint {path} has version {checkpoint['version']}")
+    if checkpoint["agent_class"] != agent.checkpoint_name():
+        raise ValueError(
+            f"Checkpoint {path} was written by a {checkpoint['agent_class']}, "
+            f"not a {agent.checkpoint_name()}"
+        )
+
+    env.set_state(checkpoint["env_state"])
+    random.setstate(checkpoint["random_state"])
+    agent.restore_checkpoint_state(checkpoint["agent"])
+    return checkpoint["game"]
@@ -0,0 +1,92 @@
+import json
+import queue
+import sys
+import threading
+
+from termcolor import cprint
+
+VERBOSITIES = ("full", "summary", "log", "silent")
+
+
+class BackgroundWriter:
+    def __init__(self, file):
+        """
+        Writes lines to a file from a background thread so the game loop never waits on I/O.
+        """
+        self.file = file
+        self.queue: queue.Queue[str | None] = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, text: str):
+        self.queue.put(text)
+
+    def run(self):
+        while (text := self.queue.get()) is not None:
+            self.file.write(text)
+            if self.queue.empty():
+                self.file.flush()
+        self.file.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class Console:
+    def __init__(self):
+        """
+        Routes the harness's console output according to a verbosity setting:
+        full prints everything as before, summary prints only end-of-run results, log writes
+        structured JSONL events instead of per-move text, and silent prints nothing. In log
+        mode end-of-run results are "summary" events too, so the stream stays parseable.
+        """
+        self.per_move = True
+        self.summaries = True
+        self.sink = None
+        self.file = None
+
+    def configure(self, verbosity: str = "full", log_path: str | None = None, log_async=False):
+        """
+        :param log_path: Where log mode writes its events. Defaults to stdout.
+        :param log_async: Write log events from a background thread.
+        """
+        if verbosity not in VERBOSITIES:
+            raise ValueError(f"Invalid verbosity {verbosity}, expected one of {VERBOSITIES}")
+        self.close()
+
+        self.per_move = verbosity == "full"
+        self.summaries = verbosity in ("full", "summary")
+        if verbosity == "log":
+            if log_path is not None:
+                # Stays open for the whole run. close() or the next configure() closes it.
+                self.file = open(log_path, "w", buffering=64 * 1024)  # noqa: SIM115
+            self.sink = self.file or sys.stdout
+            if log_async:
+                self.sink = BackgroundWriter(self.sink)
+
+    def move(self, text, color: str | None = None):
+        if self.per_move:
+            cprint(text, color)
+
+    def summary(self, text, color: str | None = None):
+        if self.sink is not None:
+            self.event("summary", text=str(text))
+        elif self.summaries:
+            cprint(text, color)
+
+    def event(self, kind: str, **fields):
+        if self.sink is not None:
+            self.sink.write(json.dumps({"event": kind, **fields}) + "\n")
+
+    def close(self):
+        if isinstance(self.sink, BackgroundWriter):
+            self.sink.close()
+        if self.file is not None:
+            self.file.close()
+        self.sink = None
+        self.file = None
+
+
+# Shared by the game loop and the agents. Configured by run --verbosity.
+console = Console()
@@ -0,0 +1,109 @@
+import contextlib
+import threading
+
+from jericho import FrotzEnv
+
+
+class EnvPool:
+    def __init__(self, max_idle: int = 4):
+        """
+        Keeps emulators between games instead of building a new one per episode. An env that
+        last ran the same game is reseeded and reused (the game loop resets it). Otherwise an
+        idle env switches games with FrotzEnv.load, which only reads a ROM the first time that
+        env sees it.
+        :param max_idle: Idle envs kept. More are closed when released.
+        """
+        self.max_idle = max_idle
+        self.idle: list[FrotzEnv] = []
+        self.lock = threading.Lock()
+        self.constructed = 0
+        self.reused = 0
+        self.switched = 0
+
+    def preload(self, rom_paths: list[str]):
+        """
+        Reads every ROM, its bindings and action templates into an idle env's cache up front,
+        so switching that env between games later costs no file reads.
+        """
+        if not rom_paths:
+            return
+        env = self.acquire(rom_paths[0])
+        for rom_path in rom_paths[1:]:
+            load_game(env, rom_path)
+        self.release(env)
+
+    def acquire(self, rom_path: str, seed: int | None = None) -> FrotzEnv:
+        with self.lock:
+            env = next((e for e in self.idle if e.story_file.decode() == rom_path), None)
+            if env is None and self.idle:
+                # The least recently released env is the least likely to be wanted again.
+                env = self.idle[0]
+            if env is not None:
+                self.idle.remove(env)
+
+        if env is None:
+            self.constructed += 1
+            return FrotzEnv(rom_path, seed=seed)
+        if env.story_file.decode() == rom_path:
+            self.reused += 1
+            env.seed(seed)
+        else:
+            self.switched += 1
+            load_game(env, rom_path, seed)
+        return env
+
+    def release(self, env: FrotzEnv):
+        with self.lock:
+            self.idle.append(env)
+            if len(self.idle) <= self.max_idle:
+                return
+            env = self.idle.pop(0)
+        env.close()
+
+    @contextlib.contextmanager
+    def lease(self, rom_path: str, seed: int | None = None):
+        env = self.acquire(rom_path, seed)
+        try:
+            yield env
+        finally:
+            self.release(env)
+
+    def stats(self) -> str:
+        return (
+            f"{self.constructed} envs built, {self.reused} reused for the same game, "
+            f"{self.switched} switched games"
+        )
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for env in idle:
+            env.close()
+
+
+def load_game(env: FrotzEnv, rom_path: str, seed: int | None = None):
+    """
+    Switches an env to another game. FrotzEnv.load only checks whether a game is fully supported
+    the first time it reads the ROM, so the flag is set again here. Otherwise a supported game
+    could return no valid actions, or action generation could run on an unsupported one.
+    """
+    env.load(rom_path, seed)
+    env.is_fully_supported = bool(env.frotz_lib.is_supported(env.story_file))
+
+
+# Pool of the current process, for evaluation workers that play one episode after another.
+_process_pool: EnvPool | None = None
+
+
+def process_env_pool() -> EnvPool:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = EnvPool()
+    return _process_pool
+
+
+def init_env_pool(rom_paths: list[str]):
+    """
+    Pool initializer: preloads every ROM the worker may be asked to play.
+    """
+    process_env_pool().preload(rom_paths)
@@ -0,0 +1,164 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fire
+
+from utils.mock_llm import MockMessages
+from utils.rate_limit import TokenBucket
+
+
+class FakeAnthropicServer(ThreadingHTTPServer):
+    def __init__(
+        self,
+        port: int,
+        requests_per_minute: float,
+        overloaded_rate: float,
+        latency: float,
+        seed: int,
+    ):
+        """
+        Local stand-in for the Messages API that enforces a request rate limit the way the real
+        one does, answering 429 with a retry-after header once the limit is used up.
+        """
+        super().__init__(("127.0.0.1", port), FakeAnthropicHandler)
+        self.bucket = TokenBucket(requests_per_minute)
+        self.overloaded_rate = overloaded_rate
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.mock = MockMessages(seed=seed, chunk_size=8)
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.start_time = time.monotonic()
+
+    def admit(self) -> tuple[int, float]:
+        """
+        Returns the status to answer with and, for a 429, the seconds until a request would be
+        accepted.
+        """
+        with self.lock:
+            wait = self.bucket.wait_time(1, time.monotonic())
+            if wait > 0:
+                self.rejected += 1
+                return 429, wait
+            if self.rng.random() < self.overloaded_rate:
+                self.rejected += 1
+                return 529, 0.0
+            self.bucket.take(1)
+            self.accepted += 1
+            return 200, 0.0
+
+    def stats(self) -> str:
+        minutes = (time.monotonic() - self.start_time) / 60
+        return (
+            f"{self.accepted} accepted ({self.accepted / minutes:.1f}/min), "
+            f"{self.rejected} rejected"
+        )
+
+
+class FakeAnthropicHandler(BaseHTTPRequestHandler):
+    server: FakeAnthropicServer
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["content-length"])))
+        status, retry_after = self.server.admit()
+        if status == 429:
+            self.send_error_json(429, "rate_limit_error", retry_after)
+            return
+        if status == 529:
+            self.send_error_json(529, "overloaded_error")
+            return
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        with self.server.lock:
+            message = self.server.mock.respond(request)
+        if request.get("stream"):
+            self.send_stream(message)
+        else:
+            self.send_json(200, message.model_dump(mode="json"))
+
+    def send_json(self, status: int, body: dict, headers: dict | None = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status: int, error_type: str, retry_after: float | None = None):
+        headers = {"retry-after": f"{retry_after:.3f}"} if retry_after else {}
+        body = {"type": "error", "error": {"type": error_type, "message": error_type}}
+        self.send_json(status, body, headers)
+
+    def send_stream(self, message):
+        text = message.content[0].text
+        start = message.model_dump(mode="json")
+        start["content"] = []
+        events = [
+            ("message_start", {"message": start}),
+            ("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}}),
+            *(
+                (
+                    "content_block_delta",
+                    {"index": 0, "delta": {"type": "text_delta", "text": text[i : i + 8]}},
+                )
+                for i in range(0, len(text), 8)
+            ),
+            ("content_block_stop", {"index": 0}),
+            (
+                "message_delta",
+                {
+                    "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                    "usage": {"output_tokens": message.usage.output_tokens},
+                },
+            ),
+            ("message_stop", {}),
+        ]
+        self.send_response(200)
+        self.send_header("content-type", "text/event-stream")
+        self.end_headers()
+        try:
+            for name, data in events:
+                payload = json.dumps({"type": name, **data})
+                self.wfile.write(f"event: {name}\ndata: {payload}\n\n".encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The agents close streams as soon as they have read the action.
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(
+    port: int = 8765,
+    requests_per_minute: float = 60,
+    overloaded_rate: float = 0.0,
+    latency: float = 0.0,
+    seed: int = 0,
+):
+    """
+    Serves a fake Messages API for testing the rate limiter without an account. Point the
+    harness at it with ANTHROPIC_BASE_URL=http://127.0.0.1:8765 (any ANTHROPIC_API_KEY works).
+    :param overloaded_rate: Share of admitted requests answered with 529 overloaded instead.
+    :param latency: Seconds to wait before answering, to simulate generation time.
+    """
+    server = FakeAnthropicServer(port, requests_per_minute, overloaded_rate, latency, seed)
+    print(f"Fake Messages API on http://127.0.0.1:{port}, {requests_per_minute} requests/min")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(server.stats())
+        server.server_close()
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
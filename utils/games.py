@@ -0,0 +1,54 @@
+import os
+import re
+from collections.abc import Callable
+
+ROM_EXTENSIONS = (".z1", ".z2", ".z3", ".z4", ".z5", ".z6", ".z7", ".z8")
+# Banner lines printed before the opening room: Infocom's copyright, trademark and revision
+# lines, and the release line of Inform games.
+BANNER_LINE = re.compile(
+    r"^.*(Copyright \(c\)|registered trademark|Serial [Nn]umber|Inform v\d).*$\n?",
+    re.MULTILINE,
+)
+ZORK1_INTRO = """Copyright (c) 1981, 1982, 1983 Infocom, Inc. All rights reserved.
+ZORK is a registered trademark of Infocom, Inc.
+Revision 88 / Serial number 840726"""
+
+
+def game_name(rom_path: str) -> str:
+    return os.path.splitext(os.path.basename(rom_path))[0]
+
+
+def strip_banner(observation: str) -> str:
+    return BANNER_LINE.sub("", observation).strip()
+
+
+# Games whose intro needs more than the banner removed, by game_name.
+INTRO_CLEANERS: dict[str, Callable[[str], str]] = {
+    "zork1": lambda observation: observation.replace(ZORK1_INTRO, "").strip(),
+}
+
+
+def clean_intro(rom_path: str, observation: str) -> str:
+    """
+    Removes the game's banner from its opening observation, keeping the opening room.
+    """
+    return INTRO_CLEANERS.get(game_name(rom_path), strip_banner)(observation)
+
+
+def find_roms(roms: str | list[str]) -> list[str]:
+    """
+    :param roms: ROM paths, comma separated or as a list. A directory stands for every ROM in it.
+    """
+    if isinstance(roms, str):
+        roms = roms.split(",")
+    paths = []
+    for path in roms:
+        if os.path.isdir(path):
+            paths.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.endswith(ROM_EXTENSIONS)
+            )
+        else:
+            paths.append(path)
+    return paths
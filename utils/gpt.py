@@ -1,44 +1,417 @@
 import json
+import re
+import time
+from collections import Counter, deque
+from collections.abc import Callable
 
 import anthropic
 import instructor
 from pydantic import BaseModel
 
+from utils.llm_cache import ResponseCache
+from utils.rate_limit import RateLimiter, request_tokens, without_sdk_retries
+from utils.tracing import tracer
+
+CASCADE_MODELS = ("claude-3-haiku-20240307", "claude-3-sonnet-20240229")
+CONFIDENCE_PATTERN = re.compile(r"CONFIDENCE:\s*(\d+)")
+
+
+def confidence_instruction(action_marker: str = "") -> str:
+    """
+    Asks for a confidence line ahead of the answer. Agents that write their action on the line
+    after action_marker get it before the marker, so nothing comes between the two.
+    """
+    before = f'the line "{action_marker}"' if action_marker else "your final answer"
+    return (
+        f"Just before {before}, write a line CONFIDENCE: <0-10> saying how sure you are that "
+        "it is the best action."
+    )
+
+
+def parse_confidence(text: str) -> int | None:
+    matches = CONFIDENCE_PATTERN.findall(text)
+    return int(matches[-1]) if matches else None
+
+
+def strip_confidence(text: str) -> str:
+    """
+    The answer without the confidence lines confidence_instruction asks for.
+    """
+    return "\n".join(
+        line for line in text.splitlines() if not CONFIDENCE_PATTERN.match(line.strip())
+    ).strip()
+
+
+class ModelCascade:
+    def __init__(
+        self,
+        models: list[str] | tuple[str, ...] = CASCADE_MODELS,
+        stall_moves: int = 10,
+        loop_visits: int = 3,
+        loop_window: int = 12,
+        min_confidence: int = 5,
+    ):
+        """
+        Picks the model for each call: the first (fastest) tier unless a trigger says the move
+        needs a stronger one. Keeps per-tier call counts and latency.
+        :param models: Model names from fastest to strongest.
+        :param stall_moves: Moves without reward after which every call starts one tier up.
+        :param loop_visits: Times the same observation and valid actions must repeat within the
+            last loop_window moves for the agent to count as stuck in a loop, which also starts
+            calls one tier up.
+        :param min_confidence: Answers with a lower self-reported confidence are retried on the
+            next tier.
+        """
+        self.models = list(models)
+        self.stall_moves = stall_moves
+        self.loop_visits = loop_visits
+        self.min_confidence = min_confidence
+        self.calls = [0] * len(self.models)
+        self.latency = [0.0] * len(self.models)
+        self.escalations: Counter[str] = Counter()
+        self.recent: deque[int] = deque(maxlen=loop_window)
+        self.moves_without_reward = 0
+        self.visits = 0
+
+    @classmethod
+    def from_spec(cls, spec) -> "ModelCascade":
+        """
+        Builds a cascade from a command-line value: True for the default tiers, or model names
+        as a comma-separated string or a sequence.
+        """
+        if spec is True:
+            return cls()
+        if isinstance(spec, str):
+            spec = spec.split(",")
+        return cls([model.strip() for model in spec])
+
+    def observe(self, observation: str, reward: int, valid_actions: list[str]):
+        self.moves_without_reward = 0 if reward > 0 else self.moves_without_reward + 1
+        key = hash((observation, tuple(valid_actions)))
+        self.recent.append(key)
+        self.visits = self.recent.count(key)
+
+    def first_tier(self) -> int:
+        reason = None
+        if self.visits >= self.loop_visits:
+            reason = "loop"
+        elif self.moves_without_reward >= self.stall_moves:
+            reason = "no_reward"
+        if reason is None or len(self.models) == 1:
+            return 0
+        self.escalate(reason)
+        return 1
+
+    def next_tier(self, tier: int, valid: bool, confidence: int | None) -> int | None:
+        """
+        The tier to retry on after an answer from `tier`, or None if the answer stands.
+        """
+        if tier + 1 >= len(self.models):
+            return None
+        if not valid:
+            self.escalate("invalid_action")
+        elif confidence is not None and confidence < self.min_confidence:
+            self.escalate("low_confidence")
+        else:
+            return None
+        return tier + 1
+
+    def run(self, call, judge, on_escalate=None):
+        """
+        Calls the first tier, then each stronger tier while the answer should be retried, and
+        returns the last answer.
+        :param call: Makes the call with the given model name and returns its answer.
+        :param judge: Returns whether an answer is valid and its self-reported confidence.
+        :param on_escalate: Called with each discarded answer and the model it's retried on.
+        """
+        tier = self.first_tier()
+        while True:
+            start = time.perf_counter()
+            answer = call(self.models[tier])
+            self.record_call(tier, time.perf_counter() - start)
+            next_tier = self.next_tier(tier, *judge(answer))
+            if next_tier is None:
+                return answer
+            if on_escalate is not None:
+                on_escalate(answer, self.models[next_tier])
+            tier = next_tier
+
+    async def run_async(self, call, judge, on_escalate=None):
+        """
+        Async version of run, for a call that returns an awaitable.
+        """
+        tier = self.first_tier()
+        while True:
+            start = time.perf_counter()
+            answer = await call(self.models[tier])
+            self.record_call(tier, time.perf_counter() - start)
+            next_tier = self.next_tier(tier, *judge(answer))
+            if next_tier is None:
+                return answer
+            if on_escalate is not None:
+                on_escalate(answer, self.models[next_tier])
+            tier = next_tier
+
+    def escalate(self, reason: str):
+        self.escalations[reason] += 1
+        tracer.count(f"cascade.escalations.{reason}")
+
+    def record_call(self, tier: int, seconds: float):
+        self.calls[tier] += 1
+        self.latency[tier] += seconds
+        tracer.count(f"cascade.calls.{self.models[tier]}")
+
+    def get_state(self) -> dict:
+        return {
+            "calls": self.calls,
+            "latency": self.latency,
+            "escalations": self.escalations,
+            "recent": list(self.recent),
+            "moves_without_reward": self.moves_without_reward,
+            "visits": self.visits,
+        }
+
+    def restore_state(self, state: dict):
+        self.calls = list(state["calls"])
+        self.latency = list(state["latency"])
+        self.escalations = Counter(state["escalations"])
+        self.recent = deque(state["recent"], maxlen=self.recent.maxlen)
+        self.moves_without_reward = state["moves_without_reward"]
+        self.visits = state["visits"]
+
+    def stats(self) -> dict:
+        return {
+            "tiers": [
+                {
+                    "model": model,
+                    "calls": calls,
+                    "mean_latency": latency / calls if calls else 0.0,
+                }
+                for model, calls, latency in zip(self.models, self.calls, self.latency)
+            ],
+            "escalations": dict(self.escalations),
+        }
+
+    def summary(self) -> str:
+        lines = [f"{'model':<28} {'calls':>7} {'mean s':>8}"]
+        for tier in self.stats()["tiers"]:
+            lines.append(f"{tier['model']:<28} {tier['calls']:>7} {tier['mean_latency']:>8.2f}")
+        lines.append(f"Escalations: {dict(self.escalations)}")
+        return "\n".join(lines)
+
 
 class GPTModelManager:
     def __init__(
         self,
         system_message: str = "You're a helpful AI assistant here to navigate game environment you're in.",
+        anthropic_client: anthropic.Anthropic | None = None,
+        async_anthropic_client: anthropic.AsyncAnthropic | None = None,
+        response_cache: ResponseCache | None = None,
+        cascade: ModelCascade | None = None,
+        rate_limiter: RateLimiter | None = None,
+        priority: int = 0,
     ):
         """
         Initializes a new instance of the GPTModelManager.
         :param use_local: Determines whether to use a local model or an OpenAI model.
+        :param anthropic_client: Client to wrap. A new one is created if not given.
+        :param async_anthropic_client: Async client used by get_response_async, typically shared
+            by every game running on the same event loop.
+        :param response_cache: Optional cache of responses keyed on the full request.
+        :param cascade: Model tiers used by get_cascaded_response and its async version.
+        :param rate_limiter: Scheduler that queues and retries every model call.
+        :param priority: This manager's place in the rate limiter's queue, lower first.
         """
         self.client = None
-        self.initialize_client()
+        self.async_client = None
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+        self.initialize_client(anthropic_client, async_anthropic_client)
         self.system_message = system_message
+        self.response_cache = response_cache
+        self.cascade = cascade
+        # Usage of the last model call, or None if it was served from the cache.
+        self.last_usage = None
 
-    def initialize_client(self):
+    def initialize_client(
+        self,
+        anthropic_client: anthropic.Anthropic | None = None,
+        async_anthropic_client: anthropic.AsyncAnthropic | None = None,
+    ):
         """
         Initializes the GPT client based on the configuration.
         """
-        self.client = instructor.from_anthropic(anthropic.Anthropic())
+        anthropic_client = anthropic_client or anthropic.Anthropic()
+        if self.rate_limiter is not None:
+            anthropic_client = without_sdk_retries(anthropic_client)
+            if async_anthropic_client is not None:
+                async_anthropic_client = without_sdk_retries(async_anthropic_client)
+        self.client = instructor.from_anthropic(anthropic_client)
+        if async_anthropic_client is not None:
+            self.async_client = instructor.from_anthropic(async_anthropic_client)
 
     def get_response(
-        self, prompt: str, response_model: BaseModel, model: str = "claude-3-sonnet-20240229"
+        self,
+        prompt: str | list[dict],
+        response_model: BaseModel,
+        model: str = "claude-3-sonnet-20240229",
     ) -> str:
         """
         Gets a response from the GPT model.
-        :param prompt: The prompt to send to the GPT model.
+        :param prompt: The prompt to send to the GPT model, either as text or as content blocks
+            (e.g. with prompt-cache breakpoints).
         :return: The response from the GPT model.
         """
-        response = self.client.messages.create(
-            model=model,
-            max_tokens=100,
-            messages=[
-                {"role": "system", "content": self.system_message},
-                {"role": "user", "content": prompt},
-            ],
-            response_model=response_model,
-        )
+        self.last_usage = None
+        cache_key = self.get_cache_key(prompt, response_model, model)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return self.deserialize_response(cached, response_model)
+
+        request = {
+            "model": model,
+            "max_tokens": 100,
+            "messages": self.build_messages(prompt),
+            "response_model": response_model,
+        }
+        if self.rate_limiter is not None:
+            response, completion = self.rate_limiter.call(
+                lambda: self.client.messages.create_with_completion(**request),
+                request_tokens(request),
+                self.priority,
+            )
+        else:
+            response, completion = self.client.messages.create_with_completion(**request)
+        self.last_usage = completion.usage
+
+        if cache_key is not None:
+            self.response_cache.put(cache_key, self.serialize_response(response))
+        return response
+
+    async def get_response_async(
+        self,
+        prompt: str | list[dict],
+        response_model: BaseModel,
+        model: str = "claude-3-sonnet-20240229",
+    ) -> str:
+        """
+        Async version of get_response.
+        """
+        self.last_usage = None
+        cache_key = self.get_cache_key(prompt, response_model, model)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return self.deserialize_response(cached, response_model)
+
+        if self.async_client is None:
+            async_anthropic_client = anthropic.AsyncAnthropic()
+            if self.rate_limiter is not None:
+                async_anthropic_client = without_sdk_retries(async_anthropic_client)
+            self.async_client = instructor.from_anthropic(async_anthropic_client)
+
+        request = {
+            "model": model,
+            "max_tokens": 100,
+            "messages": self.build_messages(prompt),
+            "response_model": response_model,
+        }
+        if self.rate_limiter is not None:
+            response, completion = await self.rate_limiter.call_async(
+                lambda: self.async_client.messages.create_with_completion(**request),
+                request_tokens(request),
+                self.priority,
+            )
+        else:
+            response, completion = await self.async_client.messages.create_with_completion(
+                **request
+            )
+        self.last_usage = completion.usage
+
+        if cache_key is not None:
+            self.response_cache.put(cache_key, self.serialize_response(response))
         return response
+
+    def get_cascaded_response(
+        self,
+        prompt: str | list[dict],
+        response_model: BaseModel,
+        is_valid: Callable[[object], bool],
+        on_usage: Callable[[object], None] | None = None,
+    ):
+        """
+        Asks the cascade's first tier and moves up a tier while the answer fails is_valid or
+        reports low confidence.
+        :param on_usage: Called with the usage of every model call, including discarded ones.
+        """
+
+        def judge(response) -> tuple[bool, int | None]:
+            return is_valid(response), parse_confidence(str(response))
+
+        def call(model: str):
+            response = self.get_response(prompt, response_model, model=model)
+            if on_usage is not None and self.last_usage is not None:
+                on_usage(self.last_usage)
+            return response
+
+        return self.cascade.run(call, judge)
+
+    async def get_cascaded_response_async(
+        self,
+        prompt: str | list[dict],
+        response_model: BaseModel,
+        is_valid: Callable[[object], bool],
+        on_usage: Callable[[object], None] | None = None,
+    ):
+        """
+        Async version of get_cascaded_response.
+        """
+
+        def judge(response) -> tuple[bool, int | None]:
+            return is_valid(response), parse_confidence(str(response))
+
+        async def call(model: str):
+            response = await self.get_response_async(prompt, response_model, model=model)
+            if on_usage is not None and self.last_usage is not None:
+                on_usage(self.last_usage)
+            return response
+
+        return await self.cascade.run_async(call, judge)
+
+    def build_messages(self, prompt: str | list[dict]) -> list[dict]:
+        # The system message is the same on every call, so mark it for prompt caching.
+        system = {
+            "type": "text",
+            "text": self.system_message,
+            "cache_control": {"type": "ephemeral"},
+        }
+        return [
+            {"role": "system", "content": [system]},
+            {"role": "user", "content": prompt},
+        ]
+
+    def get_cache_key(self, prompt: str | list[dict], response_model, model: str) -> str | None:
+        if self.response_cache is None:
+            return None
+        return self.response_cache.make_key(
+            {
+                "model": model,
+                "system": self.system_message,
+                "messages": [{"role": "user", "content": prompt}],
+                "max_tokens": 100,
+                "response_model": getattr(response_model, "__name__", str(response_model)),
+            }
+        )
+
+    @staticmethod
+    def serialize_response(response) -> str:
+        if isinstance(response, BaseModel):
+            return response.model_dump_json()
+        return json.dumps(response)
+
+    @staticmethod
+    def deserialize_response(cached: str, response_model):
+        if isinstance(response_model, type) and issubclass(response_model, BaseModel):
+            return response_model.model_validate_json(cached)
+        return json.loads(cached)
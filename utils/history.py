@@ -1,31 +1,367 @@
+import bisect
+import json
+import os
+import sys
 import textwrap
 from abc import ABC, abstractmethod
+from collections.abc import Callable
+
+from utils.tracing import tracer
+
+
+class HistoryWriter:
+    def __init__(
+        self, filename: str, jsonl: bool = False, flush_every: int = 1, fsync_every: int = 0
+    ):
+        """
+        Appends history entries to a file as they are added instead of rewriting the whole file.
+        :param filename: The file to write to. It is truncated when the first entry is written,
+            so building an agent that never plays leaves it alone.
+        :param jsonl: Write one JSON record per entry instead of the plain-text transcript.
+        :param flush_every: Flush the buffer every N entries. 0 leaves flushing to the buffer.
+        :param fsync_every: Also fsync to disk every N entries. 0 never fsyncs.
+        """
+        self.filename = filename
+        self.jsonl = jsonl
+        self.flush_every = flush_every
+        self.fsync_every = fsync_every
+        self.entries_written = 0
+        self.header = ""
+        self.file = None
+
+    def write_header(self, system_message: str):
+        if self.jsonl:
+            self.header = json.dumps({"system_message": system_message}) + "\n"
+        else:
+            self.header = system_message + "\n"
+
+    def write_entry(self, history: "History", index: int):
+        with tracer.span("history.export"):
+            self._write_entry(history, index)
+
+    def _write_entry(self, history: "History", index: int):
+        if self.file is None:
+            # Closed by close(), which every agent's close() calls once the game is over.
+            self.file = open(self.filename, "w")  # noqa: SIM115
+            self.file.write(self.header)
+        if self.jsonl:
+            self.file.write(json.dumps(history.entry_record(index)) + "\n")
+        else:
+            # Matches the "\n".join layout of History.get_formatted_history_for_next_action.
+            text = history.format_entry(index, compact=False)
+            self.file.write(text if self.entries_written == 0 else "\n" + text)
+
+        self.entries_written += 1
+        if self.flush_every and self.entries_written % self.flush_every == 0:
+            self.file.flush()
+        if self.fsync_every and self.entries_written % self.fsync_every == 0:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None and not self.file.closed:
+            self.file.close()
+
+
+class InternTable:
+    """
+    Stores each distinct value once and hands out its index, so repeated values cost one int.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.ids = {}
+
+    def intern(self, value) -> int:
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+    def __getitem__(self, value_id: int):
+        return self.values[value_id]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+class TurnEntry:
+    """
+    One update_history call. The observation and the valid actions are ids into the history's
+    tables, so a repeat costs nothing. Observations are stored as tuples of line ids, so a room
+    description that comes back with a line added only stores the new line.
+    """
+
+    __slots__ = ("chosen_action", "observation", "reward", "score", "valid_actions")
+
+    def __init__(self, chosen_action, observation, reward, score, valid_actions):
+        self.chosen_action = chosen_action
+        self.observation = observation
+        self.reward = reward
+        self.score = score
+        self.valid_actions = valid_actions
+
+
+class TextEntry:
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+# Stands in for an observation or action list identical to the previous turn's when compact.
+SAME_AS_BEFORE = "(same as before)"
 
 
 class History(ABC):
-    def __init__(self, system_message):
+    def __init__(self, system_message, writer: HistoryWriter | None = None, compact: bool = False):
+        """
+        Keeps the game as compact records and only formats them into text for prompts and the
+        writer.
+        :param compact: Format prompts with "(same as before)" in place of an observation or
+            valid action list that repeats the previous turn's. The writer always gets the full
+            text.
+        """
         self.system_message = system_message
-        self.history = []
+        self.compact = compact
+        self.history: list[TurnEntry | TextEntry] = []
+        # Index into self.history where each update_history turn begins.
+        self.turn_starts = []
+        self.lines = InternTable()
+        self.observations = InternTable()
+        self.action_lists = InternTable()
+        self.writer = writer
+        if self.writer is not None:
+            self.writer.write_header(system_message)
 
     def update_history(self, chosen_action, observation, reward, score, next_valid_actions):
+        self.turn_starts.append(len(self.history))
+        self._append(
+            TurnEntry(
+                sys.intern(chosen_action),
+                self.observations.intern(
+                    tuple(self.lines.intern(line) for line in observation.split("\n"))
+                ),
+                reward,
+                score,
+                self.action_lists.intern(tuple(map(sys.intern, next_valid_actions))),
+            )
+        )
+
+    def update_history_with_string(self, string):
+        self._append(TextEntry(string))
+
+    def _append(self, entry: TurnEntry | TextEntry):
+        self.history.append(entry)
+        if self.writer is not None:
+            self.writer.write_entry(self, len(self.history) - 1)
+
+    def get_state(self) -> dict:
+        return {
+            "history": self.history,
+            "turn_starts": self.turn_starts,
+            "lines": self.lines,
+            "observations": self.observations,
+            "action_lists": self.action_lists,
+        }
+
+    def restore_state(self, state: dict):
+        """
+        Restores the entries from get_state and writes them to the writer, so its file ends up
+        as it would have without the restart.
+        """
+        self.history = list(state["history"])
+        self.turn_starts = list(state["turn_starts"])
+        self.lines = state["lines"]
+        self.observations = state["observations"]
+        self.action_lists = state["action_lists"]
+        if self.writer is not None:
+            for index in range(len(self.history)):
+                self.writer.write_entry(self, index)
+
+    def previous_turn(self, index: int) -> TurnEntry | None:
+        turn_index = bisect.bisect_left(self.turn_starts, index)
+        if turn_index == 0:
+            return None
+        return self.history[self.turn_starts[turn_index - 1]]
+
+    def format_entry(self, index: int, compact: bool | None = None) -> str:
+        """
+        The text of one entry. Compact output only refers back to the turn just before, so a
+        prompt that starts at this entry should pass compact=False.
+        """
+        entry = self.history[index]
+        if isinstance(entry, TextEntry):
+            return entry.text
+
+        observation = self.observation_text(entry)
+        valid_actions = list(self.action_lists[entry.valid_actions])
+        if self.compact if compact is None else compact:
+            previous = self.previous_turn(index)
+            if previous is not None and previous.observation == entry.observation:
+                observation = SAME_AS_BEFORE
+            if previous is not None and previous.valid_actions == entry.valid_actions:
+                valid_actions = SAME_AS_BEFORE
         history_entry = textwrap.dedent(f"""\
-Chosen Action: {chosen_action} \n
+Chosen Action: {entry.chosen_action} \n
 Led to this Observation: {observation} \n
-with Reward: {reward} \n
-with Total Score: {score}\n\n
-VALID NEXT ACTIONS: {next_valid_actions}""")
+with Reward: {entry.reward} \n
+with Total Score: {entry.score}\n\n
+VALID NEXT ACTIONS: {valid_actions}""")
+        return f"\n\n{history_entry}\n\n"
 
-        self.history.append(f"\n\n{history_entry}\n\n")
+    def observation_text(self, entry: TurnEntry) -> str:
+        return "\n".join(self.lines[line_id] for line_id in self.observations[entry.observation])
 
-    def update_history_with_string(self, string):
-        self.history.append(string)
+    def entry_record(self, index: int) -> dict:
+        entry = self.history[index]
+        if isinstance(entry, TextEntry):
+            return {"text": entry.text}
+        return {
+            "chosen_action": entry.chosen_action,
+            "observation": self.observation_text(entry),
+            "reward": entry.reward,
+            "score": entry.score,
+            "valid_actions": list(self.action_lists[entry.valid_actions]),
+        }
+
+    def get_turn(self, turn_index: int, standalone: bool = False) -> str:
+        """
+        :param standalone: Format the turn in full, for prompts that don't include the one
+            before.
+        """
+        start = self.turn_starts[turn_index]
+        end = (
+            self.turn_starts[turn_index + 1]
+            if turn_index + 1 < len(self.turn_starts)
+            else len(self.history)
+        )
+        return "\n".join(
+            self.format_entry(index, compact=False if standalone else None)
+            for index in range(start, end)
+        )
 
     def get_latest_history_entry(self):
-        return self.system_message + "\n" + self.history[-1]
+        return self.system_message + "\n" + self.format_entry(len(self.history) - 1, False)
 
     def get_formatted_history_for_next_action(self):
-        return self.system_message + "\n" + "\n".join(self.history)
+        return (
+            self.system_message
+            + "\n"
+            + "\n".join(self.format_entry(index) for index in range(len(self.history)))
+        )
+
+    def get_cacheable_history_blocks(self) -> list[dict]:
+        """
+        The same text as get_formatted_history_for_next_action, split into one content block per
+        entry with a prompt-cache breakpoint on the last one. Block boundaries stay put as the
+        history grows, so the API can reuse the prefix cached on the previous turn.
+        """
+        texts = [self.system_message + "\n" + self.format_entry(0)]
+        texts.extend("\n" + self.format_entry(index) for index in range(1, len(self.history)))
+        blocks = [{"type": "text", "text": text} for text in texts]
+        blocks[-1]["cache_control"] = {"type": "ephemeral"}
+        return blocks
 
     def export_history_to_file(self, filename):
         with open(filename, "w") as f:
             f.write(self.get_formatted_history_for_next_action())
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate (roughly four characters per token for English text).
+    """
+    return len(text) // 4 + 1
+
+
+class ContextWindow:
+    def __init__(
+        self,
+        history: History,
+        summarize: Callable[[str, str], str],
+        keep_last_turns: int = 8,
+        refresh_every: int = 10,
+        max_input_tokens: int = 6000,
+        reserved_tokens: int = 0,
+    ):
+        """
+        Builds prompts from a rolling summary of older turns plus the most recent turns verbatim.
+        :param history: The history to build prompts from.
+        :param summarize: Called with (previous summary, text of turns to fold in), returns the new
+            summary.
+        :param keep_last_turns: Number of most recent turns always sent verbatim.
+        :param refresh_every: Fold older turns into the summary once this many have piled up.
+        :param max_input_tokens: Hard budget for the estimated size of each request's input.
+        :param reserved_tokens: Estimated size of the rest of the request, such as the agent's
+            system prompt, which comes out of max_input_tokens before the prompt is built.
+        """
+        self.history = history
+        self.summarize = summarize
+        self.keep_last_turns = keep_last_turns
+        self.refresh_every = refresh_every
+        self.max_input_tokens = max_input_tokens
+        self.reserved_tokens = reserved_tokens
+        self.summary = ""
+        self.summarized_turns = 0
+
+    def get_state(self) -> dict:
+        return {"summary": self.summary, "summarized_turns": self.summarized_turns}
+
+    def restore_state(self, state: dict):
+        self.summary = state["summary"]
+        self.summarized_turns = state["summarized_turns"]
+
+    def refresh_summary(self, up_to_turn: int):
+        if up_to_turn <= self.summarized_turns:
+            return
+        new_turns = "\n".join(
+            self.history.get_turn(i, standalone=i == self.summarized_turns)
+            for i in range(self.summarized_turns, up_to_turn)
+        )
+        self.summary = self.summarize(self.summary, new_turns)
+        self.summarized_turns = up_to_turn
+
+    def get_prompt(self) -> str:
+        num_turns = len(self.history.turn_starts)
+        foldable = num_turns - self.keep_last_turns
+        if foldable - self.summarized_turns >= self.refresh_every:
+            self.refresh_summary(foldable)
+
+        budget = self.max_input_tokens - self.reserved_tokens
+        prompt = self._format(self.summarized_turns)
+        if estimate_tokens(prompt) <= budget:
+            return prompt
+
+        # Over budget: fold everything outside the verbatim window now, then drop the oldest
+        # verbatim turns until the prompt fits. The latest turn is always kept.
+        self.refresh_summary(max(foldable, 0))
+        first_turn = self.summarized_turns
+        prompt = self._format(first_turn)
+        while estimate_tokens(prompt) > budget and first_turn < num_turns - 1:
+            first_turn += 1
+            prompt = self._format(first_turn)
+
+        if estimate_tokens(prompt) > budget:
+            # Even the latest turn alone is too long. Cut the start of its text, keeping the
+            # system message, the summary and the turn's end with the valid actions.
+            head = self._format(num_turns) + "\n"
+            turn = self.history.get_turn(num_turns - 1, standalone=True)
+            max_chars = max(budget * 4 - 1 - len(head), 0)
+            prompt = head + turn[len(turn) - max_chars :]
+        return prompt
+
+    def _format(self, first_turn: int) -> str:
+        parts = [self.history.system_message]
+        if self.summary:
+            parts.append(f"SUMMARY OF EARLIER MOVES:\n{self.summary}\n\nRECENT MOVES:")
+        parts.extend(
+            self.history.get_turn(i, standalone=i == first_turn)
+            for i in range(first_turn, len(self.history.turn_starts))
+        )
+        return "\n".join(parts)
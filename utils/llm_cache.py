@@ -0,0 +1,227 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from anthropic.types import Message
+
+
+class CacheMissError(Exception):
+    pass
+
+
+class ResponseCache:
+    def __init__(self, path: str, replay_only: bool = False, max_bytes: int = 512 * 1024 * 1024):
+        """
+        Content-addressed store of model responses, keyed on a hash of the full request.
+        :param path: SQLite file to keep the cache in. Safe to share between processes.
+        :param replay_only: Raise CacheMissError instead of calling the model on a miss, so runs
+            are guaranteed not to touch the network.
+        :param max_bytes: Least recently used responses are evicted once the stored responses
+            exceed this size.
+        """
+        self.path = path
+        self.replay_only = replay_only
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "last_used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(request: dict) -> str:
+        encoded = json.dumps(request, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.replay_only:
+                    raise CacheMissError(f"No cached response for request {key}")
+                return None
+
+            self.hits += 1
+            self.connection.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key: str, value: str):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        (total,) = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        while total > self.max_bytes:
+            row = self.connection.execute(
+                "SELECT key, size FROM responses ORDER BY last_used LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            total -= row[1]
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses"
+
+    def close(self):
+        self.connection.close()
+
+
+class ReplayedMessageStream:
+    def __init__(self, message: Message):
+        """
+        Replays a cached message through the parts of the MessageStream interface the agents use.
+        Works as both a sync and an async context manager.
+        """
+        self.message = message
+
+    @property
+    def current_message_snapshot(self) -> Message:
+        return self.message
+
+    def get_final_message(self) -> Message:
+        return self.message
+
+    def texts(self) -> list[str]:
+        return [block.text for block in self.message.content if block.type == "text"]
+
+    @property
+    def text_stream(self):
+        return ReplayedTextStream(self.texts())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+
+class ReplayedTextStream:
+    def __init__(self, texts: list[str]):
+        self.texts = texts
+
+    def __iter__(self):
+        return iter(self.texts)
+
+    async def __aiter__(self):
+        for text in self.texts:
+            yield text
+
+
+class RecordingMessageStream:
+    def __init__(self, stream_manager, cache: "ResponseCache", key: str):
+        """
+        Passes a live stream through and caches whatever was received when it is closed, so a
+        stream the agent cut short replays the same way.
+        """
+        self.stream_manager = stream_manager
+        self.cache = cache
+        self.key = key
+        self.stream = None
+
+    def __enter__(self):
+        self.stream = self.stream_manager.__enter__()
+        return self.stream
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.record()
+        return self.stream_manager.__exit__(*exc_info)
+
+    async def __aenter__(self):
+        self.stream = await self.stream_manager.__aenter__()
+        return self.stream
+
+    async def __aexit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.record()
+        return await self.stream_manager.__aexit__(*exc_info)
+
+    def record(self):
+        self.cache.put(self.key, self.stream.current_message_snapshot.model_dump_json())
+
+
+class CachedMessages:
+    def __init__(self, messages, cache: ResponseCache):
+        self.messages = messages
+        self.cache = cache
+
+    def create(self, **request) -> Message:
+        key = self.cache.make_key(request)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return Message.model_validate_json(cached)
+
+        response = self.messages.create(**request)
+        self.cache.put(key, response.model_dump_json())
+        return response
+
+    def stream(self, **request):
+        # Streams may be cut short by the caller, so they never share entries with create().
+        key = self.cache.make_key({**request, "stream": True})
+        cached = self.cache.get(key)
+        if cached is not None:
+            return ReplayedMessageStream(Message.model_validate_json(cached))
+        return RecordingMessageStream(self.messages.stream(**request), self.cache, key)
+
+
+class AsyncCachedMessages(CachedMessages):
+    async def create(self, **request) -> Message:
+        key = self.cache.make_key(request)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return Message.model_validate_json(cached)
+
+        response = await self.messages.create(**request)
+        self.cache.put(key, response.model_dump_json())
+        return response
+
+
+class CachedAnthropic:
+    def __init__(self, client, cache: ResponseCache):
+        """
+        Wraps an anthropic.Anthropic client so that messages.create goes through the cache.
+        """
+        self.client = client
+        self.messages = CachedMessages(client.messages, cache)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class AsyncCachedAnthropic(CachedAnthropic):
+    def __init__(self, client, cache: ResponseCache):
+        """
+        Wraps an anthropic.AsyncAnthropic client so that messages.create goes through the cache.
+        """
+        self.client = client
+        self.messages = AsyncCachedMessages(client.messages, cache)
@@ -0,0 +1,128 @@
+MOVEMENT_ACTIONS = {
+    "north",
+    "south",
+    "east",
+    "west",
+    "northeast",
+    "northwest",
+    "southeast",
+    "southwest",
+    "up",
+    "down",
+    "in",
+    "out",
+    "enter",
+    "exit",
+}
+
+
+class Room:
+    def __init__(self, name: str):
+        self.name = name
+        self.objects: list[str] = []
+        self.exits: dict[str, int] = {}
+        self.unexplored_exits: list[str] = []
+        self.interactions: list[str] = []
+        self.notes: list[str] = []
+
+
+class MentalMap:
+    def __init__(self, max_interactions_per_room: int = 5, max_notes_per_room: int = 5):
+        """
+        Graph of rooms, exits, objects and interactions, maintained in code from the moves the
+        agent makes rather than regenerated by the model every turn.
+        """
+        self.rooms: dict[int, Room] = {}
+        self.current_location: int | None = None
+        self.max_interactions_per_room = max_interactions_per_room
+        self.max_notes_per_room = max_notes_per_room
+
+    def update(
+        self,
+        location: int,
+        location_name: str,
+        objects: list[str],
+        chosen_action: str,
+        observation: str,
+        reward: int,
+        valid_actions: list[str],
+    ):
+        """
+        Records the outcome of chosen_action, which took the player from the previous location to
+        `location`.
+        """
+        room = self.rooms.setdefault(location, Room(location_name))
+        room.objects = objects
+
+        previous = self.rooms.get(self.current_location)
+        if previous is not None:
+            if location != self.current_location:
+                previous.exits[chosen_action] = location
+            else:
+                outcome = observation.strip().splitlines()[0] if observation.strip() else ""
+                if reward:
+                    outcome += f" (reward {reward})"
+                interaction = f"{chosen_action}: {outcome}"
+                if interaction in previous.interactions:
+                    previous.interactions.remove(interaction)
+                previous.interactions.append(interaction)
+                del previous.interactions[: -self.max_interactions_per_room]
+
+        room.unexplored_exits = [
+            action
+            for action in valid_actions
+            if action in MOVEMENT_ACTIONS and action not in room.exits
+        ]
+        self.current_location = location
+
+    def add_note(self, note: str):
+        room = self.rooms.get(self.current_location)
+        if room is None or note in room.notes:
+            return
+        room.notes.append(note)
+        del room.notes[: -self.max_notes_per_room]
+
+    def serialize(self) -> str:
+        """
+        Compact text form of the map, one line per room with the current room first.
+        """
+        if self.current_location is None:
+            return "(empty)"
+
+        locations = [self.current_location]
+        locations.extend(location for location in self.rooms if location != self.current_location)
+        lines = []
+        for location in locations:
+            room = self.rooms[location]
+            parts = [f"{room.name}{' [CURRENT]' if location == self.current_location else ''}"]
+            if room.exits:
+                exits = ", ".join(
+                    f"{action}->{self.rooms[destination].name}"
+                    for action, destination in room.exits.items()
+                )
+                parts.append(f"exits: {exits}")
+            if room.unexplored_exits:
+                parts.append(f"unexplored: {', '.join(room.unexplored_exits)}")
+            if room.objects:
+                parts.append(f"objects: {', '.join(room.objects)}")
+            if room.interactions:
+                parts.append(f"done: {'; '.join(room.interactions)}")
+            if room.notes:
+                parts.append(f"notes: {'; '.join(room.notes)}")
+            lines.append("- " + " | ".join(parts))
+        return "\n".join(lines)
+
+
+def room_objects(env, location) -> list[str]:
+    """
+    Names of the objects directly inside a Jericho location, excluding the player.
+    """
+    player = env.get_player_object()
+    objects = []
+    child = location.child
+    while child:
+        obj = env.get_object(child)
+        if obj.num != player.num:
+            objects.append(obj.name)
+        child = obj.sibling
+    return objects
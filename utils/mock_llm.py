@@ -0,0 +1,146 @@
+import ast
+import asyncio
+import random
+import re
+import time
+
+from anthropic.types import Message, TextBlock
+
+ACTION_MARKER = "NEXT BEST ACTION FROM VALID NEXT ACTIONS:"
+VALID_ACTIONS_PATTERN = re.compile(r"VALID NEXT ACTIONS: (\[.*?\])")
+
+
+def request_text(content) -> str:
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+
+class MockMessages:
+    def __init__(self, seed: int = 0, latency: float = 0.0, chunk_size: int = 16):
+        """
+        Stand-in for client.messages that answers from the prompt alone, without a network.
+        :param seed: Seed for the choice among valid actions, so runs are reproducible.
+        :param latency: Seconds to sleep per call, to simulate API round trips.
+        :param chunk_size: Characters per chunk when streaming.
+        """
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.calls = 0
+
+    def respond(self, request: dict) -> Message:
+        self.calls += 1
+        system = request_text(request.get("system", ""))
+        prompt = request_text(request["messages"][-1]["content"])
+
+        valid_actions = ["look"]
+        matches = VALID_ACTIONS_PATTERN.findall(prompt)
+        if matches:
+            valid_actions = ast.literal_eval(matches[-1]) or valid_actions
+        action = self.rng.choice(valid_actions)
+
+        if "keeping notes" in system:
+            text = f"Notes: visited {prompt.count('Chosen Action:')} more locations."
+        elif ACTION_MARKER in system:
+            text = (
+                "<mental_map>\nMental Map:\n- Nodes:\n- Current Location: Unknown\n</mental_map>\n\n"
+                "<strategy_thinking>\nExploring is the best way to find points.\n"
+                f"</strategy_thinking>\n\n{ACTION_MARKER}\n{action}"
+            )
+        else:
+            text = f"Thinking: Exploring is the best way to find points.\n\n{action}"
+
+        return Message(
+            id=f"mock_{self.calls}",
+            type="message",
+            role="assistant",
+            model=request["model"],
+            content=[TextBlock(type="text", text=text)],
+            stop_reason="end_turn",
+            stop_sequence=None,
+            usage={"input_tokens": len(system + prompt) // 4, "output_tokens": len(text) // 4},
+        )
+
+    def create(self, **request) -> Message:
+        if self.latency:
+            time.sleep(self.latency)
+        return self.respond(request)
+
+    def stream(self, **request) -> "MockMessageStream":
+        if self.latency:
+            time.sleep(self.latency)
+        return MockMessageStream(self.respond(request), self.chunk_size)
+
+
+class AsyncMockMessages(MockMessages):
+    async def create(self, **request) -> Message:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.respond(request)
+
+    def stream(self, **request) -> "MockMessageStream":
+        return MockMessageStream(self.respond(request), self.chunk_size, self.latency)
+
+
+class MockMessageStream:
+    def __init__(self, message: Message, chunk_size: int, latency: float = 0.0):
+        """
+        Yields a message's text in fixed-size chunks, with the parts of the MessageStream
+        interface the agents use. current_message_snapshot only covers what has been streamed.
+        """
+        self.message = message
+        self.chunk_size = chunk_size
+        self.latency = latency
+        self.streamed = ""
+
+    @property
+    def current_message_snapshot(self) -> Message:
+        return self.message.model_copy(
+            update={"content": [TextBlock(type="text", text=self.streamed)]}
+        )
+
+    def chunks(self):
+        text = self.message.content[0].text
+        for start in range(0, len(text), self.chunk_size):
+            chunk = text[start : start + self.chunk_size]
+            self.streamed += chunk
+            yield chunk
+
+    @property
+    def text_stream(self):
+        return self
+
+    def __iter__(self):
+        return self.chunks()
+
+    async def __aiter__(self):
+        for chunk in self.chunks():
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+    async def __aenter__(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+
+class MockAnthropic:
+    def __init__(self, seed: int = 0, latency: float = 0.0):
+        self.messages = MockMessages(seed=seed, latency=latency)
+
+
+class AsyncMockAnthropic:
+    def __init__(self, seed: int = 0, latency: float = 0.0):
+        self.messages = AsyncMockMessages(seed=seed, latency=latency)
+
+    async def close(self):
+        pass
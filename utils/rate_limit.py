@@ -0,0 +1,371 @@
+import asyncio
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+
+import anthropic
+
+from utils.history import estimate_tokens
+from utils.tracing import tracer
+
+# Status codes worth retrying: rate limited, and the API's "overloaded" and unavailable errors.
+RETRYABLE_STATUS_CODES = (429, 500, 503, 529)
+# How often async waiters check the queue again, since they can't block on the condition.
+ASYNC_POLL_SECONDS = 0.05
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        """
+        Holds up to a minute's allowance and refills continuously, the way the API counts.
+        """
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float):
+        # May go negative when a response used more tokens than estimated, which delays the
+        # next requests by exactly the overrun.
+        self.level -= amount
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        max_in_flight: int = 8,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        """
+        Schedules model calls from every agent in a process against the account's limits.
+        Callers queue by priority (lower first, then arrival order) and are admitted once the
+        request and token buckets allow it and fewer than max_in_flight calls are running.
+        Retryable errors back off exponentially with jitter, and a 429 pauses every caller so
+        they don't all retry into the same limit.
+        :param tokens_per_minute: Counted as prompt plus max_tokens up front, then corrected to
+            the response's actual usage.
+        """
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.waiting: list[tuple[int, int]] = []
+        self.arrivals = itertools.count()
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.calls = 0
+        self.retries = 0
+        self.queued_seconds = 0.0
+
+    def enqueue(self, priority: int) -> tuple[int, int]:
+        ticket = (priority, next(self.arrivals))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+        return ticket
+
+    def dequeue(self, ticket: tuple[int, int]):
+        with self.condition:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+            self.condition.notify_all()
+
+    def try_acquire(self, ticket: tuple[int, int], tokens: int) -> float:
+        """
+        Admits the ticket if it is first in line and there is capacity. Returns 0 once
+        admitted, otherwise how long to wait before trying again.
+        """
+        with self.condition:
+            now = time.monotonic()
+            if self.waiting[0] != ticket or self.in_flight >= self.max_in_flight:
+                return ASYNC_POLL_SECONDS
+            wait = self.paused_until - now
+            if self.requests is not None:
+                wait = max(wait, self.requests.wait_time(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.wait_time(tokens, now))
+            if wait > 0:
+                return wait
+
+            heapq.heappop(self.waiting)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(min(tokens, self.tokens.capacity))
+            self.in_flight += 1
+            self.calls += 1
+            self.condition.notify_all()
+            return 0.0
+
+    def acquire(self, tokens: int, priority: int = 0):
+        start = time.perf_counter()
+        ticket = self.enqueue(priority)
+        try:
+            while (wait := self.try_acquire(ticket, tokens)) > 0:
+                with self.condition:
+                    self.condition.wait(wait)
+        except BaseException:
+            self.dequeue(ticket)
+            raise
+        self.queued_seconds += time.perf_counter() - start
+
+    async def acquire_async(self, tokens: int, priority: int = 0):
+        start = time.perf_counter()
+        ticket = self.enqueue(priority)
+        try:
+            while (wait := self.try_acquire(ticket, tokens)) > 0:
+                await asyncio.sleep(min(wait, ASYNC_POLL_SECONDS))
+        except BaseException:
+            self.dequeue(ticket)
+            raise
+        self.queued_seconds += time.perf_counter() - start
+
+    def release(self, estimated_tokens: int = 0, used_tokens: int | None = None):
+        with self.condition:
+            self.in_flight -= 1
+            if self.tokens is not None and used_tokens is not None:
+                self.tokens.take(used_tokens - min(estimated_tokens, self.tokens.capacity))
+            self.condition.notify_all()
+
+    def retry_delay(self, error: Exception, attempt: int) -> float:
+        """
+        Seconds to wait before retrying after `error`, which may be an API error or an
+        instructor exception caused by one. Re-raises it if it isn't retryable or the retries
+        are used up.
+        """
+        cause = api_error(error)
+        status = getattr(cause, "status_code", None)
+        retryable = status in RETRYABLE_STATUS_CODES or isinstance(
+            cause, anthropic.APIConnectionError
+        )
+        if not retryable or attempt >= self.max_retries:
+            raise error
+
+        delay = min(self.max_delay, self.base_delay * 2**attempt) * random.uniform(0.5, 1.0)
+        response = getattr(cause, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after is not None:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        if status == 429:
+            # The account's buckets are evidently empty even if ours aren't, e.g. because another
+            # process shares the key. Empty ours too so every caller resumes at the refill rate
+            # instead of bursting into the limit again.
+            with self.condition:
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                for bucket in (self.requests, self.tokens):
+                    if bucket is not None:
+                        bucket.level = min(bucket.level, 0.0)
+
+        self.retries += 1
+        tracer.count("llm.retries")
+        tracer.count(f"llm.errors.{status or 'connection'}")
+        return delay
+
+    def call(self, send, tokens: int, priority: int = 0):
+        for attempt in itertools.count():
+            with tracer.span("llm.queue"):
+                self.acquire(tokens, priority)
+            try:
+                result = send()
+            except Exception as error:
+                self.release()
+                if api_error(error) is None:
+                    raise
+                time.sleep(self.retry_delay(error, attempt))
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self.release(tokens, used_tokens(result))
+            return result
+
+    async def call_async(self, send, tokens: int, priority: int = 0):
+        for attempt in itertools.count():
+            with tracer.span("llm.queue"):
+                await self.acquire_async(tokens, priority)
+            try:
+                result = await send()
+            except Exception as error:
+                self.release()
+                if api_error(error) is None:
+                    raise
+                await asyncio.sleep(self.retry_delay(error, attempt))
+                continue
+            except BaseException:
+                self.release()
+                raise
+            self.release(tokens, used_tokens(result))
+            return result
+
+    def stats(self) -> str:
+        return (
+            f"{self.calls} calls, {self.retries} retries, "
+            f"{self.queued_seconds:.1f}s waiting for capacity (summed over calls)"
+        )
+
+
+def api_error(error: BaseException | None) -> anthropic.APIError | None:
+    """
+    The API error behind `error`. instructor raises its own exceptions for failed calls, with
+    the SDK's error as their cause.
+    """
+    while error is not None and not isinstance(error, anthropic.APIError):
+        error = error.__cause__
+    return error
+
+
+def request_tokens(request: dict) -> int:
+    """
+    Upper bound on the tokens a request can use: its estimated prompt plus max_tokens.
+    """
+    prompt = json.dumps([request.get("system", ""), request.get("messages", [])])
+    return estimate_tokens(prompt) + request.get("max_tokens", 0)
+
+
+def used_tokens(result) -> int | None:
+    # instructor's create_with_completion returns (response, completion).
+    if isinstance(result, tuple):
+        result = result[-1]
+    usage = getattr(result, "usage", None)
+    if usage is None:
+        return None
+    return usage.input_tokens + usage.output_tokens
+
+
+def without_sdk_retries(client):
+    """
+    The SDK retries twice by default. Behind the limiter that would retry around the queue.
+    """
+    with_options = getattr(client, "with_options", None)
+    return with_options(max_retries=0) if with_options is not None else client
+
+
+class RateLimitedStream:
+    def __init__(self, limiter: RateLimiter, open_stream, tokens: int, priority: int):
+        """
+        Holds a slot for as long as a stream is open. Errors are retried when the stream is
+        entered, which is when the request is sent.
+        """
+        self.limiter = limiter
+        self.open_stream = open_stream
+        self.tokens = tokens
+        self.priority = priority
+        self.manager = None
+        self.stream = None
+
+    def __enter__(self):
+        for attempt in itertools.count():
+            self.limiter.acquire(self.tokens, self.priority)
+            self.manager = self.open_stream()
+            try:
+                self.stream = self.manager.__enter__()
+                return self.stream
+            except anthropic.APIError as error:
+                self.limiter.release()
+                time.sleep(self.limiter.retry_delay(error, attempt))
+            except BaseException:
+                self.limiter.release()
+                raise
+
+    def __exit__(self, *exc_info):
+        try:
+            return self.manager.__exit__(*exc_info)
+        finally:
+            self.limiter.release(self.tokens, self.snapshot_tokens())
+
+    async def __aenter__(self):
+        for attempt in itertools.count():
+            await self.limiter.acquire_async(self.tokens, self.priority)
+            self.manager = self.open_stream()
+            try:
+                self.stream = await self.manager.__aenter__()
+                return self.stream
+            except anthropic.APIError as error:
+                self.limiter.release()
+                await asyncio.sleep(self.limiter.retry_delay(error, attempt))
+            except BaseException:
+                self.limiter.release()
+                raise
+
+    async def __aexit__(self, *exc_info):
+        try:
+            return await self.manager.__aexit__(*exc_info)
+        finally:
+            self.limiter.release(self.tokens, self.snapshot_tokens())
+
+    def snapshot_tokens(self) -> int | None:
+        snapshot = getattr(self.stream, "current_message_snapshot", None)
+        return used_tokens(snapshot) if snapshot is not None else None
+
+
+class RateLimitedMessages:
+    def __init__(self, messages, limiter: RateLimiter, priority: int = 0):
+        self.messages = messages
+        self.limiter = limiter
+        self.priority = priority
+
+    def create(self, **request):
+        return self.limiter.call(
+            lambda: self.messages.create(**request), request_tokens(request), self.priority
+        )
+
+    def stream(self, **request) -> RateLimitedStream:
+        return RateLimitedStream(
+            self.limiter,
+            lambda: self.messages.stream(**request),
+            request_tokens(request),
+            self.priority,
+        )
+
+
+class AsyncRateLimitedMessages(RateLimitedMessages):
+    async def create(self, **request):
+        return await self.limiter.call_async(
+            lambda: self.messages.create(**request), request_tokens(request), self.priority
+        )
+
+
+class RateLimitedAnthropic:
+    def __init__(self, client, limiter: RateLimiter, priority: int = 0):
+        """
+        Wraps an anthropic.Anthropic client so that messages.create and messages.stream go
+        through the limiter. Wrap it in CachedAnthropic, not the other way round, so cache hits
+        don't use up the limits.
+        :param priority: Lower is served first, e.g. the episode number.
+        """
+        self.client = without_sdk_retries(client)
+        self.messages = RateLimitedMessages(self.client.messages, limiter, priority)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class AsyncRateLimitedAnthropic(RateLimitedAnthropic):
+    def __init__(self, client, limiter: RateLimiter, priority: int = 0):
+        """
+        Wraps an anthropic.AsyncAnthropic client, see RateLimitedAnthropic.
+        """
+        self.client = without_sdk_retries(client)
+        self.messages = AsyncRateLimitedMessages(self.client.messages, limiter, priority)
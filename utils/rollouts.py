@@ -0,0 +1,109 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from jericho import FrotzEnv
+
+DEATH_PENALTY = -10.0
+
+# Each pool worker owns one emulator and a transposition table that lives as long as the worker.
+_worker_env: FrotzEnv | None = None
+_worker_table: dict[str, tuple[float, int]] = {}
+
+
+def init_worker(rom_path: str):
+    global _worker_env
+    _worker_env = FrotzEnv(rom_path)
+
+
+def step_value(env: FrotzEnv, reward: float, done: bool) -> float:
+    if done and not env.victory():
+        return reward + DEATH_PENALTY
+    return reward
+
+
+def best_future_reward(env: FrotzEnv, depth: int, budget: list[int]) -> tuple[float, bool]:
+    """
+    Best total reward reachable from the env's current state within `depth` moves, expanding
+    at most budget[0] nodes. Returns the value and whether the search finished within budget.
+    The env is left in the state it started in.
+    """
+    if depth == 0:
+        return 0.0, True
+
+    state_hash = env.get_world_state_hash()
+    cached = _worker_table.get(state_hash)
+    if cached is not None and cached[1] >= depth:
+        return cached[0], True
+
+    state = env.get_state()
+    best = 0.0
+    complete = True
+    for action in env.get_valid_actions(use_parallel=False):
+        if budget[0] <= 0:
+            complete = False
+            break
+        budget[0] -= 1
+        env.set_state(state)
+        _, reward, done, _ = env.step(action)
+        value = step_value(env, reward, done)
+        if not done:
+            future, future_complete = best_future_reward(env, depth - 1, budget)
+            value += future
+            complete = complete and future_complete
+        best = max(best, value)
+    env.set_state(state)
+
+    if complete:
+        _worker_table[state_hash] = (best, depth)
+    return best, complete
+
+
+def future_value(state, depth: int, node_budget: int) -> tuple[float, int, bool]:
+    """
+    Pool task: restores `state` in the worker's emulator and searches `depth` plies from it.
+    Returns (value, nodes expanded, complete).
+    """
+    _worker_env.set_state(state)
+    budget = [node_budget]
+    value, complete = best_future_reward(_worker_env, depth, budget)
+    return value, node_budget - budget[0], complete
+
+
+def step_branch(state, action: str) -> dict:
+    """
+    Pool task: restores `state`, steps `action` and generates the valid actions of the state it
+    leads to, which is what the game loop would do next.
+    """
+    start = time.perf_counter()
+    _worker_env.set_state(state)
+    observation, reward, done, info = _worker_env.step(action)
+    valid_actions = [] if done else _worker_env.get_valid_actions(use_parallel=False)
+    return {
+        "observation": observation,
+        "reward": reward,
+        "done": done,
+        "info": info,
+        "state": _worker_env.get_state(),
+        "hash": _worker_env.get_world_state_hash(),
+        "valid_actions": valid_actions,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+class RolloutPool:
+    def __init__(self, rom_path: str, workers: int | None = None):
+        """
+        Process pool of emulators for the same ROM that evaluate game states from snapshots.
+        """
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker, initargs=(rom_path,)
+        )
+
+    def submit(self, state, depth: int, node_budget: int):
+        return self.executor.submit(future_value, state, depth, node_budget)
+
+    def submit_step(self, state, action: str):
+        return self.executor.submit(step_branch, state, action)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
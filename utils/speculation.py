@@ -0,0 +1,94 @@
+import time
+from collections import Counter, defaultdict
+
+from utils.rollouts import RolloutPool
+from utils.tracing import tracer
+
+
+class Speculator:
+    def __init__(self, rom_path: str, width: int = 4):
+        """
+        Uses the time the agent spends waiting on the model: steps the likeliest actions from a
+        snapshot in a rollout pool, and generates the valid actions each one leads to. If the
+        agent picks one of them, its move is applied by restoring the prepared state.
+        :param width: Actions prepared per move, one rollout worker each.
+        """
+        self.pool = RolloutPool(rom_path, workers=width)
+        self.width = width
+        # How often each action was chosen, overall and per world state, to rank candidates.
+        self.choices = Counter()
+        self.state_choices: defaultdict[str, Counter] = defaultdict(Counter)
+        self.state_hash = None
+        self.branches = {}
+        self.prepared = None
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    def rank(self, valid_actions: list[str]) -> list[str]:
+        state_choices = self.state_choices[self.state_hash]
+        # sorted is stable, so actions never chosen keep the game's order.
+        ranked = sorted(
+            valid_actions, key=lambda action: (-state_choices[action], -self.choices[action])
+        )
+        return ranked[: self.width]
+
+    def start(self, env, valid_actions: list[str]):
+        """
+        Starts preparing the likeliest next moves. Call right before the agent chooses, with the
+        env in the state it will choose from.
+        """
+        self.state_hash = env.get_world_state_hash()
+        state = env.get_state()
+        self.branches = {
+            action: self.pool.submit_step(state, action) for action in self.rank(valid_actions)
+        }
+
+    def step(self, env, action: str):
+        """
+        Applies the chosen action to the env like env.step, from a prepared branch if one was
+        started for it.
+        """
+        self.choices[action] += 1
+        self.state_choices[self.state_hash][action] += 1
+        future = self.branches.pop(action, None)
+        for other in self.branches.values():
+            other.cancel()
+        self.branches = {}
+
+        # A branch that is still queued would take as long as stepping here.
+        if future is None or not (future.running() or future.done()):
+            if future is not None:
+                future.cancel()
+            self.misses += 1
+            tracer.count("speculation.misses")
+            return env.step(action)
+
+        start = time.perf_counter()
+        branch = future.result()
+        env.set_state(branch["state"])
+        self.prepared = (branch["hash"], branch["valid_actions"])
+        self.hits += 1
+        self.seconds_saved += branch["seconds"] - (time.perf_counter() - start)
+        tracer.count("speculation.hits")
+        return branch["observation"], branch["reward"], branch["done"], branch["info"]
+
+    def prepared_valid_actions(self, env) -> list[str] | None:
+        """
+        The valid actions generated along with the branch the last step came from, if any.
+        """
+        prepared, self.prepared = self.prepared, None
+        if prepared is None or prepared[0] != env.get_world_state_hash():
+            return None
+        return list(prepared[1])
+
+    def stats(self) -> str:
+        moves = self.hits + self.misses
+        hit_rate = self.hits / moves if moves else 0.0
+        return (
+            f"{self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate), "
+            f"{self.seconds_saved:.2f}s of emulator work saved"
+        )
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class Tracer:
+    def __init__(self, enabled: bool = False):
+        """
+        Collects timed spans and counters for the game loop. Disabled tracers do no work, so
+        spans can be left in hot paths.
+        """
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        self.events: list[dict] = []
+        self.durations: dict[str, list[float]] = defaultdict(list)
+        self.counters: Counter[str] = Counter()
+        self.lock = threading.Lock()
+
+    def span(self, name: str, **args):
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, args)
+
+    @contextmanager
+    def _span(self, name: str, args: dict):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.start_time) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+            }
+            if args:
+                event["args"] = args
+            with self.lock:
+                self.events.append(event)
+                self.durations[name].append(end - start)
+
+    def count(self, name: str, value: int = 1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += value
+
+    def export(self, path: str):
+        """
+        Writes the spans as a Chrome trace (load in chrome://tracing or Perfetto), or as one JSON
+        event per line if the path ends in .jsonl. Counters are included either way.
+        """
+        counter_event = {
+            "name": "counters",
+            "ph": "C",
+            "ts": (time.perf_counter() - self.start_time) * 1e6,
+            "pid": os.getpid(),
+            "args": dict(self.counters),
+        }
+        with open(path, "w") as f:
+            if path.endswith(".jsonl"):
+                f.writelines(json.dumps(event) + "\n" for event in [*self.events, counter_event])
+            else:
+                json.dump({"traceEvents": [*self.events, counter_event]}, f)
+
+    def summary(self) -> str:
+        lines = [
+            f"{'span':<28} {'count':>7} {'total s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+        ]
+        for name, durations in sorted(self.durations.items(), key=lambda item: -sum(item[1])):
+            durations = sorted(durations)
+            lines.append(
+                f"{name:<28} {len(durations):>7} {sum(durations):>9.3f} "
+                f"{percentile(durations, 50) * 1e3:>9.2f} {percentile(durations, 95) * 1e3:>9.2f} "
+                f"{percentile(durations, 99) * 1e3:>9.2f}"
+            )
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<28} {value:>7}")
+        return "\n".join(lines)
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+# Shared by the game loop, the agents and the history writer. Enabled by run --trace.
+tracer = Tracer()
@@ -0,0 +1,412 @@
+import array
+import json
+import math
+import mmap
+import os
+import re
+import sys
+
+import fire
+
+# Per-move columns and their array typecodes. "game", "action" and "observation" are ids into
+# the string tables of the same name.
+COLUMNS = {
+    "game": "i",
+    "episode": "i",
+    "move": "i",
+    "reward": "i",
+    "score": "i",
+    "input_tokens": "q",
+    "output_tokens": "q",
+    "latency": "d",
+    "action": "i",
+    "observation": "i",
+}
+STRING_TABLES = ("game", "action", "observation")
+NUMPY_DTYPES = {"i": "i4", "q": "i8", "d": "f8"}
+
+# One History.update_history entry in a history.txt transcript. textwrap.dedent turns the space
+# after an observation ending in a newline into an empty line, so that space is optional.
+TRANSCRIPT_ENTRY = re.compile(
+    r"Chosen Action: (.*?) \n\nLed to this Observation: ([\s\S]*?) ?\n\n"
+    r"with Reward: (-?\d+) \n\nwith Total Score: (-?\d+)\n"
+)
+
+
+class StringTableWriter:
+    def __init__(self, path: str, name: str):
+        """
+        Appends distinct strings to {name}.strings as UTF-8 and their end offsets to
+        {name}.offsets, handing out each string's index. Existing tables are read back so ids
+        stay stable when a store is appended to.
+        """
+        self.strings_path = os.path.join(path, f"{name}.strings")
+        self.offsets_path = os.path.join(path, f"{name}.offsets")
+        self.ids: dict[str, int] = {}
+        self.size = 0
+        self.pending_strings = bytearray()
+        self.pending_offsets = array.array("q")
+        if os.path.exists(self.offsets_path):
+            self.load()
+
+    def load(self):
+        offsets = array.array("q")
+        with open(self.offsets_path, "rb") as f:
+            data = f.read()
+        offsets.frombytes(data[: len(data) - len(data) % offsets.itemsize])
+        with open(self.strings_path, "rb") as f:
+            strings = f.read()
+        start = 0
+        for string_id, end in enumerate(offsets):
+            self.ids[strings[start:end].decode()] = string_id
+            start = end
+        self.size = start
+        # Drop whatever a crash left after the last complete string.
+        truncate(self.strings_path, self.size)
+        truncate(self.offsets_path, len(offsets) * offsets.itemsize)
+
+    def intern(self, text: str) -> int:
+        string_id = self.ids.get(text)
+        if string_id is None:
+            string_id = self.ids[text] = len(self.ids)
+            data = text.encode()
+            self.pending_strings += data
+            self.size += len(data)
+            self.pending_offsets.append(self.size)
+        return string_id
+
+    def flush(self):
+        with open(self.strings_path, "ab") as f:
+            f.write(self.pending_strings)
+        with open(self.offsets_path, "ab") as f:
+            self.pending_offsets.tofile(f)
+        self.pending_strings = bytearray()
+        self.pending_offsets = array.array("q")
+
+
+class TrajectoryWriter:
+    def __init__(self, path: str, flush_every: int = 16):
+        """
+        Appends per-move records to a columnar store: one flat array file per numeric column
+        and offset-indexed string tables for games, actions and observations. Reopening a store
+        appends to it, so one store can collect any number of runs.
+        :param path: Directory of the store.
+        :param flush_every: Write buffered moves to disk every N moves.
+        """
+        self.path = path
+        self.flush_every = flush_every
+        os.makedirs(path, exist_ok=True)
+        self.meta_path = os.path.join(path, "meta.json")
+        self.episodes = 0
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            check_meta(meta, path)
+            self.episodes = meta["episodes"]
+
+        self.strings = {name: StringTableWriter(path, name) for name in STRING_TABLES}
+        # Columns may differ in length after a crash. Cut them back to the rows they all have.
+        rows = min(column_rows(path, name) for name in COLUMNS)
+        for name, typecode in COLUMNS.items():
+            truncate(column_path(path, name), rows * array.array(typecode).itemsize)
+        self.rows = rows
+        self.pending = {name: array.array(typecode) for name, typecode in COLUMNS.items()}
+        # Game string id of each episode begun by this writer.
+        self.episode_games: dict[int, int] = {}
+
+    def begin_episode(self, game: str = "") -> int:
+        """
+        :param game: Name of the game played, recorded on every row of the episode so that
+            stores of several games can be merged and still told apart.
+        """
+        episode = self.episodes
+        self.episodes += 1
+        self.episode_games[episode] = self.strings["game"].intern(game)
+        return episode
+
+    def resume_episode(self, episode: int, move: int, game: str = "") -> int:
+        """
+        Carries on an episode from a checkpoint taken after `move`. Rows the episode wrote after
+        that move are dropped, as those moves are about to be played again. Rows of other
+        episodes are kept, so stores shared by concurrent games can be resumed too.
+        :return: The episode, to pass to add_move.
+        """
+        self.flush()
+        columns = {name: array.array(typecode) for name, typecode in COLUMNS.items()}
+        for name, values in columns.items():
+            with open(column_path(self.path, name), "rb") as f:
+                values.fromfile(f, self.rows)
+        keep = [
+            row
+            for row in range(self.rows)
+            if columns["episode"][row] != episode or columns["move"][row] <= move
+        ]
+        if len(keep) < self.rows:
+            # Write every column before replacing any, so a crash while writing keeps the old rows.
+            for name, values in columns.items():
+                kept = array.array(values.typecode, (values[row] for row in keep))
+                with open(column_path(self.path, name) + ".tmp", "wb") as f:
+                    kept.tofile(f)
+            for name in COLUMNS:
+                os.replace(column_path(self.path, name) + ".tmp", column_path(self.path, name))
+            self.rows = len(keep)
+            self.write_meta()
+        self.episodes = max(self.episodes, episode + 1)
+        self.episode_games[episode] = self.strings["game"].intern(game)
+        return episode
+
+    def add_move(
+        self,
+        episode: int,
+        move: int,
+        action: str,
+        observation: str,
+        reward: int,
+        score: int,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+        latency: float = math.nan,
+    ):
+        """
+        :param input_tokens: Tokens used to choose this move, not the running total.
+        :param latency: Seconds the agent took to choose the move.
+        """
+        row = {
+            "game": self.episode_games[episode],
+            "episode": episode,
+            "move": move,
+            "reward": reward,
+            "score": score,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "latency": latency,
+            "action": self.strings["action"].intern(action),
+            "observation": self.strings["observation"].intern(observation),
+        }
+        for name, value in row.items():
+            self.pending[name].append(value)
+        if self.flush_every and len(self.pending["move"]) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # Strings go first, so ids in flushed columns always exist in the tables.
+        for table in self.strings.values():
+            table.flush()
+        for name, values in self.pending.items():
+            with open(column_path(self.path, name), "ab") as f:
+                values.tofile(f)
+        self.rows += len(self.pending["move"])
+        self.pending = {name: array.array(typecode) for name, typecode in COLUMNS.items()}
+        self.write_meta()
+
+    def write_meta(self):
+        meta = {
+            "columns": COLUMNS,
+            "byteorder": sys.byteorder,
+            "episodes": self.episodes,
+            "rows": self.rows,
+        }
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def close(self):
+        self.flush()
+
+
+class StringTable:
+    def __init__(self, path: str, name: str):
+        """
+        Read-only view of a string table. Strings are decoded from the mapped file on access.
+        """
+        self.data = map_file(os.path.join(path, f"{name}.strings"))
+        offsets = map_file(os.path.join(path, f"{name}.offsets"))
+        self.offsets = offsets[: len(offsets) - len(offsets) % 8].cast("q")
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, string_id: int) -> str:
+        start = self.offsets[string_id - 1] if string_id > 0 else 0
+        return bytes(self.data[start : self.offsets[string_id]]).decode()
+
+
+class TrajectoryStore:
+    def __init__(self, path: str):
+        """
+        Memory-maps a store written by TrajectoryWriter. Columns are views of the mapped files,
+        so opening a store of thousands of episodes copies nothing.
+        """
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        check_meta(self.meta, path)
+        self.columns = {}
+        for name, typecode in self.meta["columns"].items():
+            view = map_file(column_path(path, name))
+            itemsize = array.array(typecode).itemsize
+            self.columns[name] = view[: len(view) - len(view) % itemsize].cast(typecode)
+        self.rows = min(len(column) for column in self.columns.values())
+        self.strings = {name: StringTable(path, name) for name in STRING_TABLES}
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def column(self, name: str) -> memoryview:
+        return self.columns[name][: self.rows]
+
+    def array(self, name: str):
+        """
+        The column as a numpy array sharing the mapped memory, for vectorized analysis.
+        """
+        import numpy as np
+
+        return np.frombuffer(self.column(name), dtype=NUMPY_DTYPES[self.meta["columns"][name]])
+
+    def text(self, name: str, row: int) -> str:
+        """
+        The game, action or observation of a row.
+        """
+        return self.strings[name][self.columns[name][row]]
+
+    def episode_summary(self) -> dict:
+        """
+        Per-episode game, moves, final score, tokens and mean latency, computed with numpy.
+        """
+        import numpy as np
+
+        episodes = self.array("episode")
+        ids, moves = np.unique(episodes, return_counts=True)
+        count = int(ids[-1]) + 1 if len(ids) else 0
+        # Rows of concurrent episodes interleave, so sort by episode, then move.
+        order = np.lexsort((self.array("move"), episodes))
+        last_rows = order[np.cumsum(moves) - 1]
+        latency = self.array("latency")
+        timed = ~np.isnan(latency)
+        latency_sum = np.bincount(episodes[timed], latency[timed], minlength=count)[ids]
+        timed_moves = np.bincount(episodes[timed], minlength=count)[ids]
+        games = self.column("game")
+        return {
+            "episode": ids,
+            "game": [self.strings["game"][games[row]] for row in last_rows],
+            "moves": moves,
+            "score": self.array("score")[last_rows],
+            "input_tokens": np.bincount(episodes, self.array("input_tokens"), count)[ids],
+            "output_tokens": np.bincount(episodes, self.array("output_tokens"), count)[ids],
+            "latency": np.where(timed_moves > 0, latency_sum / np.maximum(timed_moves, 1), np.nan),
+        }
+
+
+def column_path(path: str, name: str) -> str:
+    return os.path.join(path, f"{name}.col")
+
+
+def column_rows(path: str, name: str) -> int:
+    file_path = column_path(path, name)
+    if not os.path.exists(file_path):
+        return 0
+    return os.path.getsize(file_path) // array.array(COLUMNS[name]).itemsize
+
+
+def truncate(file_path: str, size: int):
+    if os.path.exists(file_path) and os.path.getsize(file_path) > size:
+        os.truncate(file_path, size)
+
+
+def map_file(file_path: str) -> memoryview:
+    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+        return memoryview(b"")
+    with open(file_path, "rb") as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def check_meta(meta: dict, path: str):
+    if meta["columns"] != COLUMNS:
+        raise ValueError(f"Trajectory store {path} has columns {meta['columns']}")
+    if meta["byteorder"] != sys.byteorder:
+        raise ValueError(
+            f"Trajectory store {path} was written on a {meta['byteorder']}-endian host"
+        )
+
+
+def convert_transcript(transcript_path: str, writer: TrajectoryWriter, game: str = "") -> int:
+    """
+    Adds the moves of a history.txt transcript (such as those in walkthroughs/) to a store as
+    one episode. Transcripts don't record tokens or latency, so those are 0 and NaN.
+    :param game: Name of the game the transcript is of. Transcripts don't say.
+    :return: The number of moves added.
+    """
+    with open(transcript_path) as f:
+        text = f.read()
+    episode = writer.begin_episode(game)
+    moves = 0
+    for move, match in enumerate(TRANSCRIPT_ENTRY.finditer(text)):
+        action, observation, reward, score = match.groups()
+        writer.add_move(episode, move, action, observation, int(reward), int(score))
+        moves += 1
+    return moves
+
+
+def merge(output: str, *stores: str):
+    """
+    Appends the rows of several stores to another one, e.g. the per-episode stores of an
+    evaluation. Episodes are numbered anew in the order they come and keep their game.
+    """
+    writer = TrajectoryWriter(output)
+    for path in stores:
+        store = TrajectoryStore(path)
+        episodes = {}
+        columns = {name: store.column(name) for name in COLUMNS}
+        for row in range(len(store)):
+            source_episode = columns["episode"][row]
+            if source_episode not in episodes:
+                episodes[source_episode] = writer.begin_episode(store.text("game", row))
+            writer.add_move(
+                episodes[source_episode],
+                columns["move"][row],
+                store.text("action", row),
+                store.text("observation", row),
+                columns["reward"][row],
+                columns["score"][row],
+                columns["input_tokens"][row],
+                columns["output_tokens"][row],
+                columns["latency"][row],
+            )
+    writer.close()
+
+
+def convert(output: str, *transcripts: str, game: str = "zork1"):
+    """
+    Converts history.txt transcripts, one episode each, into a trajectory store.
+    :param game: Name of the game the transcripts are of.
+    """
+    writer = TrajectoryWriter(output)
+    for transcript_path in transcripts:
+        moves = convert_transcript(transcript_path, writer, game)
+        print(f"{transcript_path}: {moves} moves")
+    writer.close()
+
+
+def summary(path: str):
+    """
+    Prints per-episode results of a store.
+    """
+    store = TrajectoryStore(path)
+    results = store.episode_summary()
+    width = max([4, *(len(game) for game in results["game"])])
+    print(
+        f"{'episode':>7} {'game':<{width}} {'moves':>6} {'score':>5} {'in tok':>9} "
+        f"{'out tok':>8} {'latency':>8}"
+    )
+    for row in zip(*results.values(), strict=True):
+        episode, game, moves, score, input_tokens, output_tokens, latency = row
+        print(
+            f"{episode:>7} {game:<{width}} {moves:>6} {score:>5} {input_tokens:>9.0f} "
+            f"{output_tokens:>8.0f} {latency:>8.2f}"
+        )
+    print(f"{len(store)} moves in {len(results['episode'])} episodes")
+
+
+if __name__ == "__main__":
+    fire.Fire({"convert": convert, "merge": merge, "summary": summary})
@@ -0,0 +1,58 @@
+from collections import Counter, deque
+
+
+class Transition:
+    __slots__ = ("next_hash", "observation", "reward")
+
+    def __init__(self, next_hash: str, reward: int, observation: str):
+        self.next_hash = next_hash
+        self.reward = reward
+        self.observation = observation
+
+
+class TransitionTable:
+    def __init__(self):
+        """
+        Observed outcomes of (world-state hash, action) pairs, plus the valid actions seen in each
+        state, so already-explored parts of the game can be navigated without asking a model.
+        """
+        self.transitions: dict[str, dict[str, Transition]] = {}
+        self.valid_actions: dict[str, list[str]] = {}
+        self.visits: Counter[str] = Counter()
+
+    def record(self, state_hash: str, action: str, next_hash: str, reward: int, observation: str):
+        self.transitions.setdefault(state_hash, {})[action] = Transition(
+            next_hash, reward, observation
+        )
+
+    def visit(self, state_hash: str, valid_actions: list[str]):
+        self.visits[state_hash] += 1
+        self.valid_actions[state_hash] = valid_actions
+
+    def lookup(self, state_hash: str, action: str) -> Transition | None:
+        return self.transitions.get(state_hash, {}).get(action)
+
+    def untried_actions(self, state_hash: str) -> list[str]:
+        tried = self.transitions.get(state_hash, {})
+        return [action for action in self.valid_actions.get(state_hash, []) if action not in tried]
+
+    def route_to_frontier(self, state_hash: str) -> list[str] | None:
+        """
+        Shortest sequence of known transitions from state_hash to another state that still has
+        untried actions, or None if no such state is reachable.
+        """
+        parents: dict[str, tuple[str, str] | None] = {state_hash: None}
+        queue = deque([state_hash])
+        while queue:
+            current = queue.popleft()
+            if current != state_hash and self.untried_actions(current):
+                route = []
+                while parents[current] is not None:
+                    current, action = parents[current]
+                    route.append(action)
+                return route[::-1]
+            for action, transition in self.transitions.get(current, {}).items():
+                if transition.next_hash not in parents:
+                    parents[transition.next_hash] = (current, action)
+                    queue.append(transition.next_hash)
+        return None
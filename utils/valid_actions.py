@@ -0,0 +1,92 @@
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class ValidActionCache:
+    def __init__(
+        self, max_entries: int = 4096, path: str | None = None, save_path: str | None = None
+    ):
+        """
+        Caches `env.get_valid_actions` results keyed on the Jericho world-state hash.
+        :param max_entries: Number of world states kept before least recently used ones are evicted.
+        :param path: Optional JSON file the cache is loaded from and saved to between runs.
+        :param save_path: Save to this file instead of path, e.g. so that worker processes
+            don't overwrite each other's entries. The parent merges their files afterwards.
+        """
+        self.max_entries = max_entries
+        self.path = path
+        self.save_path = save_path or path
+        self.entries: OrderedDict[str, list[str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Concurrent games look states up from worker threads.
+        self.lock = threading.Lock()
+
+        if path is not None:
+            self.load(path)
+
+    def get_valid_actions(self, env) -> list[str]:
+        state_hash = env.get_world_state_hash()
+
+        with self.lock:
+            if state_hash in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(state_hash)
+                return list(self.entries[state_hash])
+            self.misses += 1
+
+        valid_actions = env.get_valid_actions(use_parallel=False)
+        self.put(state_hash, valid_actions)
+        return list(valid_actions)
+
+    def put(self, state_hash: str, valid_actions: list[str]):
+        with self.lock:
+            self.entries[state_hash] = list(valid_actions)
+            self.entries.move_to_end(state_hash)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def load(self, path: str):
+        """
+        Adds the entries saved in `path`. A missing or unreadable file counts as empty, since the
+        cache can always be rebuilt from the emulator.
+        """
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for state_hash, valid_actions in entries.items():
+            self.put(state_hash, valid_actions)
+
+    def save(self):
+        if self.save_path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.save_path))
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file of our own first, so an interrupted or concurrent save can't
+        # leave a half-written cache behind.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with self.lock, os.fdopen(fd, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.save_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (
+            f"{self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate), "
+            f"{len(self.entries)} states"
+        )
+
+
+def cache_path_for_rom(cache_dir: str, rom_path: str) -> str:
+    rom_name = os.path.splitext(os.path.basename(rom_path))[0]
+    return os.path.join(cache_dir, f"{rom_name}.valid_actions.json")